@@ -0,0 +1,156 @@
+/*
+ * bench.c
+ *
+ * Run several instruction set tests at the same time, one per thread
+ * pinned to its own cpu, and report the number of test runs per second
+ * of each of them.
+ */
+
+#define _GNU_SOURCE
+#include <sched.h>
+#include <signal.h>
+#include <setjmp.h>
+#include <string.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/time.h>
+#include "tests.h"
+
+#define CHECK_EVERY 256
+
+typedef struct {
+	const char *name;
+	int (*func)();
+} bench_test;
+
+static const bench_test bench_tests[] = {
+	{ "sse3", sse3 },
+	{ "ssse3", ssse3 },
+	{ "sse4", sse4 },
+	{ "sse4a", sse4a },
+	{ "avx", avx },
+	{ "aes", aes },
+	{ "pclmul", pclmul },
+	{ "rdrand", rdrand },
+	{ "fma4", fma4 },
+	{ "xop", xop },
+};
+
+#define N_BENCH_TESTS (sizeof(bench_tests) / sizeof(*bench_tests))
+
+typedef struct {
+	const bench_test *test;
+	unsigned long long ops;
+	unsigned long long failures;
+	double elapsed;
+	int sigill;
+	int cpu;
+} bench_result;
+
+static __thread sigjmp_buf bench_jmp;
+
+static void bench_sigill(int sig) {
+	siglongjmp(bench_jmp, 1);
+}
+
+static double now() {
+	struct timeval tv;
+
+	gettimeofday(&tv, NULL);
+	return tv.tv_sec + tv.tv_usec / 1e6;
+}
+
+static const bench_test *find_test(const char *name) {
+	for (unsigned int i = 0; i < N_BENCH_TESTS; i++) {
+		if (strcmp(bench_tests[i].name, name) == 0)
+			return &bench_tests[i];
+	}
+	return NULL;
+}
+
+static void bench_run(bench_result *res, unsigned int duration) {
+	/* volatile: kept across siglongjmp */
+	volatile unsigned long long ops = 0;
+	volatile unsigned long long failures = 0;
+	double start, end;
+	cpu_set_t mask;
+
+	CPU_ZERO(&mask);
+	CPU_SET(res->cpu, &mask);
+	sched_setaffinity(0, sizeof(mask), &mask);
+
+	start = now();
+	end = start + duration;
+	if (sigsetjmp(bench_jmp, 1) == 0) {
+		while (1) {
+			for (int i = 0; i < CHECK_EVERY; i++) {
+				if (res->test->func() != 0)
+					failures++;
+				ops++;
+			}
+			if (now() >= end)
+				break;
+		}
+	} else {
+		res->sigill = 1;
+	}
+	res->elapsed = now() - start;
+	res->ops = ops;
+	res->failures = failures;
+}
+
+void bench(unsigned int duration, char *tests) {
+	bench_result results[N_BENCH_TESTS];
+	int n = 0;
+	long ncpus = sysconf(_SC_NPROCESSORS_ONLN);
+	int saved_stdout;
+	int devnull;
+	char *pch;
+
+	memset(results, 0, sizeof(results));
+	pch = strtok(tests, ",");
+	while (pch != NULL && n < (int) N_BENCH_TESTS) {
+		const bench_test *test = find_test(pch);
+		if (test == NULL) {
+			fprintf(stderr, "bench: unknown test %s\n", pch);
+			exit(-1);
+		}
+		results[n].test = test;
+		results[n].cpu = n % (ncpus > 0 ? ncpus : 1);
+		n++;
+		pch = strtok(NULL, ",");
+	}
+	if (!n) {
+		fprintf(stderr, "bench: no test given\n");
+		exit(-1);
+	}
+
+	signal(SIGILL, bench_sigill);
+	/* The tests print their results, keep them out of the report */
+	fflush(stdout);
+	saved_stdout = dup(1);
+	devnull = open("/dev/null", O_WRONLY);
+	dup2(devnull, 1);
+
+	omp_set_dynamic(0);
+	omp_set_num_threads(n);
+	#pragma omp parallel for schedule(static, 1)
+	for (int i = 0; i < n; i++) {
+		bench_run(&results[i], duration);
+	}
+
+	fflush(stdout);
+	dup2(saved_stdout, 1);
+	close(devnull);
+	close(saved_stdout);
+	signal(SIGILL, SIG_DFL);
+
+	printf("bench: test ops ops/s failures sigill cpu\n");
+	for (int i = 0; i < n; i++) {
+		printf("bench: %s %llu %.1f %llu %d %d\n", results[i].test->name,
+		       results[i].ops,
+		       results[i].elapsed > 0 ? results[i].ops / results[i].elapsed : 0.0,
+		       results[i].failures, results[i].sigill, results[i].cpu);
+	}
+	fflush(stdout);
+}
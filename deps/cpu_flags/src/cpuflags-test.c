@@ -18,7 +18,15 @@ void print_help(){
 			"  --stress n_cpus,avx,aes          start stress on n_cpus.and cpuflags.\n"
 			"  --stressmem mem_size[,max_mem]   start stressmem\n"
 			"                                   mem_size/s amount of mem in MB filled by one second.\n"
-			"                                   max_mem in MB which can be use for filling.\n");
+			"                                   max_mem in MB which can be use for filling.\n"
+			"  --dirtymem total,wss,rate[,entropy[,report]]\n"
+			"                                   dirty rate pages/s of the first wss MB\n"
+			"                                   of total MB, entropy %% of each page\n"
+			"                                   changed (default 100), achieved rate\n"
+			"                                   is printed and appended to report.\n"
+			"  --bench duration,sse3,aes,...    run the tests at the same time, one\n"
+			"                                   per cpu, for duration seconds and\n"
+			"                                   print the test runs/s of each.\n");
 }
 
 
@@ -66,6 +74,40 @@ inst parse_Inst(char * optarg){
 	return i;
 }
 
+void parse_dirtymem(char * optarg){
+	unsigned int values[4] = {0, 0, 0, 100};
+	const char *report = NULL;
+	char * pch;
+	int i = 0;
+
+	pch = strtok(optarg, ",");
+	while (pch != NULL) {
+		if (i < 4) {
+			values[i] = (unsigned int) atoi(pch);
+		} else {
+			report = pch;
+		}
+		i++;
+		pch = strtok(NULL, ",");
+	}
+	if (i < 3 || values[3] > 100) {
+		print_help();
+		exit(-1);
+	}
+	dirtymem(values[0], values[1], values[2], values[3], report);
+}
+
+void parse_bench(char * optarg){
+	char * tests = strchr(optarg, ',');
+
+	if (tests == NULL || atoi(optarg) <= 0) {
+		print_help();
+		exit(-1);
+	}
+	*tests++ = '\0';
+	bench((unsigned int) atoi(optarg), tests);
+}
+
 void parse_mem(char * optarg, unsigned int *stressmem, unsigned int *maxmem) {
 	char * pch;
 
@@ -106,6 +148,8 @@ int main(int argc, char **argv) {
 				{ "rdrand", no_argument, 0, 0 },
 				{ "fma4",   no_argument, 0, 0 },
 				{ "xop",    no_argument, 0, 0 },
+				{ "dirtymem", required_argument, 0, 0 },
+				{ "bench", required_argument, 0, 0 },
 				{ 0, 0, 0, 0}};
 
 		c = getopt_long(argc, argv, "", long_options, &option_index);
@@ -158,6 +202,12 @@ int main(int argc, char **argv) {
 			case 11:
 				ret += xop();
 				break;
+			case 12:
+				parse_dirtymem(optarg);
+				break;
+			case 13:
+				parse_bench(optarg);
+				break;
 
 			}
 			break;
@@ -17,9 +17,10 @@ int pclmul(){
 	}
 	__ma128i v3;
 	v3.i = _mm_clmulepi64_si128(v1.i, v2.i, 0);
-	if (v3.ui64[0] != 5)
+	if (v3.ui64[0] != 5) {
 		printf("Correct: %d result: %d\n", 5, v3.ui64[0]);
 		return -1;
+	}
 	return 0;
 }
 #else
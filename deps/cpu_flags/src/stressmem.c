@@ -72,3 +72,136 @@ void stressmem(unsigned int sizeMB, unsigned int fillMB){
 	printf("Stress round.\n");
 	free(a);
 }
+
+#define PAGE_SIZE 4096
+#define SLICES_PER_SEC 100
+#define USEC ((long long)(STOUS))
+
+static inline uint64_t xorshift64(uint64_t *state){
+	uint64_t x = *state;
+	x ^= x << 13;
+	x ^= x >> 7;
+	x ^= x << 17;
+	*state = x;
+	return x;
+}
+
+/*
+ * Write one page. Only entropy % of its 64 bit words get new pseudo random
+ * data, the rest stays untouched, so a low entropy gives xbzrle small deltas
+ * (cache hits) and 100 % makes every page overflow the xbzrle encoding.
+ */
+static void dirty_page(uint64_t *page, unsigned int words, uint64_t *state){
+	unsigned int step = PAGE_SIZE / sizeof(uint64_t) / words;
+	for (unsigned int i = 0; i < words; i++){
+		page[i * step] = xorshift64(state);
+	}
+}
+
+/*
+ * Dirty guest memory at a given rate.
+ *
+ * totalMB   allocated and touched once
+ * wssMB     working set, the first wssMB of the buffer are dirtied over and
+ *           over, page after page
+ * rate      target dirty pages per second, 0 means as fast as possible
+ * entropy   percentage of each dirtied page that changes
+ * report    if not NULL, every second the achieved rate is written there as
+ *           "time_s pages_total rate_pages_s target_pages_s", the same line
+ *           is also printed with a "dirtymem:" prefix
+ */
+void dirtymem(unsigned int totalMB, unsigned int wssMB, unsigned int rate,
+              unsigned int entropy, const char *report){
+	size_t total_pages = (size_t)totalMB * 1024 * 1024 / PAGE_SIZE;
+	size_t wss_pages = (size_t)wssMB * 1024 * 1024 / PAGE_SIZE;
+	unsigned int words = PAGE_SIZE / sizeof(uint64_t) * entropy / 100;
+	struct timeval starttime, now, last_report;
+	struct timeval tsleep;
+	uint64_t state = 88172645463325252ULL;
+	unsigned long long dirtied = 0, last_dirtied = 0;
+	long long slice = USEC / SLICES_PER_SEC;
+	long long next_slice;
+	size_t pos = 0;
+
+	if (wss_pages == 0 || wss_pages > total_pages){
+		wss_pages = total_pages;
+	}
+	if (words == 0){
+		words = 1;
+	}
+	if (total_pages == 0){
+		fprintf(stderr, "dirtymem: nothing to dirty\n");
+		exit(-1);
+	}
+	if (rate && rate < SLICES_PER_SEC){
+		slice = USEC / rate;
+	}
+
+	char *a = malloc(total_pages * PAGE_SIZE);
+	if (a == NULL){
+		fprintf(stderr, "dirtymem: unable to allocate %u MB\n", totalMB);
+		exit(-1);
+	}
+	for (size_t p = 0; p < total_pages; p++){
+		dirty_page((uint64_t *)(a + p * PAGE_SIZE), 1, &state);
+	}
+	printf("dirtymem: total %u MB, working set %zu pages, target %u pages/s,"
+	       " entropy %u %%\n", totalMB, wss_pages, rate, entropy);
+	fflush(stdout);
+
+	gettimeofday(&starttime, 0x0);
+	last_report = starttime;
+	next_slice = slice;
+	while (1){
+		// every slice catches up with rate * end of slice, so rates that
+		// are not a multiple of SLICES_PER_SEC are not truncated
+		unsigned long long count = 1024;
+		if (rate){
+			unsigned long long target = (unsigned long long)
+				((double)rate * next_slice / USEC + 0.5);
+			count = target > dirtied ? target - dirtied : 0;
+		}
+		for (unsigned long long i = 0; i < count; i++){
+			dirty_page((uint64_t *)(a + pos * PAGE_SIZE), words, &state);
+			if (++pos == wss_pages){
+				pos = 0;
+			}
+		}
+		dirtied += count;
+
+		gettimeofday(&now, 0x0);
+		long long since_report = timeval_subtract(&now, &last_report);
+		if (since_report >= USEC){
+			double achieved = (dirtied - last_dirtied) * (double)USEC /
+					since_report;
+			double elapsed = timeval_subtract(&now, &starttime) /
+					(double)USEC;
+			printf("dirtymem: %.3f %llu %.0f %u\n", elapsed, dirtied,
+			       achieved, rate);
+			fflush(stdout);
+			if (report != NULL){
+				FILE *f = fopen(report, "a");
+				if (f != NULL){
+					fprintf(f, "%.3f %llu %.0f %u\n", elapsed, dirtied,
+					        achieved, rate);
+					fclose(f);
+				}
+			}
+			last_report = now;
+			last_dirtied = dirtied;
+		}
+
+		if (rate){
+			// sleep until the next slice, deadlines are absolute so the
+			// rate does not drift; when late, just continue
+			long long wait = next_slice - timeval_subtract(&now, &starttime);
+			if (wait > 0){
+				tsleep.tv_sec = wait / USEC;
+				tsleep.tv_usec = wait % USEC;
+				select(0, NULL, NULL, NULL, &tsleep);
+			}
+			next_slice += slice;
+		}
+	}
+	free(a);
+}
@@ -72,6 +72,9 @@ int fma4();
 int xop();
 void stress(inst in);
 void stressmem(unsigned int sizeMB, unsigned int fillMB);
+void dirtymem(unsigned int totalMB, unsigned int wssMB, unsigned int rate,
+              unsigned int entropy, const char *report);
+void bench(unsigned int duration, char *tests);
 
 
 #endif /* TEST_H_ */
@@ -0,0 +1,282 @@
+/*
+ * ksm_fill.c
+ *
+ * Native replacement of the ksm_overcommit_guest.py allocator. It reads
+ * the same commands on stdin:
+ *
+ *   mem = MemFill(size_mb, static_value, random_key)
+ *   mem.value_fill([value])
+ *   mem.value_check([value])
+ *   mem.static_random_fill([n_bytes_on_end])
+ *   mem.static_random_verify([n_bytes_on_end])
+ *   die()
+ *
+ * and answers every one of them with a "PASS:" or "FAIL:" line. The
+ * memory is a file on a private tmpfs, so the allocation is not limited
+ * by the process address space, it is filled and verified by one OpenMP
+ * thread per cpu working on mmap()ed windows of the file.
+ *
+ * static_random_fill writes the same random page everywhere, with a
+ * 64 bit word unique to every page (its index xored with a value of
+ * random_key) stored at an offset among the last n_bytes_on_end, so no
+ * two pages are equal but they only differ in their end. The page, the
+ * words and their offsets are derived from random_key,
+ * static_random_verify computes them again.
+ */
+
+#define _GNU_SOURCE
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <omp.h>
+#include <sys/mman.h>
+#include <sys/mount.h>
+#include <sys/time.h>
+
+#define PAGE_SIZE 4096
+#define WINDOW (64 * 1024 * 1024)
+#define WINDOW_PAGES (WINDOW / PAGE_SIZE)
+
+static char tmpdir[] = "/tmp/ksm_fill.XXXXXX";
+static char path[sizeof(tmpdir) + 8];
+static int mem_fd = -1;
+static unsigned long long npages;
+static unsigned int static_value;
+static unsigned int random_key;
+static unsigned char random_page[PAGE_SIZE];
+
+static uint64_t mix(uint64_t x) {
+	/* splitmix64 finalizer */
+	x ^= x >> 30;
+	x *= 0xbf58476d1ce4e5b9ULL;
+	x ^= x >> 27;
+	x *= 0x94d049bb133111ebULL;
+	x ^= x >> 31;
+	return x;
+}
+
+static double now() {
+	struct timeval tv;
+
+	gettimeofday(&tv, NULL);
+	return tv.tv_sec + tv.tv_usec / 1e6;
+}
+
+/*
+ * Store the word unique to the page at its offset, an 8 byte aligned
+ * one among the last n_bytes_on_end (at least 8) bytes.
+ */
+static void stamp_page(unsigned char *page, unsigned long long index,
+		       unsigned int n_bytes_on_end) {
+	uint64_t r = mix(((uint64_t) random_key << 40) ^ index ^
+			 0x9e3779b97f4a7c15ULL);
+	uint64_t word = index ^ mix(random_key);
+
+	memcpy(page + PAGE_SIZE - 8 - 8 * (r % (n_bytes_on_end / 8)), &word,
+	       sizeof(word));
+}
+
+static void free_mem() {
+	if (mem_fd < 0)
+		return;
+	close(mem_fd);
+	mem_fd = -1;
+	unlink(path);
+	umount(tmpdir);
+	rmdir(tmpdir);
+}
+
+static int mem_fill(unsigned int size_mb, unsigned int value,
+		    unsigned int key) {
+	char options[32];
+	uint64_t r = key;
+
+	free_mem();
+	strcpy(tmpdir, "/tmp/ksm_fill.XXXXXX");
+	if (mkdtemp(tmpdir) == NULL) {
+		printf("FAIL: mkdtemp: %m\n");
+		return -1;
+	}
+	snprintf(options, sizeof(options), "size=%uM", size_mb + 25);
+	if (mount("tmpfs", tmpdir, "tmpfs", 0, options) != 0) {
+		printf("FAIL: mount tmpfs on %s: %m\n", tmpdir);
+		rmdir(tmpdir);
+		return -1;
+	}
+	snprintf(path, sizeof(path), "%s/data", tmpdir);
+	mem_fd = open(path, O_RDWR | O_CREAT | O_TRUNC, 0600);
+	npages = (unsigned long long) size_mb * 1024 * 1024 / PAGE_SIZE;
+	if (mem_fd < 0 || ftruncate(mem_fd, npages * PAGE_SIZE) != 0) {
+		printf("FAIL: create %s: %m\n", path);
+		free_mem();
+		return -1;
+	}
+	static_value = value;
+	random_key = key;
+	for (int i = 0; i < PAGE_SIZE; i++) {
+		r = mix(r + 0x9e3779b97f4a7c15ULL);
+		random_page[i] = r;
+	}
+	printf("PASS: Initialization\n");
+	return 0;
+}
+
+/*
+ * Run op on every window of the memory, on all the cpus.
+ * op returns the number of bad pages of the window.
+ */
+static long long for_each_window(long long (*op)(unsigned char *,
+						 unsigned long long,
+						 unsigned long long,
+						 unsigned int),
+				 unsigned int arg, int write) {
+	unsigned long long nwindows = (npages + WINDOW_PAGES - 1) / WINDOW_PAGES;
+	long long bad = 0;
+	int error = 0;
+
+	#pragma omp parallel for schedule(dynamic, 1) reduction(+:bad)
+	for (long long w = 0; w < (long long) nwindows; w++) {
+		unsigned long long first = w * WINDOW_PAGES;
+		unsigned long long count = npages - first;
+		unsigned char *map;
+
+		if (count > WINDOW_PAGES)
+			count = WINDOW_PAGES;
+		map = mmap(NULL, count * PAGE_SIZE,
+			   write ? PROT_READ | PROT_WRITE : PROT_READ,
+			   MAP_SHARED | MAP_POPULATE, mem_fd,
+			   first * PAGE_SIZE);
+		if (map == MAP_FAILED) {
+			error = 1;
+			continue;
+		}
+		bad += op(map, first, count, arg);
+		munmap(map, count * PAGE_SIZE);
+	}
+	return error ? -1 : bad;
+}
+
+static long long value_fill_op(unsigned char *map, unsigned long long first,
+			       unsigned long long count, unsigned int value) {
+	memset(map, value, count * PAGE_SIZE);
+	return 0;
+}
+
+static long long value_check_op(unsigned char *map, unsigned long long first,
+				unsigned long long count, unsigned int value) {
+	unsigned char page[PAGE_SIZE];
+	long long bad = 0;
+
+	memset(page, value, PAGE_SIZE);
+	for (unsigned long long i = 0; i < count; i++) {
+		if (memcmp(map + i * PAGE_SIZE, page, PAGE_SIZE) != 0)
+			bad++;
+	}
+	return bad;
+}
+
+static long long random_fill_op(unsigned char *map, unsigned long long first,
+				unsigned long long count,
+				unsigned int n_bytes_on_end) {
+	for (unsigned long long i = 0; i < count; i++) {
+		unsigned char *page = map + i * PAGE_SIZE;
+
+		memcpy(page, random_page, PAGE_SIZE);
+		stamp_page(page, first + i, n_bytes_on_end);
+	}
+	return 0;
+}
+
+static long long random_verify_op(unsigned char *map, unsigned long long first,
+				  unsigned long long count,
+				  unsigned int n_bytes_on_end) {
+	unsigned char page[PAGE_SIZE];
+	long long bad = 0;
+
+	for (unsigned long long i = 0; i < count; i++) {
+		memcpy(page, random_page, PAGE_SIZE);
+		stamp_page(page, first + i, n_bytes_on_end);
+		if (memcmp(map + i * PAGE_SIZE, page, PAGE_SIZE) != 0)
+			bad++;
+	}
+	return bad;
+}
+
+static void run(const char *name, long long (*op)(unsigned char *,
+						  unsigned long long,
+						  unsigned long long,
+						  unsigned int),
+		unsigned int arg, int write) {
+	double start, elapsed, gbps;
+	long long bad;
+
+	if (mem_fd < 0) {
+		printf("FAIL: %s: no memory, use MemFill first\n", name);
+		return;
+	}
+	start = now();
+	bad = for_each_window(op, arg, write);
+	elapsed = now() - start;
+	gbps = elapsed > 0 ? npages * PAGE_SIZE / elapsed / 1e9 : 0.0;
+	if (bad < 0)
+		printf("FAIL: %s: mmap failed\n", name);
+	else if (bad > 0)
+		printf("FAIL: %s: %lld of %llu pages differ\n", name, bad, npages);
+	else
+		/* split()[4] is the duration in ms, like the python allocator */
+		printf("PASS: %s duration = %lld ms (%.2f GB/s, %d threads)\n",
+		       name, (long long) (elapsed * 1000), gbps,
+		       omp_get_max_threads());
+}
+
+static int arg_or(const char *args, unsigned int def, unsigned int *value) {
+	const char *p = strchr(args, '(');
+
+	if (p == NULL)
+		return -1;
+	if (sscanf(p + 1, "%u", value) != 1)
+		*value = def;
+	return 0;
+}
+
+int main(void) {
+	char line[256];
+	unsigned int a, b, c;
+
+	setvbuf(stdout, NULL, _IOLBF, 0);
+	printf("PASS: Start\n");
+	while (fgets(line, sizeof(line), stdin) != NULL) {
+		char *cmd = line;
+
+		while (*cmd == ' ')
+			cmd++;
+		if (sscanf(cmd, "mem = MemFill(%u, %u, %u)", &a, &b, &c) == 3) {
+			mem_fill(a, b, c);
+		} else if (strncmp(cmd, "mem.value_fill(", 15) == 0) {
+			arg_or(cmd, static_value, &a);
+			run("filling", value_fill_op, a, 1);
+		} else if (strncmp(cmd, "mem.value_check(", 16) == 0) {
+			arg_or(cmd, static_value, &a);
+			run("check", value_check_op, a, 0);
+		} else if (strncmp(cmd, "mem.static_random_fill(", 23) == 0) {
+			arg_or(cmd, PAGE_SIZE, &a);
+			if (a < 8 || a > PAGE_SIZE)
+				a = PAGE_SIZE;
+			run("filling", random_fill_op, a, 1);
+		} else if (strncmp(cmd, "mem.static_random_verify(", 25) == 0) {
+			arg_or(cmd, PAGE_SIZE, &a);
+			if (a < 8 || a > PAGE_SIZE)
+				a = PAGE_SIZE;
+			run("verification", random_verify_op, a, 0);
+		} else if (strncmp(cmd, "die()", 5) == 0) {
+			break;
+		} else if (*cmd != '\n' && *cmd != '\0') {
+			printf("FAIL: unknown command: %s", cmd);
+		}
+	}
+	free_mem();
+	return 0;
+}
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+Start several netperf streams at once and aggregate their results live.
+
+usage: netperf_driver.py <sessions> <duration> <netperf> [netperf args]
+
+netperf has to run in demo mode (-D <interval>). The interim results of
+every stream are read from its stdout pipe as soon as they are printed.
+Once every stream reported, "ALL_STARTED" is printed. Then, every
+second, the sum of the latest interim result of each stream is printed
+as "SUM <elapsed> <aggregate>". After <duration> seconds the streams are
+killed and "RESULT <mean aggregate> <number of SUM lines>" is printed.
+"""
+
+import os
+import re
+import sys
+import time
+import select
+import signal
+import subprocess
+
+
+INTERIM_RE = re.compile(r"Interim result:\s*(\S+)")
+
+
+def output(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def main(argv):
+    if len(argv) < 4:
+        sys.stderr.write(__doc__)
+        return 2
+    sessions = int(argv[1])
+    duration = float(argv[2])
+    netperf_cmd = argv[3:]
+
+    streams = {}
+    for _ in range(sessions):
+        proc = subprocess.Popen(netperf_cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        streams[proc.stdout.fileno()] = [proc, "", None]
+
+    all_started = None
+    next_tick = None
+    sums = []
+    exit_status = 0
+    try:
+        while streams:
+            now = time.time()
+            if all_started is not None and now - all_started >= duration:
+                break
+            timeout = 1.0
+            if next_tick is not None:
+                timeout = max(0, next_tick - now)
+            readable = select.select(list(streams.keys()), [], [],
+                                     timeout)[0]
+            for fd in readable:
+                data = os.read(fd, 65536)
+                stream = streams[fd]
+                if not data:
+                    # the stream ended before the measurement was done
+                    del streams[fd]
+                    exit_status = 1
+                    continue
+                stream[1] += data.decode("ascii", "replace")
+                lines = stream[1].split("\n")
+                stream[1] = lines.pop()
+                for line in lines:
+                    match = INTERIM_RE.search(line)
+                    if match:
+                        stream[2] = float(match.group(1))
+
+            now = time.time()
+            if all_started is None:
+                if all(_[2] is not None for _ in streams.values()):
+                    all_started = now
+                    next_tick = now + 1
+                    output("ALL_STARTED %d" % len(streams))
+            elif now >= next_tick:
+                total = sum(_[2] for _ in streams.values()
+                            if _[2] is not None)
+                sums.append(total)
+                output("SUM %.3f %.2f" % (now - all_started, total))
+                next_tick += 1
+    finally:
+        for stream in streams.values():
+            try:
+                os.kill(stream[0].pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    if sums:
+        output("RESULT %.2f %d" % (sum(sums) / len(sums), len(sums)))
+    else:
+        output("RESULT 0 0")
+        exit_status = 1
+    return exit_status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Persistent network statistics agent for the netperf test.
+
+Reads commands from stdin, one per line, so it can be kept running in a
+guest shell session for the whole test:
+
+    snapshot <ip>   print "STATS <json>" with the counters of the interface
+                    owning <ip>: netdev stats, per queue virtio interrupts
+                    and the TCP retransmitted segments
+    quit            exit
+
+All the counters are read in process, no command is forked per request.
+"""
+
+import os
+import sys
+import json
+import fcntl
+import socket
+import struct
+
+
+SIOCGIFADDR = 0x8915
+_ifname_cache = {}
+
+
+def get_ifname(ip):
+    """
+    Find the interface holding an IPv4 address.
+    """
+    if ip in _ifname_cache:
+        return _ifname_cache[ip]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for ifname in os.listdir("/sys/class/net"):
+            try:
+                ifreq = struct.pack("256s", ifname[:15].encode())
+                addr = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, ifreq)[20:24]
+            except IOError:
+                continue
+            if socket.inet_ntoa(addr) == ip:
+                _ifname_cache[ip] = ifname
+                return ifname
+    finally:
+        sock.close()
+    raise ValueError("No interface with address %s" % ip)
+
+
+def read_int(path):
+    with open(path) as stat_file:
+        return int(stat_file.read())
+
+
+def netdev_stats(ifname):
+    stats_dir = "/sys/class/net/%s/statistics" % ifname
+    return {"rx_pkts": read_int(os.path.join(stats_dir, "rx_packets")),
+            "tx_pkts": read_int(os.path.join(stats_dir, "tx_packets")),
+            "rx_byts": read_int(os.path.join(stats_dir, "rx_bytes")),
+            "tx_byts": read_int(os.path.join(stats_dir, "tx_bytes"))}
+
+
+def tcp_retrans():
+    with open("/proc/net/snmp") as snmp_file:
+        tcp = [_.split() for _ in snmp_file if _.startswith("Tcp:")]
+    return int(tcp[1][tcp[0].index("RetransSegs")])
+
+
+def virtio_interrupts():
+    """
+    Per queue interrupt counts of the virtio devices, summed over cpus.
+
+    :return: tuple of (input queue counts, output queue counts, all
+             virtio interrupt counts), in /proc/interrupts order
+    """
+    rx_intr, tx_intr, intr = [], [], []
+    with open("/proc/interrupts") as irq_file:
+        ncpu = len(irq_file.readline().split())
+        for line in irq_file:
+            fields = line.split()
+            if not fields or "virtio" not in fields[-1]:
+                continue
+            count = sum(int(_) for _ in fields[1:ncpu + 1] if _.isdigit())
+            intr.append(count)
+            if "-input" in fields[-1]:
+                rx_intr.append(count)
+            elif "-output" in fields[-1]:
+                tx_intr.append(count)
+    return rx_intr, tx_intr, intr
+
+
+def snapshot(ip):
+    stats = netdev_stats(get_ifname(ip))
+    stats["re_pkts"] = tcp_retrans()
+    stats["rx_intr"], stats["tx_intr"], stats["intr"] = virtio_interrupts()
+    return stats
+
+
+def main():
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        args = line.split()
+        if not args:
+            continue
+        if args[0] == "quit":
+            break
+        try:
+            if args[0] == "snapshot":
+                result = "STATS %s" % json.dumps(snapshot(args[1]))
+            else:
+                result = "ERROR unknown command %s" % args[0]
+        except Exception as details:
+            result = "ERROR %s" % details
+        sys.stdout.write(result + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
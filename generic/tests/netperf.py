@@ -1,10 +1,13 @@
 import logging
 import os
+import json
 import commands
 import threading
 import re
 import time
 
+import aexpect
+
 from autotest.client import utils
 from autotest.client.shared import error
 
@@ -15,6 +18,9 @@ from virttest import remote
 from virttest import data_dir
 from virttest import arch
 
+from provider import convergence
+from provider import host_sampler
+
 
 _netserver_started = False
 
@@ -106,6 +112,16 @@ def run(test, params, env):
         agent_path = os.path.join(test.virtdir, "scripts/netperf_agent.py")
         remote.scp_to_remote(ip, shell_port, username, password,
                              agent_path, "/tmp")
+        if params.get("netstat_agent") == "yes":
+            agent_path = os.path.join(data_dir.get_deps_dir("netperf"),
+                                      "netstat_agent.py")
+            remote.scp_to_remote(ip, shell_port, username, password,
+                                 agent_path, "/tmp")
+        if params.get("netperf_driver") == "stream":
+            driver_path = os.path.join(data_dir.get_deps_dir("netperf"),
+                                       "netperf_driver.py")
+            remote.scp_to_remote(ip, shell_port, username, password,
+                                 driver_path, "/tmp")
 
     def _pin_vm_threads(vm, node):
         if node:
@@ -226,6 +242,26 @@ def run(test, params, env):
 
     env.stop_tcpdump()
 
+    # keep one guest session with the stats agent for the whole test
+    # instead of several ssh commands per guest counter snapshot
+    stats_session = None
+    if (params.get("get_status_in_guest", "no") == "yes" and
+            params.get("netstat_agent") == "yes"):
+        stats_session = vm.wait_for_login(timeout=login_timeout)
+        stats_session.sendline("python /tmp/netstat_agent.py")
+
+    # sample the local host in process instead of forking mpstat and cat
+    sampler = None
+    if host == "localhost" and params.get("host_sampler", "yes") == "yes":
+        if arch.ARCH in ('ppc64', 'ppc64le'):
+            kvm_stats = ("exits",)
+        else:
+            kvm_stats = ("io_exits", "irq_injections")
+        sampler = host_sampler.HostSampler(
+            interval=float(params.get("host_sample_interval", 1)),
+            kvm_stats=kvm_stats, pids=[vm.get_pid()])
+        sampler.start()
+
     error.context("Start netperf testing", logging.info)
     start_test(server_ip, server_ctl, host, clients, test.resultsdir,
                test_duration=int(params.get('l')),
@@ -236,7 +272,13 @@ def run(test, params, env):
                protocols=params.get('protocols'),
                ver_cmd=params.get('ver_cmd', "rpm -q qemu-kvm"),
                netserver_port=params.get('netserver_port', "12865"),
-               params=params, server_cyg=server_cyg, test=test)
+               params=params, server_cyg=server_cyg, test=test,
+               sampler=sampler, stats_session=stats_session)
+    if sampler:
+        sampler.stop()
+    if stats_session:
+        stats_session.sendline("quit")
+        stats_session.close()
 
     if params.get("log_hostinfo_script"):
         src = os.path.join(test.virtdir, params.get("log_hostinfo_script"))
@@ -261,7 +303,8 @@ def start_test(server, server_ctl, host, clients, resultsdir, test_duration=60,
                sizes_rr="64 256 512 1024 2048",
                sizes="64 256 512 1024 2048 4096",
                protocols="TCP_STREAM TCP_MAERTS TCP_RR TCP_CRR", ver_cmd=None,
-               netserver_port=None, params=None, server_cyg=None, test=None):
+               netserver_port=None, params=None, server_cyg=None, test=None,
+               sampler=None, stats_session=None):
     """
     Start to test with different kind of configurations
 
@@ -280,6 +323,10 @@ def start_test(server, server_ctl, host, clients, resultsdir, test_duration=60,
     :param netserver_port: netserver listen port
     :param params: Dictionary with the test parameters.
     :param server_cyg: shell session for cygwin in windows guest
+    :param sampler: started HostSampler of the local host, used instead
+                    of mpstat and the debugfs reads over ssh
+    :param stats_session: guest session running netstat_agent.py, used to
+                          get the guest counters in one request
     """
     if params is None:
         params = {}
@@ -314,16 +361,26 @@ def start_test(server, server_ctl, host, clients, resultsdir, test_duration=60,
     for i in range(int(params.get("queues", 0))):
         record_list.append('tx_intr_%s' % i)
     record_list.append('tx_intr_sum')
+
+    # repeat every cell until its throughput is stable, and record the
+    # number of runs and the coefficient of variation in %
+    stable_mode = params.get("stable_mode") == "yes"
+    cv_target = float(params.get("stable_cv_target", 0.05))
+    min_runs = int(params.get("stable_min_runs", 3))
+    max_runs = int(params.get("stable_max_runs", 10))
+    if stable_mode:
+        record_list.extend(['samples', 'thu_cv'])
     base = params.get("format_base", "12")
     fbase = params.get("format_fbase", "2")
 
-    output = ssh_cmd(host, "mpstat 1 1 |grep CPU")
-    mpstat_head = re.findall(r"CPU\s+.*", output)[0].split()
-    mpstat_key = params.get("mpstat_key", "%idle")
-    if mpstat_key in mpstat_head:
-        mpstat_index = mpstat_head.index(mpstat_key) + 1
-    else:
-        mpstat_index = 0
+    if not sampler:
+        output = ssh_cmd(host, "mpstat 1 1 |grep CPU")
+        mpstat_head = re.findall(r"CPU\s+.*", output)[0].split()
+        mpstat_key = params.get("mpstat_key", "%idle")
+        if mpstat_key in mpstat_head:
+            mpstat_index = mpstat_head.index(mpstat_key) + 1
+        else:
+            mpstat_index = 0
 
     for protocol in protocols.split():
         error.context("Testing %s protocol" % protocol, logging.info)
@@ -350,11 +407,28 @@ def start_test(server, server_ctl, host, clients, resultsdir, test_duration=60,
                 else:
                     nf_args = "-C -c -t %s -- -m %s" % (protocol, i)
 
-                ret = launch_client(j, server, server_ctl, host, clients, test_duration,
-                                    nf_args, netserver_port, params, server_cyg)
+                def run_once():
+                    ret = launch_client(j, server, server_ctl, host, clients,
+                                        test_duration, nf_args, netserver_port,
+                                        params, server_cyg, sampler,
+                                        stats_session)
+                    if sampler:
+                        ret['CPU'] = ret['host_cpu']
+                    else:
+                        ret['CPU'] = 100 - float(
+                            ret['mpstat'].split()[mpstat_index])
+                    return ret
+
+                if stable_mode:
+                    ret, spread = convergence.run_until_stable(
+                        run_once, 'thu', cv_target, min_runs, max_runs)
+                    ret['samples'] = spread['samples']
+                    ret['thu_cv'] = (spread['cv'] or 0.0) * 100
+                else:
+                    ret = run_once()
 
                 thu = float(ret['thu'])
-                cpu = 100 - float(ret['mpstat'].split()[mpstat_index])
+                cpu = ret['CPU']
                 normal = thu / cpu
                 if arch.ARCH in ('ppc64', 'ppc64le'):
                     if ret.get('tx_pkts') and ret.get('exits'):
@@ -419,7 +493,7 @@ def ssh_cmd(session, cmd, timeout=120, ignore_status=False):
 
 @error.context_aware
 def launch_client(sessions, server, server_ctl, host, clients, l, nf_args,
-                  port, params, server_cyg):
+                  port, params, server_cyg, sampler=None, stats_session=None):
     """ Launch netperf clients """
 
     netperf_version = params.get("netperf_version", "2.6.0")
@@ -492,7 +566,33 @@ def launch_client(sessions, server, server_ctl, host, clients, l, nf_args,
             sum = 0
         return intr
 
-    def get_state():
+    def get_agent_state():
+        """
+        Get all the guest counters with one request to netstat_agent.py
+        """
+        stats_session.sendline("snapshot %s" % server)
+        output = stats_session.read_until_output_matches(
+            [r"(STATS|ERROR) .*\n"], timeout=30)[1]
+        if not re.findall(r"STATS \{", output):
+            raise error.TestError("netstat agent failed: %s" % output)
+        stats = json.loads(re.findall(r"STATS (\{.*\})", output)[-1])
+        state_list = []
+        for key in ('rx_pkts', 'tx_pkts', 'rx_byts', 'tx_byts', 're_pkts'):
+            state_list.append(key)
+            state_list.append(stats[key])
+        if stats["rx_intr"]:
+            for direction in ("rx", "tx"):
+                for i, count in enumerate(stats["%s_intr" % direction]):
+                    state_list.append('%s_intr_%s' % (direction, i))
+                    state_list.append(count)
+                state_list.append('%s_intr_sum' % direction)
+                state_list.append(sum(stats["%s_intr" % direction]))
+        else:
+            state_list.append('intr')
+            state_list.append(stats["intr"])
+        return state_list
+
+    def get_guest_state():
         for i in ssh_cmd(server_ctl, "ifconfig").split("\n\n"):
             if server in i:
                 ifname = re.findall(r"(\w+\d+)[:\s]", i)[0]
@@ -536,6 +636,17 @@ def launch_client(sessions, server, server_ctl, host, clients, l, nf_args,
             state_list.append('intr')
             state_list.append(ninit)
 
+        return state_list
+
+    def get_state():
+        if stats_session:
+            state_list = get_agent_state()
+        else:
+            state_list = get_guest_state()
+
+        # with a sampler the host counters come from the sampled window
+        if sampler:
+            return state_list
         if arch.ARCH in ('ppc64', 'ppc64le'):
             exits = int(ssh_cmd(host, "cat /sys/kernel/debug/kvm/exits"))
             state_list.append('exits')
@@ -564,6 +675,26 @@ def launch_client(sessions, server, server_ctl, host, clients, l, nf_args,
         logging.info("Start netperf thread by cmd '%s'" % cmd)
         ssh_cmd(client_s, cmd)
 
+    def netperf_driver_start(i, numa_enable, client_s):
+        """
+        Start all the netperf streams with netperf_driver.py, which reads
+        their interim results through pipes and prints the aggregated
+        throughput while they run.
+        """
+        cmd = ""
+        if numa_enable:
+            output = ssh_cmd(client_s, "numactl --hardware")
+            n = re.findall(r"node (\d+) cpus:", output)[-1]
+            cmd += "numactl --cpunodebind=%s --membind=%s " % (n, n)
+        cmd += "python /tmp/netperf_driver.py %d %s " % (i, l - 1)
+        cmd += "%s -D 1 -H %s -l %s %s" % (client_path, server,
+                                           int(l) * 1.5, nf_args)
+        logging.info("Start netperf driver by cmd '%s'" % cmd)
+        if client_s == "localhost":
+            return aexpect.Expect(cmd)
+        client_s.sendline(cmd)
+        return client_s
+
     def all_clients_up():
         try:
             content = ssh_cmd(clients[-1], "cat %s" % fname)
@@ -609,18 +740,30 @@ def launch_client(sessions, server, server_ctl, host, clients, l, nf_args,
     ssh_cmd(clients[-1], "rm -f %s" % fname)
     numa_enable = params.get("netperf_with_numa", "yes") == "yes"
     timeout_netperf_start = int(l) * 0.5
-    client_thread = threading.Thread(target=netperf_thread,
-                                     kwargs={"i": int(sessions),
-                                             "numa_enable": numa_enable,
-                                             "client_s": clients[0],
-                                             "timeout": timeout_netperf_start})
-    client_thread.start()
+    stream_driver = params.get("netperf_driver") == "stream"
+    if stream_driver:
+        driver = netperf_driver_start(int(sessions), numa_enable, clients[0])
+    else:
+        client_thread = threading.Thread(target=netperf_thread,
+                                         kwargs={"i": int(sessions),
+                                                 "numa_enable": numa_enable,
+                                                 "client_s": clients[0],
+                                                 "timeout": timeout_netperf_start})
+        client_thread.start()
 
     ret = {}
     ret['pid'] = pid
 
-    if utils_misc.wait_for(all_clients_up, timeout_netperf_start, 0.0, 0.2,
-                           "Wait until all netperf clients start to work"):
+    if stream_driver:
+        try:
+            driver.read_until_output_matches([r"ALL_STARTED"],
+                                             timeout=timeout_netperf_start)
+            logging.debug("All netperf clients start to work.")
+        except aexpect.ExpectError, details:
+            raise error.TestNAError("Error, not all netperf clients at "
+                                    "work: %s" % details)
+    elif utils_misc.wait_for(all_clients_up, timeout_netperf_start, 0.0, 0.2,
+                             "Wait until all netperf clients start to work"):
         logging.debug("All netperf clients start to work.")
     else:
         raise error.TestNAError("Error, not all netperf clients at work")
@@ -628,8 +771,25 @@ def launch_client(sessions, server, server_ctl, host, clients, l, nf_args,
     # real & effective test starts
     if get_status_flag:
         start_state = get_state()
-    ret['mpstat'] = ssh_cmd(host, "mpstat 1 %d |tail -n 1" % (l - 1))
-    finished_result = ssh_cmd(clients[-1], "cat %s" % fname)
+    if sampler:
+        start_time = time.time()
+        time.sleep(l - 1)
+        end_time = time.time()
+        # mpstat's "100 - %idle" counts iowait as busy time
+        ret['host_cpu'] = sampler.cpu_usage(start_time, end_time,
+                                            count_iowait=True)
+        cpu_series = sampler.cpu_series(start_time, end_time,
+                                        count_iowait=True)
+        logging.debug("Host cpu usage: %s", host_sampler.summary(
+            [_[1] for _ in cpu_series]))
+    else:
+        ret['mpstat'] = ssh_cmd(host, "mpstat 1 %d |tail -n 1" % (l - 1))
+    if stream_driver:
+        # the driver stops its streams by itself after l - 1 seconds
+        finished_result = driver.read_until_output_matches(
+            [r"RESULT\s+\S+\s+\d+"], timeout=int(l))[1]
+    else:
+        finished_result = ssh_cmd(clients[-1], "cat %s" % fname)
 
     # stop netperf clients
     kill_cmd = "killall netperf"
@@ -649,10 +809,29 @@ def launch_client(sessions, server, server_ctl, host, clients, l, nf_args,
             for i in range(len(end_state) / 2):
                 ret[end_state[i * 2]] = (end_state[i * 2 + 1] -
                                          start_state[i * 2 + 1])
-
-    client_thread.join()
+        if sampler:
+            if arch.ARCH in ('ppc64', 'ppc64le'):
+                ret['exits'] = sampler.counter_delta("kvm:exits",
+                                                     start_time, end_time)
+            else:
+                ret['io_exits'] = sampler.counter_delta("kvm:io_exits",
+                                                        start_time, end_time)
+                ret['irq_injs'] = sampler.counter_delta(
+                    "kvm:irq_injections", start_time, end_time)
 
     error.context("Testing Results Treatment and Report", logging.info)
+    if stream_driver:
+        if clients[0] == "localhost":
+            driver.close()
+        thu, samples = re.findall(r"RESULT\s+(\S+)\s+(\d+)",
+                                  finished_result)[-1]
+        logging.debug("netperf driver aggregated %s samples" % samples)
+        if not int(samples):
+            raise error.TestError("netperf driver got no interim results")
+        ret['thu'] = float(thu)
+        return ret
+
+    client_thread.join()
     f = open(fname, "w")
     f.write(finished_result)
     f.close()
@@ -0,0 +1,77 @@
+import os
+import json
+import logging
+
+from autotest.client.shared import error
+
+from provider import perf_compare
+
+
+def run(test, params, env):
+    """
+    Compare the *.RHS results of a candidate run against a baseline.
+
+    1) Load the baseline and candidate result sets, every result file
+       found in the given directories is one sample (e.g. repeatN runs)
+    2) Align the rows by category and key columns and compute the
+       relative delta of every metric with its confidence interval
+    3) Write the report and give a verdict per metric, the test fails
+       or warns with the worst of them
+
+    :param test: QEMU test object.
+    :param params: Dictionary with the test parameters.
+    :param env: Dictionary with test environment.
+    """
+    baseline = params.get("baseline_results", "").split()
+    candidate = params.get("candidate_results", "").split()
+    if not baseline or not candidate:
+        raise error.TestNAError("Please set baseline_results and "
+                                "candidate_results")
+    pattern = params.get("result_file_pattern", "*.RHS")
+    key_columns = params.get("key_columns",
+                             " ".join(perf_compare.DEFAULT_KEY_COLUMNS))
+    lower_better = params.get("lower_better_metrics",
+                              " ".join(perf_compare.DEFAULT_LOWER_BETTER))
+    higher_better = params.get("higher_better_metrics",
+                               " ".join(perf_compare.DEFAULT_HIGHER_BETTER))
+    metrics = params.get("compare_metrics", "").split()
+
+    error.context("Load the result sets", logging.info)
+    base = perf_compare.load_result_set(baseline, pattern,
+                                        key_columns.split())
+    cand = perf_compare.load_result_set(candidate, pattern,
+                                        key_columns.split())
+    if not base or not cand:
+        raise error.TestError("No results found, baseline: %s rows, "
+                              "candidate: %s rows" % (len(base), len(cand)))
+
+    error.context("Compare the result sets", logging.info)
+    results = perf_compare.compare_sets(
+        base, cand, warn=float(params.get("warn_threshold", 0.03)),
+        fail=float(params.get("fail_threshold", 0.05)),
+        alpha=float(params.get("significance_level", 0.05)),
+        lower_better_patterns=lower_better.split(), metrics=metrics,
+        higher_better_patterns=higher_better.split())
+    if not results:
+        raise error.TestError("No common rows between the result sets")
+
+    report = perf_compare.format_report(results)
+    logging.info("Compare results:\n%s", report)
+    report_file = open(os.path.join(test.resultsdir, "perf_compare.txt"),
+                       "w")
+    report_file.write(report + "\n")
+    report_file.close()
+    json_file = open(os.path.join(test.resultsdir, "perf_compare.json"), "w")
+    json.dump([{"category": category, "key": key, "metric": metric,
+                "result": ret} for category, key, metric, ret in results],
+              json_file, indent=1)
+    json_file.close()
+
+    failed = [_ for _ in results if _[3]["verdict"] != perf_compare.PASS]
+    verdict = perf_compare.worst_verdict(results)
+    msg = "%s of %s metrics regressed:\n%s" % (
+        len(failed), len(results), perf_compare.format_report(failed))
+    if verdict == perf_compare.FAIL:
+        raise error.TestFail(msg)
+    elif verdict == perf_compare.WARN:
+        raise error.TestWarn(msg)
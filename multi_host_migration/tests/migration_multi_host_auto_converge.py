@@ -1,3 +1,4 @@
+import os
 import logging
 import time
 from autotest.client.shared import error
@@ -6,6 +7,38 @@ from virttest import virt_vm
 from virttest import utils_test
 from virttest import utils_misc
 from virttest.utils_test.qemu import migration
+from provider import cpuflags
+from provider import migration_telemetry
+
+
+def correlate_throttle(reports, samples, baseline):
+    """
+    Align the guest workload throughput with the cpu throttle percentage.
+
+    :param reports: list of (host time, ops/s) reported by the guest load
+    :param samples: list of (host time, throttle percentage) of the
+                    migration, sorted by time
+    :param baseline: ops/s of the load before the migration
+    :return: tuple of (timeline as list of (time, throttle, ops/s), work
+             lost under throttling in ops, work lost in total in ops)
+    """
+    timeline = []
+    lost_throttled = 0.0
+    lost_total = 0.0
+    index = 0
+    throttle = 0
+    for i, (stamp, rate) in enumerate(reports):
+        while index < len(samples) and samples[index][0] <= stamp:
+            throttle = samples[index][1] or 0
+            index += 1
+        timeline.append((stamp, throttle, rate))
+        if i == 0:
+            continue
+        lost = max(0.0, baseline - rate) * (stamp - reports[i - 1][0])
+        lost_total += lost
+        if throttle:
+            lost_throttled += lost
+    return timeline, lost_throttled, lost_total
 
 
 @error.context_aware
@@ -36,6 +69,11 @@ def run(test, params, env):
           the output for (1) default auto-converge setting (off) and (2)
           auto-converge on, the guest performance should not be effected
           obviously with auto-converge on.
+       d. throttle_timeline: run a guest load reporting its throughput
+          (cpuflags-test --dirtymem) and migrate with auto-converge for
+          every cpu-throttle-increment value, align the throttle percentage
+          with the guest throughput and report the work lost to throttling
+          and the time to convergence.
 
     :param test: kvm test object.
     :param params: Dictionary with test parameters.
@@ -85,6 +123,12 @@ def run(test, params, env):
             if self.sub_type == "before_migrate_load_host_io":
                 self.before_migration = self.before_migration_load_host
                 self.post_migration = self.post_migration_capability_load_host_io
+            if self.sub_type == "throttle_timeline":
+                self.before_migration = self.before_migration_timeline
+                self.post_migration = self.post_migration_timeline
+            self.throttle_increment = None
+            self.load_reports = []
+            self.reading_load = False
 
         def set_auto_converge(self):
             """
@@ -439,6 +483,143 @@ def run(test, params, env):
                 vm.destroy(gracefully=False)
                 mig_thread.join()
 
+        @error.context_aware
+        def start_timeline_load(self):
+            """
+            start the guest load reporting its throughput and measure its
+            baseline before migration
+            """
+
+            vm = self.env.get_vm(self.params["main_vm"])
+            cpuflags.install_cpuflags_util_on_vm(test, vm, install_path,
+                                                 extra_flags="-msse3 -msse2")
+            self.session = vm.wait_for_login(timeout=self.login_timeout)
+            cmd = cpuflags.stressmem_cmd(install_path, params, 0,
+                                         int(params.get("mem", 512)) / 2)
+            error.context("Start guest load: %s" % cmd, logging.info)
+            self.session.sendline(cmd)
+            self.reading_load = True
+            self.load_thread = utils.InterruptedThread(self.read_load_rate)
+            self.load_thread.start()
+            time.sleep(float(params.get("baseline_time", 10)))
+
+        def read_load_rate(self):
+            """
+            function, called by utils.InterruptedThread(), timestamps the
+            throughput reports of the guest load with the host time
+            """
+
+            pending = ""
+            while self.reading_load:
+                try:
+                    pending += self.session.read_nonblocking(0.1, 0.5)
+                except Exception:
+                    time.sleep(0.5)
+                    continue
+                stamp = time.time()
+                lines, _, pending = pending.rpartition("\n")
+                for _, rate, _ in cpuflags.parse_dirty_rate(lines):
+                    self.load_reports.append((stamp, rate))
+
+        def before_migration_timeline(self, mig_data):
+            """
+            enable auto-converge and set cpu-throttle-initial and the
+            cpu-throttle-increment of this run before migration
+
+            :param mig_data: Data for migration
+            """
+
+            if self.is_src:
+                if self.need_set_speed:
+                    self.set_migration_speed(self.max_speed)
+                self.set_migration_capability(True, "auto-converge")
+                self.parameters_value = [self.parameters_value[0],
+                                         str(self.throttle_increment)]
+                self.set_migration_parameter()
+                self.get_migration_parameter()
+
+        @error.context_aware
+        def post_migration_timeline(
+                self, vm, cancel_delay, mig_offline, dsthost,
+                vm_ports, not_wait_for_migration, fd, mig_data):
+            """
+            sample the throttle percentage during migration and align it
+            with the guest throughput
+
+            :param vm: vm object
+            :param cancel_delay: If provided, specifies a time duration
+                   after which migration will be canceled.  Used for
+                   testing migrate_cancel.
+            :param mig_offline: If True, pause the source VM before migration
+            :param dsthost: Destination host
+            :param vm_ports: vm migration ports
+            :param not_wait_for_migration: If True migration start but not
+                   wait till the end of migration.
+            :param fd: File descriptor for migration
+            :param mig_data: Data for migration
+            """
+
+            mig_start = time.time()
+            try:
+                telemetry = migration_telemetry.collect(
+                    vm, self.migration_timeout,
+                    float(params.get("mig_telemetry_interval", "0.5")))
+                try:
+                    vm.wait_for_migration(self.migration_timeout)
+                except virt_vm.VMMigrateTimeoutError:
+                    raise error.TestFail("Migration failed with auto-converge"
+                                         " and cpu-throttle-increment %s"
+                                         % self.throttle_increment)
+                total_time = migration_telemetry.parse_migrate_info(
+                    vm.monitor.info("migrate")).get("total_time", 0) / 1000.0
+                # let the guest report after the switch over too
+                time.sleep(float(params.get("baseline_time", 10)) / 2)
+            finally:
+                self.reading_load = False
+                self.load_thread.join()
+                if self.session:
+                    self.session.close()
+                vm.destroy(gracefully=False)
+
+            baseline = [_[1] for _ in self.load_reports if _[0] < mig_start]
+            if not baseline:
+                raise error.TestError("The guest load did not report its "
+                                      "throughput before migration")
+            baseline = sum(baseline) / len(baseline)
+            samples = [(telemetry.start_time + _["time"], _.get("throttle"))
+                       for _ in telemetry.samples]
+            reports = [_ for _ in self.load_reports if _[0] >= mig_start]
+            timeline, lost_throttled, lost_total = correlate_throttle(
+                reports, samples, baseline)
+            throttled = [_[0] for _ in samples if _[1]]
+            throttle_time = 0
+            if throttled:
+                throttle_time = throttled[-1] - throttled[0]
+            max_throttle = max([_[1] or 0 for _ in samples] or [0])
+
+            timeline_file = open(os.path.join(
+                test.debugdir, "throttle_timeline_%s" %
+                self.throttle_increment), "w")
+            timeline_file.write("# time[s] throttle[%] ops/s\n")
+            for stamp, throttle, rate in timeline:
+                timeline_file.write("%.3f %s %.0f\n" %
+                                    (stamp - mig_start, throttle, rate))
+            timeline_file.close()
+            result = {"increment": self.throttle_increment,
+                      "initial": self.parameters_value[0],
+                      "total_time": total_time,
+                      "throttle_time": throttle_time,
+                      "max_throttle": max_throttle,
+                      "baseline": baseline,
+                      "lost_throttled": lost_throttled,
+                      "lost_total": lost_total,
+                      "lost_pct": (100.0 * lost_total /
+                                   (baseline * total_time)
+                                   if baseline and total_time else 0)}
+            logging.info("Throttle increment %s: %s", self.throttle_increment,
+                         result)
+            timeline_results.append(result)
+
         @error.context_aware
         def migration_scenario(self):
 
@@ -451,7 +632,9 @@ def run(test, params, env):
                 enable/disable stress in guest on src host
                 """
 
-                if self.need_stress:
+                if self.sub_type == "throttle_timeline":
+                    self.start_timeline_load()
+                elif self.need_stress:
                     self.start_stress(sar_cmd_in_guest)
                 else:
                     logging.info("No need to start stress test")
@@ -468,6 +651,9 @@ def run(test, params, env):
                         if not utils_test.qemu.guest_active(vm):
                             raise error.TestFail("Guest not active "
                                                  "after migration")
+                    if self.sub_type == "throttle_timeline":
+                        vm.destroy(gracefully=False)
+                        return
                     if self.need_cleanup:
                         self.clean_up(self.kill_bg_stress_cmd, vm)
                     else:
@@ -479,6 +665,41 @@ def run(test, params, env):
             self.migrate_wait([self.vm], self.srchost, self.dsthost,
                               start_worker, check_worker)
 
+    def report_timeline():
+        """
+        log the timeline results of all cpu-throttle-increment values and
+        write them to throttle_timeline.RHS
+        """
+
+        columns = ("increment", "initial", "total_time", "throttle_time",
+                   "max_throttle", "baseline", "lost_throttled", "lost_total",
+                   "lost_pct")
+        lines = ["Category:throttle_timeline", "|".join(columns)]
+        for result in timeline_results:
+            lines.append("|".join(str(result[_]) for _ in columns))
+        logging.info("Auto-converge throttle timeline:\n%s",
+                     "\n".join(lines))
+        result_file = open(os.path.join(test.resultsdir,
+                                        "throttle_timeline.RHS"), "w")
+        result_file.write("\n".join(lines) + "\n")
+        result_file.close()
+
+    install_path = params.get("cpuflags_install_path", "/tmp")
+    timeline_results = []
+    if params.get("sub_type") == "throttle_timeline":
+        set_auto_converge = "yes"
+        throttle_increments = params.objects("throttle_increments")
+        if not throttle_increments:
+            raise error.TestError("throttle_increments is empty, nothing to "
+                                  "run")
+        for increment in throttle_increments:
+            mig = TestMultihostMigration(test, params, env)
+            mig.throttle_increment = int(increment)
+            mig.run()
+        if mig.is_src:
+            report_timeline()
+        return
+
     set_auto_converge_list = params.objects("need_set_auto_converge")
     sar_log_name = params.get("sar_log_name", "")
     sar_cmd_in_guest = params.get("sar_cmd_in_guest", "")
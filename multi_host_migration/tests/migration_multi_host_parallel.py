@@ -0,0 +1,217 @@
+import os
+import logging
+import time
+import threading
+from autotest.client.shared import error
+from autotest.client.shared import utils
+from virttest import virt_vm
+from virttest.utils_test.qemu import migration
+from provider import migration_telemetry
+
+
+def split_waves(vms, concurrency):
+    """
+    Split the vms into waves of at most concurrency vms.
+
+    :param vms: list of vm names
+    :param concurrency: max number of concurrent migrations, 0 for all
+    """
+    if concurrency <= 0:
+        concurrency = len(vms)
+    return [vms[i:i + concurrency] for i in range(0, len(vms), concurrency)]
+
+
+def bandwidth_per_migration(concurrency, total_bandwidth=None,
+                            vm_bandwidth=None):
+    """
+    Get the max bandwidth of one migration in MB/s.
+
+    :param concurrency: number of concurrent migrations
+    :param total_bandwidth: bandwidth shared by the concurrent migrations
+    :param vm_bandwidth: fixed bandwidth of every migration, it takes
+                         precedence over total_bandwidth
+    :return: MB/s, None for no limit
+    """
+    if vm_bandwidth:
+        return vm_bandwidth
+    if total_bandwidth:
+        return total_bandwidth / max(1, concurrency)
+    return None
+
+
+@error.context_aware
+def run(test, params, env):
+    """
+    KVM multi-host parallel migration test:
+
+    Migration execution progress is described in documentation
+    for migrate method in class MultihostMigration.
+
+    The test procedure:
+    1) split the vms into waves of at most mig_concurrency vms.
+    2) for every wave start its vms on the source host, give every
+       migration its share of the bandwidth and migrate the wave, the vms
+       of a wave migrate at the same time.
+    3) collect the migration telemetry of every vm on the source host.
+    4) report per vm and aggregate throughput, downtime and total time and
+       the time needed to evacuate the host.
+
+    :param test: kvm test object.
+    :param params: Dictionary with test parameters.
+    :param env: Dictionary with the test environment.
+    """
+    mig_protocol = params.get("mig_protocol", "tcp")
+    mig_type = migration.MultihostMigration
+    if mig_protocol == "fd":
+        mig_type = migration.MultihostMigrationFd
+    if mig_protocol == "exec":
+        mig_type = migration.MultihostMigrationExec
+    if "rdma" in mig_protocol:
+        mig_type = migration.MultihostMigrationRdma
+
+    concurrency = int(params.get("mig_concurrency", 0))
+    total_bandwidth = params.get("mig_total_bandwidth")
+    vm_bandwidth = params.get("mig_vm_bandwidth")
+    if total_bandwidth:
+        total_bandwidth = utils.convert_data_size(total_bandwidth,
+                                                  "M") / 1048576
+    if vm_bandwidth:
+        vm_bandwidth = utils.convert_data_size(vm_bandwidth, "M") / 1048576
+    link_bandwidth = params.get("mig_link_bandwidth")
+    if link_bandwidth:
+        link_bandwidth = utils.convert_data_size(link_bandwidth,
+                                                 "M") / 1048576
+    telemetry_interval = float(params.get("mig_telemetry_interval", "0.5"))
+
+    class TestMultihostMigration(mig_type):
+
+        def __init__(self, test, params, env):
+            super(TestMultihostMigration, self).__init__(test, params, env)
+            self.srchost = self.params.get("hosts")[0]
+            self.dsthost = self.params.get("hosts")[1]
+            self.is_src = params["hostid"] == self.srchost
+            self.vms = params["vms"].split()
+            self.mig_timeout = int(params.get("mig_timeout", 480))
+            self.results = {}
+            self.lock = threading.Lock()
+            self.wave_start = None
+
+        def before_migration(self, mig_data):
+            """
+            Set the bandwidth of every migration of the wave.
+
+            :param mig_data: Data for migration
+            """
+            if not self.is_src:
+                return
+            bandwidth = bandwidth_per_migration(len(mig_data.vms),
+                                                total_bandwidth,
+                                                vm_bandwidth)
+            if (bandwidth and link_bandwidth and
+                    bandwidth * len(mig_data.vms) > link_bandwidth):
+                logging.warn("%d migrations at %d MB/s oversubscribe the "
+                             "%d MB/s migration link", len(mig_data.vms),
+                             bandwidth, link_bandwidth)
+            for vm in mig_data.vms:
+                if bandwidth:
+                    vm.monitor.migrate_set_speed("%dM" % bandwidth)
+            logging.info("Migrating %s at %s MB/s each",
+                         " ".join(vm.name for vm in mig_data.vms),
+                         bandwidth or "unlimited")
+            self.wave_start = time.time()
+
+        @error.context_aware
+        def post_migration(self, vm, cancel_delay, mig_offline, dsthost,
+                           vm_ports, not_wait_for_migration, fd, mig_data):
+            """
+            Collect the telemetry of one migration until it ends, then
+            remove the source vm.
+
+            :param vm: vm object
+            :param cancel_delay: If provided, specifies a time duration
+                   after which migration will be canceled.  Used for
+                   testing migrate_cancel.
+            :param mig_offline: If True, pause the source VM before migration
+            :param dsthost: Destination host
+            :param vm_ports: vm migration ports
+            :param not_wait_for_migration: If True migration start but not
+                   wait till the end of migration.
+            :param fd: File descriptor for migration
+            :param mig_data: Data for migration
+            """
+            migration_telemetry.collect(
+                vm, self.mig_timeout, telemetry_interval,
+                series_file=os.path.join(test.debugdir,
+                                         "migration_telemetry_%s" % vm.name))
+            try:
+                vm.wait_for_migration(self.mig_timeout)
+            except virt_vm.VMMigrateTimeoutError:
+                raise error.TestFail("Migration of %s did not finish in "
+                                     "%ss" % (vm.name, self.mig_timeout))
+            end = time.time()
+            result = migration_telemetry.parse_migrate_info(
+                vm.monitor.info("migrate"))
+            total_time = result.get("total_time", 0) / 1000.0
+            if total_time:
+                result["mbps"] = (result.get("transferred", 0) / 1048576.0 /
+                                  total_time)
+            result["end"] = end
+            logging.info("Migration of %s finished: %s", vm.name, result)
+            self.lock.acquire()
+            self.results[vm.name] = result
+            self.lock.release()
+            vm.destroy(gracefully=False)
+
+        def report(self, wave_times, wall_time):
+            """
+            Log the per vm and aggregate results and write them to
+            parallel_migration.RHS.
+
+            :param wave_times: migration time of every wave
+            :param wall_time: time of the whole scenario including vm starts
+            """
+            columns = ("vm", "total_time", "downtime", "transferred",
+                       "mbps")
+            lines = ["### concurrency : %s" % (concurrency or len(self.vms)),
+                     "### evacuation_time : %.3f" % sum(wave_times),
+                     "### wall_time : %.3f" % wall_time,
+                     "Category:parallel_migration", "|".join(columns)]
+            transferred = 0
+            for name in self.vms:
+                result = dict(self.results.get(name, {}), vm=name)
+                transferred += result.get("transferred", 0)
+                lines.append("|".join(str(result.get(_, 0))
+                                      for _ in columns))
+            evacuation_time = sum(wave_times)
+            aggregate = 0
+            if evacuation_time:
+                aggregate = transferred / 1048576.0 / evacuation_time
+            lines.insert(3, "### aggregate_mbps : %.2f" % aggregate)
+            logging.info("Parallel migration of %d vms, %d at a time: host "
+                         "evacuated in %.1fs (%.1fs with vm starts), "
+                         "aggregate %.1f MB/s\n%s", len(self.vms),
+                         concurrency or len(self.vms), evacuation_time,
+                         wall_time, aggregate, "\n".join(lines))
+            result_file = open(os.path.join(test.resultsdir,
+                                            "parallel_migration.RHS"), "w")
+            result_file.write("\n".join(lines) + "\n")
+            result_file.close()
+
+        def migration_scenario(self):
+            error.context("Migrate %d vms from %s to %s, %s at a time" %
+                          (len(self.vms), self.srchost, self.dsthost,
+                           concurrency or "all"), logging.info)
+            wave_times = []
+            start = time.time()
+            for wave in split_waves(self.vms, concurrency):
+                self.migrate_wait(wave, self.srchost, self.dsthost)
+                if self.is_src:
+                    ends = [self.results[_]["end"] for _ in wave
+                            if _ in self.results]
+                    if ends:
+                        wave_times.append(max(ends) - self.wave_start)
+            if self.is_src:
+                self.report(wave_times, time.time() - start)
+
+    mig = TestMultihostMigration(test, params, env)
+    mig.run()
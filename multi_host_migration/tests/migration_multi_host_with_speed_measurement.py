@@ -1,5 +1,4 @@
 import os
-import re
 import logging
 import time
 import socket
@@ -9,6 +8,7 @@ from autotest.client.shared.syncdata import SyncData
 from virttest import utils_misc
 from virttest.utils_test.qemu import migration
 from provider import cpuflags
+from provider import migration_telemetry
 
 
 def run(test, params, env):
@@ -20,7 +20,7 @@ def run(test, params, env):
     3) Start memory load in vm.
     4) Set defined migration speed.
     5) Send a migration command to the source VM and collecting statistic
-            of migration speed.
+            of migration speed from sub-second migration telemetry.
     !) Checks that migration utilisation didn't slow down in guest stresser
        which would lead to less page-changes than required for this test.
        (migration speed is set too high for current CPU)
@@ -44,45 +44,49 @@ def run(test, params, env):
 
     vm_mem = int(params.get("mem", "512"))
 
-    get_mig_speed = re.compile("^transferred ram: (\d+) kbytes$",
-                               re.MULTILINE)
-
     mig_speed = params.get("mig_speed", "1G")
     mig_speed_accuracy = float(params.get("mig_speed_accuracy", "0.2"))
 
-    def get_migration_statistic(vm):
-        last_transfer_mem = 0
-        transfered_mem = 0
-        mig_stat = utils.Statistic()
-        for _ in range(30):
-            o = vm.monitor.info("migrate")
-            warning_msg = ("Migration already ended. Migration speed is"
-                           " probably too high and will block vm while"
-                           " filling its memory.")
-            fail_msg = ("Could not determine the transferred memory from"
-                        " monitor data: %s" % o)
-            if isinstance(o, str):
-                if "status: active" not in o:
-                    raise error.TestWarn(warning_msg)
-                try:
-                    transfered_mem = int(get_mig_speed.search(o).groups()[0])
-                except (IndexError, ValueError):
-                    raise error.TestFail(fail_msg)
-            else:
-                if o.get("status") != "active":
-                    raise error.TestWarn(warning_msg)
-                try:
-                    transfered_mem = o.get("ram").get("transferred") / (1024)
-                except (IndexError, ValueError):
-                    raise error.TestFail(fail_msg)
-
-            real_mig_speed = (transfered_mem - last_transfer_mem) / 1024
+    mig_stat_time = float(params.get("mig_stat_time", "30"))
+    telemetry_interval = float(params.get("mig_telemetry_interval", "0.2"))
+    telemetry_events = params.get("mig_telemetry_events", "no") == "yes"
+
+    def log_dirty_rate(session):
+        """
+        Log the guest dirty rate achieved by the rate controlled load.
+        """
+        if not params.get("stressmem_dirty_rate"):
+            return
+        rates = cpuflags.parse_dirty_rate(session.read_nonblocking(0.1, 1))
+        if not rates:
+            logging.warn("The guest load did not report its dirty rate")
+            return
+        achieved = sum(_[1] for _ in rates) / len(rates)
+        logging.info("Guest dirty rate: target %d pages/s, achieved %d "
+                     "pages/s (mean of %d reports)", rates[-1][2], achieved,
+                     len(rates))
 
-            last_transfer_mem = transfered_mem
+    def get_migration_statistic(vm):
+        telemetry = migration_telemetry.collect(
+            vm, mig_stat_time, telemetry_interval, telemetry_events,
+            os.path.join(test.debugdir, "migration_telemetry"))
+        if not [_ for _ in telemetry.samples if "transferred" in _]:
+            raise error.TestFail("Could not determine the transferred memory"
+                                 " from monitor data: %s"
+                                 % telemetry.samples[-1:])
+        speeds = telemetry.throughput()
+        if telemetry.finished():
+            if len(speeds) < 2:
+                raise error.TestWarn("Migration already ended. Migration "
+                                     "speed is probably too high and will "
+                                     "block vm while filling its memory.")
+            logging.warn("Migration ended after %.1fs, the statistic covers "
+                         "only that time", telemetry.samples[-1]["time"])
 
+        mig_stat = utils.Statistic()
+        for _, real_mig_speed in speeds:
             logging.debug("Migration speed: %s MB/s" % (real_mig_speed))
             mig_stat.record(real_mig_speed)
-            time.sleep(1)
 
         return mig_stat
 
@@ -97,6 +101,7 @@ def run(test, params, env):
                        'dst': self.dsthost,
                        "type": "speed_measurement"}
             self.link_speed = 0
+            self.stress_session = None
 
         def check_vms(self, mig_data):
             """
@@ -115,10 +120,15 @@ def run(test, params, env):
             For change way how machine migrates is necessary
             re implement this method.
             """
+            if telemetry_events:
+                for vm in mig_data.vms:
+                    migration_telemetry.enable_events(vm)
             super_cls = super(TestMultihostMigration, self)
             super_cls.migrate_vms_src(mig_data)
             vm = mig_data.vms[0]
             self.mig_stat = get_migration_statistic(vm)
+            if self.stress_session:
+                log_dirty_rate(self.stress_session)
 
         def migration_scenario(self):
             sync = SyncData(self.master_id(), self.hostid, self.hosts,
@@ -134,11 +144,11 @@ def run(test, params, env):
                 cpuflags.install_cpuflags_util_on_vm(test, vm, install_path,
                                                      extra_flags="-msse3 -msse2")
 
-                cmd = ("%s/cpuflags-test --stressmem %d,%d" %
-                       (os.path.join(install_path, "cpu_flags"),
-                        vm_mem * 4, vm_mem / 2))
+                cmd = cpuflags.stressmem_cmd(install_path, params,
+                                             vm_mem * 4, vm_mem / 2)
                 logging.debug("Sending command: %s" % (cmd))
                 session.sendline(cmd)
+                self.stress_session = session
 
             if self.master_id() == self.hostid:
                 server_port = utils_misc.find_free_port(5200, 6000)
@@ -1,8 +1,34 @@
+import os
 import logging
+import time
 from autotest.client.shared import error
+from autotest.client.shared import utils
 from virttest import utils_test
 from virttest import virt_vm
 from virttest.utils_test.qemu import migration
+from provider import cpuflags
+from provider import migration_telemetry
+
+
+def find_knee(sizes, values, threshold=0.05):
+    """
+    Find the knee of a cost curve over increasing cache sizes: the smallest
+    size after which the next size improves the cost by less than threshold.
+
+    :param sizes: increasing cache sizes
+    :param values: cost for every size (total time, transferred ram...),
+                   lower is better
+    :param threshold: relative improvement considered negligible
+    :return: the knee cache size, None for no sizes
+    """
+    for i in range(len(sizes) - 1):
+        if values[i] <= 0:
+            return sizes[i]
+        if float(values[i] - values[i + 1]) / values[i] < threshold:
+            return sizes[i]
+    if sizes:
+        return sizes[-1]
+    return None
 
 
 @error.context_aware
@@ -25,6 +51,10 @@ def run(test, params, env):
     4) With xbzrle enabled, the total time, downtime and transferred ram
        should less than disabled
     5) Check live migration statistics for xbzrle specific options
+    cache_size_sweep: migrate the same rate controlled dirty workload
+    (cpuflags-test --dirtymem) with every xbzrle cache size and compression
+    thread count, collect the total time, downtime, transferred ram and
+    xbzrle cache stats and report the knee cache size of every thread count
 
     :param test: kvm test object.
     :param params: Dictionary with test parameters.
@@ -76,6 +106,10 @@ def run(test, params, env):
                     self.before_migration_capability_with_xbzrle_on
                 self.post_migration = \
                     self.post_migration_set_cache_size
+            if self.sub_type == "cache_size_sweep":
+                self.before_migration = self.before_migration_sweep
+                self.post_migration = self.post_migration_sweep
+            self.sweep_point = None
 
         def set_xbzrle(self):
             """
@@ -298,6 +332,99 @@ def run(test, params, env):
             self.get_migration_info(vm)
             vm.destroy(gracefully=False)
 
+        def before_migration_sweep(self, mig_data):
+            """
+            enable xbzrle, set the cache size, compression threads and speed
+            of the sweep point before migration
+
+            :param mig_data: Data for migration
+            """
+
+            compress_threads = self.sweep_point[0]
+            if compress_threads:
+                for vm in mig_data.vms:
+                    vm.monitor.set_migrate_capability(True, "compress")
+                    if vm.monitor.protocol == "qmp":
+                        vm.monitor.cmd("migrate-set-parameters",
+                                       {"compress-threads": compress_threads,
+                                        "decompress-threads":
+                                        compress_threads})
+                    else:
+                        vm.monitor.cmd("migrate_set_parameter "
+                                       "compress-threads %d"
+                                       % compress_threads)
+                        vm.monitor.cmd("migrate_set_parameter "
+                                       "decompress-threads %d"
+                                       % compress_threads)
+            if self.is_src:
+                self.set_migration_capability(True, "xbzrle")
+                self.set_migration_cache_size(
+                    sweep_key(self.sweep_point)[1])
+                if self.need_set_speed:
+                    self.set_migration_speed(self.max_speed)
+
+        @error.context_aware
+        def post_migration_sweep(self, vm, cancel_delay, mig_offline,
+                                 dsthost, vm_ports, not_wait_for_migration,
+                                 fd, mig_data):
+            """
+            collect the migration telemetry until the migration ends and
+            record the result of the sweep point
+
+            :param vm: vm object
+            :param cancel_delay: If provided, specifies a time duration
+                   after which migration will be canceled.  Used for
+                   testing migrate_cancel.
+            :param mig_offline: If True, pause the source VM before migration
+            :param dsthost: Destination host
+            :param vm_ports: vm migration ports
+            :param not_wait_for_migration: If True migration start but not
+                   wait till the end of migration.
+            :param fd: File descriptor for migration
+            :param mig_data: Data for migration
+            """
+
+            compress_threads, cache_size = self.sweep_point
+            series_file = os.path.join(test.debugdir,
+                                       "xbzrle_sweep_%d_%d" % sweep_key(
+                                           self.sweep_point))
+            try:
+                migration_telemetry.collect(
+                    vm, self.mig_timeout,
+                    float(params.get("mig_telemetry_interval", "0.5")),
+                    series_file=series_file)
+                try:
+                    vm.wait_for_migration(self.mig_timeout)
+                except virt_vm.VMMigrateTimeoutError:
+                    raise error.TestFail("Migration failed with cache size "
+                                         "%s and %d compression threads."
+                                         % (cache_size, compress_threads))
+                result = migration_telemetry.parse_migrate_info(
+                    vm.monitor.info("migrate"))
+                result["threads"] = compress_threads
+                result["cache_size"] = sweep_key(self.sweep_point)[1]
+                logging.info("Migration with cache size %s and %d "
+                             "compression threads: %s", cache_size,
+                             compress_threads, result)
+                sweep_results.append(result)
+            finally:
+                vm.destroy(gracefully=False)
+
+        def start_sweep_load(self):
+            """
+            start the rate controlled dirty workload of the sweep
+            """
+
+            vm = self.env.get_vm(self.params["main_vm"])
+            session = vm.wait_for_login(timeout=self.login_timeout)
+            cpuflags.install_cpuflags_util_on_vm(test, vm, install_path,
+                                                 extra_flags="-msse3 -msse2")
+            cmd = cpuflags.stressmem_cmd(install_path, params, vm_mem * 4,
+                                         vm_mem / 2)
+            logging.debug("Sending command: %s" % cmd)
+            session.sendline(cmd)
+            time.sleep(float(params.get("sleep_before_migration", 5)))
+
         @error.context_aware
         def migration_scenario(self):
 
@@ -310,7 +437,9 @@ def run(test, params, env):
                 enable/disable stress in guest on src host
                 """
 
-                if self.need_stress:
+                if self.sub_type == "cache_size_sweep":
+                    self.start_sweep_load()
+                elif self.need_stress:
                     self.start_stress()
                 else:
                     logging.info("No need to start stress test")
@@ -327,6 +456,9 @@ def run(test, params, env):
                         if not utils_test.qemu.guest_active(vm):
                             raise error.TestFail("Guest not active "
                                                  "after migration")
+                    if self.sub_type == "cache_size_sweep":
+                        vm.destroy(gracefully=False)
+                        return
                     if self.need_cleanup:
                         self.clean_up(self.kill_bg_stress_cmd, vm)
                     else:
@@ -338,6 +470,59 @@ def run(test, params, env):
             self.migrate_wait([self.vm], self.srchost, self.dsthost,
                               start_worker, check_worker)
 
+    def sweep_key(sweep_point):
+        return (sweep_point[0], utils.convert_data_size(sweep_point[1], "M"))
+
+    def report_sweep():
+        """
+        log the sweep results with the knee cache size of every compression
+        thread count and write them to xbzrle_sweep.RHS
+        """
+
+        columns = ("threads", "cache_size", "total_time", "downtime",
+                   "transferred", "xbzrle_pages", "xbzrle_bytes",
+                   "xbzrle_cache_miss", "xbzrle_cache_miss_rate",
+                   "xbzrle_overflow")
+        lines = ["Category:xbzrle_sweep", "|".join(columns)]
+        for result in sweep_results:
+            lines.append("|".join(str(result.get(_, 0)) for _ in columns))
+        threshold = float(params.get("xbzrle_knee_threshold", "0.05"))
+        metric = params.get("xbzrle_knee_metric", "total_time")
+        for threads in sorted(set(_["threads"] for _ in sweep_results)):
+            points = sorted((_["cache_size"], _.get(metric, 0))
+                            for _ in sweep_results if _["threads"] == threads)
+            knee = find_knee([_[0] for _ in points], [_[1] for _ in points],
+                             threshold)
+            logging.info("xbzrle %s knee with %d compression threads: cache "
+                         "size %dM", metric, threads, knee / 1048576)
+            lines.append("### knee_threads_%d : %dM" % (threads,
+                                                        knee / 1048576))
+        logging.info("xbzrle cache size sweep:\n%s", "\n".join(lines))
+        result_file = open(os.path.join(test.resultsdir, "xbzrle_sweep.RHS"),
+                           "w")
+        result_file.write("\n".join(lines) + "\n")
+        result_file.close()
+
+    install_path = params.get("cpuflags_install_path", "/tmp")
+    vm_mem = int(params.get("mem", "512"))
+    sweep_results = []
+    if params.get("sub_type") == "cache_size_sweep":
+        set_cache_size = "yes"
+        need_stress = "yes"
+        sweep_threads = params.objects("xbzrle_sweep_compress_threads") or [0]
+        sweep_cache_sizes = params.objects("xbzrle_sweep_cache_sizes")
+        if not sweep_cache_sizes:
+            raise error.TestError("xbzrle_sweep_cache_sizes is empty, "
+                                  "nothing to sweep")
+        for threads in sweep_threads:
+            for cache_size in sweep_cache_sizes:
+                mig = TestMultihostMigration(test, params, env)
+                mig.sweep_point = (int(threads), cache_size)
+                mig.run()
+        if mig.is_src:
+            report_sweep()
+        return
+
     set_cache_size_list = params.objects("set_cache_size")
     need_stress_list = params.objects("need_stress")
     mig_total_time_list = []
@@ -0,0 +1,87 @@
+"""
+Repeat a performance measurement until its result is stable.
+
+Instead of running every cell of a test matrix once for a fixed time, a
+cell is repeated until the coefficient of variation (stdev / mean) of its
+main metric falls below a target, or a maximum number of runs is hit.
+Quiet hosts stop after the minimum number of runs, busy hosts get more
+samples.
+"""
+import math
+import logging
+
+
+def coefficient_of_variation(values):
+    """
+    Get the sample coefficient of variation of a list of numbers.
+
+    :return: stdev / mean, None for less than two values or a zero mean
+    """
+    if len(values) < 2:
+        return None
+    avg = float(sum(values)) / len(values)
+    if avg == 0:
+        return None
+    var = sum((_ - avg) ** 2 for _ in values) / (len(values) - 1)
+    return math.sqrt(var) / abs(avg)
+
+
+def merge_results(results):
+    """
+    Merge the result dicts of several runs of the same measurement.
+
+    Numbers are averaged over the runs that reported them, the other
+    values are taken from the last run.
+    """
+    merged = {}
+    for key in results[-1]:
+        values = [_[key] for _ in results if key in _]
+        numbers = [_ for _ in values if isinstance(_, (int, long, float)) and
+                   not isinstance(_, bool)]
+        if numbers and len(numbers) == len(values):
+            avg = float(sum(numbers)) / len(numbers)
+            if all(isinstance(_, (int, long)) for _ in numbers):
+                avg = int(round(avg))
+            merged[key] = avg
+        else:
+            merged[key] = results[-1][key]
+    return merged
+
+
+def run_until_stable(run_once, key, cv_target=0.05, min_runs=3, max_runs=10):
+    """
+    Repeat a measurement until the chosen metric is stable.
+
+    :param run_once: function running the measurement once and returning
+                     a dict of results
+    :param key: the result key whose variation decides the stability
+    :param cv_target: stop once the coefficient of variation of the key is
+                      at or below this value
+    :param min_runs: runs done before checking the variation
+    :param max_runs: stop after this many runs even if not stable
+    :return: tuple of (merged results as by merge_results(), dict with
+             the number of samples, the cv, min and max of the key and
+             whether the target was met)
+    """
+    results = []
+    values = []
+    cv = None
+    min_runs = max(1, min(min_runs, max_runs))
+    while len(results) < max_runs:
+        ret = run_once()
+        results.append(ret)
+        values.append(float(ret[key]))
+        if len(results) < min_runs:
+            continue
+        cv = coefficient_of_variation(values)
+        logging.debug("Run %s of %s: %s = %s, cv = %s", len(results),
+                      max_runs, key, values[-1], cv)
+        if cv is not None and cv <= cv_target:
+            break
+    stable = cv is not None and cv <= cv_target
+    if not stable:
+        logging.warn("%s did not get stable after %s runs, cv = %s",
+                     key, len(results), cv)
+    spread = {"samples": len(results), "cv": cv, "min": min(values),
+              "max": max(values), "stable": stable}
+    return merge_results(results), spread
@@ -29,3 +29,75 @@ def install_cpuflags_util_on_vm(test, vm, dst_dir, extra_flags=None):
                 (cpuflags_dst, extra_flags))
     session.cmd("sync")
     session.close()
+
+
+def stressmem_cmd(install_path, params, fill_mb, max_mb):
+    """
+    Get the cpuflags-test guest memory load command.
+
+    By default it is --stressmem, filling fill_mb of max_mb every second.
+    With stressmem_dirty_rate set (pages/s) it is the rate controlled
+    --dirtymem load, configured by stressmem_total (MB, max_mb by default),
+    stressmem_wss (working set MB, all by default), stressmem_entropy (% of
+    each page changed, 100 by default) and stressmem_report (guest file the
+    achieved rate is appended to).
+
+    :param install_path: cpuflags-test install path in the guest
+    :param params: Dictionary with the test parameters
+    """
+    binary = os.path.join(install_path, "cpu_flags", "cpuflags-test")
+    rate = params.get("stressmem_dirty_rate")
+    if not rate:
+        return "%s --stressmem %d,%d" % (binary, fill_mb, max_mb)
+    total = int(params.get("stressmem_total", max_mb))
+    cmd = "%s --dirtymem %d,%d,%d,%d" % (
+        binary, total, int(params.get("stressmem_wss", total)), int(rate),
+        int(params.get("stressmem_entropy", 100)))
+    if params.get("stressmem_report"):
+        cmd += ",%s" % params["stressmem_report"]
+    return cmd
+
+
+def parse_dirty_rate(output):
+    """
+    Get the dirty rates reported by cpuflags-test --dirtymem.
+
+    :param output: output of the load or content of its report file
+    :return: list of (time, achieved pages/s, target pages/s)
+    """
+    rates = []
+    for line in output.splitlines():
+        fields = line.replace("dirtymem:", "").split()
+        if len(fields) != 4:
+            continue
+        try:
+            rates.append((float(fields[0]), float(fields[2]),
+                          float(fields[3])))
+        except ValueError:
+            continue
+    return rates
+
+
+def parse_bench(output):
+    """
+    Get the results of cpuflags-test --bench.
+
+    :param output: output of cpuflags-test --bench
+    :return: dict of test name -> dict with the test runs "ops", the runs/s
+             "rate", the failed runs "failures", "sigill" (the test died
+             on an illegal instruction) and the "cpu" it ran on
+    """
+    results = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) != 7 or fields[0] != "bench:":
+            continue
+        try:
+            results[fields[1]] = {"ops": int(fields[2]),
+                                  "rate": float(fields[3]),
+                                  "failures": int(fields[4]),
+                                  "sigill": fields[5] == "1",
+                                  "cpu": int(fields[6])}
+        except ValueError:
+            continue
+    return results
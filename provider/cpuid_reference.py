@@ -0,0 +1,179 @@
+"""
+Compiled index of the cpuid reference dumps.
+
+All the reference dumps of a cpuid_dumps directory (one sub directory per
+machine type, one <model[,flags]>-dump.txt file per CPU model) are parsed
+once and pickled in a cache file named after the state (names, sizes and
+mtimes) of the tree, so later tests only unpickle it. A loaded index is
+also kept in memory for the rest of the process.
+"""
+import os
+import re
+import cPickle as pickle
+import hashlib
+import logging
+
+
+_DUMP_LINE = re.compile(
+    r"^ *(0x[0-9a-f]+) +0x([0-9a-f]+): +eax=0x([0-9a-f]+) "
+    r"ebx=0x([0-9a-f]+) ecx=0x([0-9a-f]+) edx=0x([0-9a-f]+)$")
+_REGS = ("eax", "ebx", "ecx", "edx")
+_DUMP_SUFFIX = "-dump.txt"
+
+_indexes = {}
+
+
+def parse_dump(output):
+    """
+    Parse the output of the cpuid test kernel.
+
+    :return: dict of (in_eax, in_ecx, register) -> value, None if the
+             output is not a complete dump
+    """
+    start = output.find("==START TEST==")
+    end = output.find("==END TEST==", start)
+    if start < 0 or end < 0:
+        return None
+    lines = output[start:end].splitlines()
+    if len(lines) < 2 or lines[1] != "CPU:":
+        return None
+    result = {}
+    for line in lines[2:]:
+        match = _DUMP_LINE.match(line)
+        if match is None:
+            logging.debug("invalid cpuid dump line: %r", line)
+            return None
+        in_eax = int(match.group(1), 16)
+        in_ecx = int(match.group(2), 16)
+        for reg, value in zip(_REGS, match.groups()[2:]):
+            result[in_eax, in_ecx, reg] = int(value, 16)
+    return result
+
+
+def diff(reference, out):
+    """
+    Compare two dumps with one XOR per register, the bits are only
+    looked at for the registers that differ.
+
+    :param reference: reference dump, its keys are compared
+    :param out: dump to check
+    :return: list of (in_eax, in_ecx, register, bit, reference bit, out
+             bit or None if out misses the register)
+    """
+    ret = []
+    for key, ref_value in reference.iteritems():
+        value = out.get(key)
+        if value is None:
+            ret.extend(key + (bit, (ref_value >> bit) & 1, None)
+                       for bit in xrange(32))
+            continue
+        mask = ref_value ^ value
+        while mask:
+            bit = (mask & -mask).bit_length() - 1
+            ret.append(key + (bit, (ref_value >> bit) & 1,
+                              (value >> bit) & 1))
+            mask &= mask - 1
+    ret.sort()
+    return ret
+
+
+def _tree_state(dumps_dir):
+    digest = hashlib.sha1()
+    for machine_type in sorted(os.listdir(dumps_dir)):
+        machine_dir = os.path.join(dumps_dir, machine_type)
+        if not os.path.isdir(machine_dir):
+            continue
+        for name in sorted(os.listdir(machine_dir)):
+            stat = os.stat(os.path.join(machine_dir, name))
+            digest.update("%s/%s %d %d\n" % (machine_type, name,
+                                             stat.st_size, stat.st_mtime))
+    return digest.hexdigest()
+
+
+class ReferenceIndex(object):
+
+    """
+    Reference dumps by machine type and CPU model.
+    """
+
+    def __init__(self, dumps_dir):
+        """
+        Parse all the reference dumps of dumps_dir.
+        """
+        self.dumps_dir = dumps_dir
+        self.dumps = {}
+        self.invalid = []
+        for machine_type in sorted(os.listdir(dumps_dir)):
+            machine_dir = os.path.join(dumps_dir, machine_type)
+            if not os.path.isdir(machine_dir):
+                continue
+            for name in os.listdir(machine_dir):
+                if not name.endswith(_DUMP_SUFFIX):
+                    continue
+                model = name[:-len(_DUMP_SUFFIX)]
+                dump_file = open(os.path.join(machine_dir, name))
+                try:
+                    dump = parse_dump(dump_file.read())
+                finally:
+                    dump_file.close()
+                if dump:
+                    self.dumps[machine_type, model] = dump
+                else:
+                    self.invalid.append((machine_type, model))
+
+    def get(self, machine_type, model):
+        """
+        :param model: CPU model name with its flags, e.g. "Opteron_G1,-svm"
+        :return: the reference dump, None if there is no valid one
+        """
+        return self.dumps.get((machine_type, model))
+
+    def machine_types(self):
+        return sorted(set(_[0] for _ in self.dumps))
+
+    def select(self, machine_types=None, models=None):
+        """
+        :param machine_types: machine types to select, all if None
+        :param models: CPU model names (without flags), all if None
+        :return: sorted list of the (machine type, model) keys selected
+        """
+        return sorted(key for key in self.dumps
+                      if (machine_types is None or
+                          key[0] in machine_types) and
+                      (models is None or key[1].split(",")[0] in models))
+
+
+def load_index(dumps_dir, cache_dir):
+    """
+    Get the index of dumps_dir, from memory, from the cache file or by
+    parsing the reference dumps.
+    """
+    state = _tree_state(dumps_dir)
+    index = _indexes.get(dumps_dir)
+    if index is not None and index[0] == state:
+        return index[1]
+    cache_file = os.path.join(cache_dir, "cpuid_reference_%s.pickle" % state)
+    reference = None
+    if os.path.exists(cache_file):
+        try:
+            index_file = open(cache_file, "rb")
+            try:
+                reference = pickle.load(index_file)
+            finally:
+                index_file.close()
+        except Exception, details:
+            logging.warn("Ignoring the invalid cpuid reference index %s: %s",
+                         cache_file, details)
+    if reference is None:
+        reference = ReferenceIndex(dumps_dir)
+        tmp_file = "%s.%d" % (cache_file, os.getpid())
+        index_file = open(tmp_file, "wb")
+        try:
+            pickle.dump(reference, index_file, pickle.HIGHEST_PROTOCOL)
+        finally:
+            index_file.close()
+        os.rename(tmp_file, cache_file)
+        logging.debug("cpuid reference index of %d dumps written to %s",
+                      len(reference.dumps), cache_file)
+    _indexes[dumps_dir] = (state, reference)
+    return reference
@@ -0,0 +1,213 @@
+"""
+Fast CPUID dumps with the cpuid test kernel.
+
+The test kernel is built once per source revision and cached by the hash
+of its sources. Every dump is a short-lived qemu process, without the VM
+object machinery, printing to its stdout serial port. The output is
+parsed incrementally as it arrives and qemu is killed as soon as the dump
+end marker is seen, so many dumps can run in parallel on the host cpus.
+"""
+import os
+import time
+import fcntl
+import select
+import shutil
+import signal
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+
+from autotest.client.shared import utils
+
+
+KERNEL_NAME = "cpuid_dump_kernel.bin"
+START_MARK = "==START TEST=="
+END_MARK = "==END TEST=="
+
+_build_lock = threading.Lock()
+
+
+def source_hash(src_dir):
+    """
+    Hash the sources of the test kernel.
+    """
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(src_dir)):
+        if os.path.splitext(name)[1] not in (".c", ".h", ".S", ".lds") \
+                and name != "Makefile":
+            continue
+        digest.update(name)
+        digest.update(open(os.path.join(src_dir, name), "rb").read())
+    return digest.hexdigest()
+
+
+def build_dump_kernel(src_dir, cache_dir):
+    """
+    Get the test kernel, built in a scratch copy of src_dir only if no
+    kernel of the same sources is cached in cache_dir.
+
+    :return: path of the test kernel
+    """
+    kernel = os.path.join(cache_dir,
+                          "%s-%s" % (KERNEL_NAME, source_hash(src_dir)))
+    _build_lock.acquire()
+    try:
+        if os.path.exists(kernel):
+            logging.debug("Using the cached cpuid test kernel %s", kernel)
+            return kernel
+        build_dir = tempfile.mkdtemp(prefix="cpuid_kernel_", dir=cache_dir)
+        try:
+            build_src = os.path.join(build_dir, "src")
+            shutil.copytree(src_dir, build_src)
+            utils.run("make -C %s clean %s" % (build_src, KERNEL_NAME))
+            # rename() makes the kernel appear complete to other users
+            shutil.copy(os.path.join(build_src, KERNEL_NAME),
+                        os.path.join(build_dir, KERNEL_NAME))
+            os.rename(os.path.join(build_dir, KERNEL_NAME), kernel)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        logging.info("Built the cpuid test kernel %s", kernel)
+        return kernel
+    finally:
+        _build_lock.release()
+
+
+class DumpParser(object):
+
+    """
+    Collect the cpuid dump from serial output fed in arbitrary chunks.
+    """
+
+    def __init__(self):
+        self._partial = ""
+        self._lines = None
+        self.done = False
+
+    def feed(self, data):
+        """
+        Feed new serial output.
+
+        :return: True once the end marker was seen
+        """
+        if self.done:
+            return True
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            line = line.rstrip("\r")
+            if line == START_MARK:
+                self._lines = [line]
+            elif self._lines is not None:
+                self._lines.append(line)
+                if line == END_MARK:
+                    self.done = True
+                    break
+        return self.done
+
+    def output(self):
+        """
+        :return: the dump text between (and including) the markers, None
+                 if the dump is not complete
+        """
+        if not self.done:
+            return None
+        return "\n".join(self._lines)
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def dump_cpuid(qemu_binary, kernel, machine_type, cpu_model, kvm=True,
+               extra_args="", timeout=60):
+    """
+    Boot the test kernel in a short-lived qemu and read its cpuid dump.
+
+    :param cpu_model: -cpu option value, model and flags
+    :return: tuple (dump text or None, qemu stderr output, exit status or
+             None if qemu was killed)
+    """
+    accel = kvm and "kvm" or "tcg"
+    cmd = [qemu_binary, "-machine", "%s,accel=%s" % (machine_type, accel),
+           "-cpu", cpu_model, "-kernel", kernel, "-smp", "1", "-m", "128",
+           "-nodefaults", "-display", "none", "-serial", "stdio",
+           "-no-reboot"] + extra_args.split()
+    devnull = open(os.devnull)
+    try:
+        process = subprocess.Popen(cmd, stdin=devnull,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=True)
+    finally:
+        devnull.close()
+    parser = DumpParser()
+    errors = []
+    fds = [process.stdout.fileno(), process.stderr.fileno()]
+    for fd in fds:
+        _set_nonblocking(fd)
+    end_time = time.time() + timeout
+    try:
+        while fds and not parser.done:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                logging.debug("%s: no cpuid dump in %ss", " ".join(cmd),
+                              timeout)
+                break
+            for fd in select.select(fds, [], [], remaining)[0]:
+                data = os.read(fd, 65536)
+                if not data:
+                    fds.remove(fd)
+                elif fd == process.stdout.fileno():
+                    parser.feed(data)
+                else:
+                    errors.append(data)
+    finally:
+        status = process.poll()
+        if status is None:
+            os.kill(process.pid, signal.SIGKILL)
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+    return parser.output(), "".join(errors), status
+
+
+def run_sweep(jobs, parallel=None):
+    """
+    Run dump_cpuid() for every job on parallel worker threads.
+
+    :param jobs: dict of job name -> dump_cpuid() kwargs
+    :param parallel: number of concurrent qemu, all host cpus if None
+    :return: dict of job name -> dump_cpuid() result
+    """
+    if not parallel:
+        parallel = os.sysconf("SC_NPROCESSORS_ONLN")
+    pending = sorted(jobs)
+    results = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                name = pending.pop(0)
+            finally:
+                lock.release()
+            try:
+                result = dump_cpuid(**jobs[name])
+            except Exception, details:
+                result = (None, str(details), None)
+            lock.acquire()
+            results[name] = result
+            lock.release()
+
+    threads = [threading.Thread(target=worker, name="cpuid_sweep_%d" % i)
+               for i in xrange(min(parallel, len(jobs)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,129 @@
+"""
+Run host monitor commands (mpstat, vmstat, sar, perf stat...) in the
+background of a test.
+
+Every monitor runs in its own process group, so it is stopped together
+with all of its children by one signal. Its output is streamed to a file
+by a reader thread and only a bounded tail of it is kept in memory.
+"""
+import os
+import time
+import signal
+import logging
+import threading
+import subprocess
+import collections
+
+
+class Monitor(object):
+
+    """
+    One monitor command running in its own process group.
+    """
+
+    def __init__(self, name, cmd, output_file, tail_lines=1000,
+                 stop_signal=signal.SIGTERM):
+        """
+        :param name: monitor name
+        :param cmd: shell command of the monitor
+        :param output_file: file the monitor output is streamed to
+        :param tail_lines: number of the last output lines kept in memory
+        :param stop_signal: first signal sent to stop the monitor, e.g.
+                            SIGINT for perf stat to print its counters
+        """
+        self.name = name
+        self.stop_signal = stop_signal
+        self.cmd = cmd
+        self.output_file = output_file
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.process = subprocess.Popen(cmd, shell=True,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        close_fds=True,
+                                        preexec_fn=os.setsid)
+        self._reader = threading.Thread(target=self._read_output,
+                                        name="monitor_%s" % name)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_output(self):
+        output = open(self.output_file, "w")
+        try:
+            for line in iter(self.process.stdout.readline, ""):
+                output.write(line)
+                output.flush()
+                self.tail.append(line)
+        finally:
+            output.close()
+            self.process.stdout.close()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def stop(self, timeout=5):
+        """
+        Stop the monitor process group, stop_signal first, then SIGKILL if
+        it is still alive after timeout seconds.
+
+        :return: exit status of the monitor command
+        """
+        for sig in (self.stop_signal, signal.SIGKILL):
+            if not self.is_alive():
+                break
+            try:
+                os.killpg(self.process.pid, sig)
+            except OSError:
+                break
+            end_time = time.time() + timeout
+            while self.is_alive() and time.time() < end_time:
+                time.sleep(0.05)
+        status = self.process.wait()
+        self._reader.join(timeout)
+        return status
+
+
+class MonitorManager(object):
+
+    """
+    Start, track and stop several monitors running at the same time.
+    """
+
+    def __init__(self, tail_lines=1000):
+        self.tail_lines = tail_lines
+        self.monitors = collections.OrderedDict()
+
+    def start(self, name, cmd, output_file, stop_signal=signal.SIGTERM):
+        """
+        Start a monitor command.
+
+        :param name: unique monitor name
+        :param cmd: shell command of the monitor
+        :param output_file: file the monitor output is streamed to
+        :param stop_signal: first signal sent to stop the monitor
+        """
+        if name in self.monitors and self.monitors[name].is_alive():
+            raise ValueError("Monitor %s is already running" % name)
+        logging.info("Start host monitor %s: %s", name, cmd)
+        monitor = Monitor(name, cmd, output_file, self.tail_lines,
+                          stop_signal)
+        self.monitors[name] = monitor
+        return monitor
+
+    def stop(self, name, timeout=5):
+        """
+        Stop one monitor.
+
+        :return: exit status of the monitor command
+        """
+        status = self.monitors[name].stop(timeout)
+        logging.debug("Host monitor %s stopped with status %s", name, status)
+        return status
+
+    def stop_all(self, timeout=5):
+        """
+        Stop all the monitors.
+
+        :return: dict of monitor name -> exit status
+        """
+        return dict((name, self.stop(name, timeout))
+                    for name in self.monitors)
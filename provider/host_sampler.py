@@ -0,0 +1,324 @@
+"""
+In-process host sampler shared by the performance tests.
+
+Reads /proc/stat, /proc/interrupts, the per thread stats of given
+processes (e.g. qemu) and the kvm debugfs counters at a fixed interval,
+without forking mpstat/cat for every sample, and keeps them in a
+preallocated ring buffer. Workloads then ask for the samples inside
+their own time window.
+"""
+import os
+import re
+import time
+import logging
+import threading
+
+
+KVM_DEBUGFS = "/sys/kernel/debug/kvm"
+
+
+def percentile(values, pct):
+    """
+    Get the percentile of a list of numbers, nearest rank method.
+
+    :param values: list of numbers
+    :param pct: percentile between 0 and 100
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def summary(values):
+    """
+    Get min/median/p95/max/mean of a list of numbers.
+    """
+    if not values:
+        return {}
+    return {"min": min(values),
+            "median": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": max(values),
+            "mean": float(sum(values)) / len(values)}
+
+
+def read_cpu_stat():
+    """
+    Read the aggregated cpu line of /proc/stat.
+
+    :return: tuple of (busy, iowait, total) jiffies, busy counts neither
+             idle nor iowait time
+    """
+    stat_file = open("/proc/stat")
+    cpu_line = stat_file.readline()
+    stat_file.close()
+    # cpu user nice system idle iowait irq softirq steal (guest time is
+    # already included in user and nice)
+    values = [int(_) for _ in cpu_line.split()[1:9]]
+    total = sum(values)
+    return total - values[3] - values[4], values[4], total
+
+
+def read_interrupts(names):
+    """
+    Sum the /proc/interrupts counts of the lines matching each pattern.
+
+    :param names: list of regex patterns, like "virtio.-input"
+    :return: dict of pattern -> count summed over all cpus and lines
+    """
+    counts = dict((name, 0) for name in names)
+    irq_file = open("/proc/interrupts")
+    ncpu = len(irq_file.readline().split())
+    for line in irq_file:
+        for name in names:
+            if re.search(name, line):
+                for value in line.split()[1:ncpu + 1]:
+                    if value.isdigit():
+                        counts[name] += int(value)
+    irq_file.close()
+    return counts
+
+
+def read_process_cpu(pid):
+    """
+    Sum utime and stime of all threads of a process.
+
+    :param pid: process id
+    :return: jiffies, 0 if the process is gone
+    """
+    total = 0
+    task_dir = "/proc/%s/task" % pid
+    try:
+        tids = os.listdir(task_dir)
+    except OSError:
+        return 0
+    for tid in tids:
+        try:
+            stat_file = open(os.path.join(task_dir, tid, "stat"))
+            stat = stat_file.read()
+            stat_file.close()
+        except IOError:
+            continue
+        # comm may hold spaces, the fields after it are fixed
+        fields = stat[stat.rindex(")") + 2:].split()
+        total += int(fields[11]) + int(fields[12])
+    return total
+
+
+def read_int_file(path):
+    """
+    Read a file holding one integer, like a sysfs counter, None if missing.
+    """
+    try:
+        int_file = open(path)
+        value = int(int_file.read())
+        int_file.close()
+    except (IOError, ValueError):
+        return None
+    return value
+
+
+def read_kvm_stat(name):
+    """
+    Read one counter of the kvm debugfs directory, None if not present.
+    """
+    return read_int_file(os.path.join(KVM_DEBUGFS, name))
+
+
+def find_pids(comm):
+    """
+    Get the pids of the processes named comm, like the ksmd kernel thread.
+    """
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            comm_file = open("/proc/%s/comm" % pid)
+            name = comm_file.read().strip()
+            comm_file.close()
+        except IOError:
+            continue
+        if name == comm:
+            pids.append(int(pid))
+    return pids
+
+
+class HostSampler(threading.Thread):
+
+    """
+    Background thread sampling the host counters at a fixed interval.
+
+    Every sample is a tuple (timestamp, cpu busy, cpu iowait, cpu total,
+    counters), counters being a dict with "kvm:<name>", "irq:<pattern>",
+    "pid:<pid>" and "file:<name>" keys. Once the ring buffer is full the
+    oldest samples are overwritten.
+    """
+
+    def __init__(self, interval=1.0, size=3600, kvm_stats=("exits",),
+                 irq_names=(), pids=(), files=None):
+        """
+        :param interval: seconds between two samples
+        :param size: number of samples kept in the ring buffer
+        :param kvm_stats: kvm debugfs counters to sample
+        :param irq_names: /proc/interrupts line patterns to sample
+        :param pids: processes whose cpu time is sampled, e.g. qemu
+        :param files: dict of name -> path of files holding one integer to
+                      sample, e.g. the /sys/kernel/mm/ksm counters
+        """
+        threading.Thread.__init__(self, name="host_sampler")
+        self.daemon = True
+        self.interval = float(interval)
+        self.size = int(size)
+        self.kvm_stats = list(kvm_stats)
+        self.irq_names = list(irq_names)
+        self.pids = list(pids)
+        self.files = dict(files or {})
+        self._ring = [None] * self.size
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.clk_tck = os.sysconf(os.sysconf_names["SC_CLK_TCK"])
+
+    def sample(self):
+        """
+        Take one sample and store it in the ring buffer.
+        """
+        busy, iowait, total = read_cpu_stat()
+        counters = {}
+        for name in self.kvm_stats:
+            value = read_kvm_stat(name)
+            if value is not None:
+                counters["kvm:%s" % name] = value
+        if self.irq_names:
+            for name, value in read_interrupts(self.irq_names).items():
+                counters["irq:%s" % name] = value
+        for pid in self.pids:
+            counters["pid:%s" % pid] = read_process_cpu(pid)
+        for name, path in self.files.items():
+            value = read_int_file(path)
+            if value is not None:
+                counters["file:%s" % name] = value
+        with self._lock:
+            self._ring[self._next] = (time.time(), busy, iowait, total,
+                                      counters)
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            start = time.time()
+            try:
+                self.sample()
+            except Exception, details:
+                logging.warn("Host sampling failed: %s", details)
+            self._stop_event.wait(max(0, self.interval -
+                                      (time.time() - start)))
+
+    def stop(self):
+        """
+        Stop sampling and wait for the thread to exit.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def samples(self, start=None, end=None):
+        """
+        Get the samples taken inside a time window, in time order.
+
+        :param start: window start timestamp, None for no limit
+        :param end: window end timestamp, None for no limit
+        """
+        with self._lock:
+            first = (self._next - self._count) % self.size
+            ordered = [self._ring[(first + i) % self.size]
+                       for i in range(self._count)]
+        return [_ for _ in ordered
+                if (start is None or _[0] >= start) and
+                (end is None or _[0] <= end)]
+
+    def _pairs(self, start, end):
+        window = self.samples(start, end)
+        if len(window) < 2:
+            raise ValueError("Not enough host samples between %s and %s" %
+                             (start, end))
+        return window, zip(window[:-1], window[1:])
+
+    def cpu_usage(self, start=None, end=None, count_iowait=False):
+        """
+        Get the average host cpu usage in % over a time window.
+
+        :param count_iowait: count iowait as busy time, mpstat's
+                             "100 - %idle" does
+        """
+        window = self._pairs(start, end)[0]
+        first, last = window[0], window[-1]
+        busy = last[1] - first[1]
+        if count_iowait:
+            busy += last[2] - first[2]
+        return 100.0 * busy / max(last[3] - first[3], 1)
+
+    def cpu_series(self, start=None, end=None, count_iowait=False):
+        """
+        Get the host cpu usage of every sample interval in a time window.
+
+        :return: list of (timestamp, cpu usage in %)
+        """
+        series = []
+        for prev, cur in self._pairs(start, end)[1]:
+            busy = cur[1] - prev[1]
+            if count_iowait:
+                busy += cur[2] - prev[2]
+            series.append((cur[0], 100.0 * busy / max(cur[3] - prev[3], 1)))
+        return series
+
+    def counter_delta(self, name, start=None, end=None):
+        """
+        Get how much a counter increased over a time window.
+
+        :param name: counter key, like "kvm:exits" or "irq:virtio.-input"
+        """
+        window = self._pairs(start, end)[0]
+        return window[-1][4].get(name, 0) - window[0][4].get(name, 0)
+
+    def counter_series(self, name, start=None, end=None):
+        """
+        Get the per second rate of a counter for every sample interval.
+
+        For "pid:" counters the rate is the cpu usage of the process in %.
+
+        :return: list of (timestamp, rate)
+        """
+        series = []
+        for prev, cur in self._pairs(start, end)[1]:
+            rate = ((cur[4].get(name, 0) - prev[4].get(name, 0)) /
+                    max(cur[0] - prev[0], 1e-6))
+            if name.startswith("pid:"):
+                rate = rate * 100.0 / self.clk_tck
+            series.append((cur[0], rate))
+        return series
+
+    def report(self, start=None, end=None, count_iowait=False):
+        """
+        Summary of all the sampled values over a time window.
+
+        :return: dict with "cpu" and one entry per counter, each holding
+                 the min/median/p95/max/mean of the per interval values
+                 and the time series
+        """
+        cpu = self.cpu_series(start, end, count_iowait)
+        ret = {"cpu": {"summary": summary([_[1] for _ in cpu]),
+                       "series": cpu}}
+        names = set()
+        for sample in self.samples(start, end):
+            names.update(sample[4].keys())
+        for name in sorted(names):
+            series = self.counter_series(name, start, end)
+            ret[name] = {"summary": summary([_[1] for _ in series]),
+                         "series": series,
+                         "delta": self.counter_delta(name, start, end)}
+        return ret
@@ -0,0 +1,302 @@
+"""
+Sub-second migration progress telemetry.
+
+A background thread polls query-migrate (or "info migrate" on a human
+monitor) of the source VM at a configurable interval, optionally also
+collecting the MIGRATION/MIGRATION_PASS QMP events, and keeps the
+samples as a time series: transferred and remaining RAM, dirty page rate,
+throughput, dirty sync count (pass number), cpu throttle percentage and
+xbzrle cache stats. The series gives the convergence curve of the
+migration (remaining RAM per pass) used to tune downtime and bandwidth.
+"""
+import re
+import time
+import logging
+import threading
+
+
+FIELDS = ("status", "total_time", "transferred", "remaining", "total",
+          "dirty_pages_rate", "mbps", "dirty_sync_count", "throttle",
+          "expected_downtime", "downtime", "xbzrle_cache_size",
+          "xbzrle_bytes", "xbzrle_pages", "xbzrle_cache_miss",
+          "xbzrle_cache_miss_rate", "xbzrle_overflow")
+
+_QMP_KEYS = {"total-time": "total_time",
+             "expected-downtime": "expected_downtime",
+             "downtime": "downtime",
+             "cpu-throttle-percentage": "throttle",
+             "x-cpu-throttle-percentage": "throttle"}
+_QMP_RAM_KEYS = {"transferred": "transferred",
+                 "remaining": "remaining",
+                 "total": "total",
+                 "dirty-pages-rate": "dirty_pages_rate",
+                 "mbps": "mbps",
+                 "dirty-sync-count": "dirty_sync_count"}
+_QMP_XBZRLE_KEYS = {"cache-size": "xbzrle_cache_size",
+                    "bytes": "xbzrle_bytes",
+                    "pages": "xbzrle_pages",
+                    "cache-miss": "xbzrle_cache_miss",
+                    "cache-miss-rate": "xbzrle_cache_miss_rate",
+                    "overflow": "xbzrle_overflow"}
+_HMP_KEYS = {"migration status": "status",
+             "total time": "total_time",
+             "expected downtime": "expected_downtime",
+             "downtime": "downtime",
+             "transferred ram": "transferred",
+             "remaining ram": "remaining",
+             "total ram": "total",
+             "dirty pages rate": "dirty_pages_rate",
+             "throughput": "mbps",
+             "dirty sync count": "dirty_sync_count",
+             "cpu throttle percentage": "throttle",
+             "cache size": "xbzrle_cache_size",
+             "xbzrle transferred": "xbzrle_bytes",
+             "xbzrle pages": "xbzrle_pages",
+             "xbzrle cache miss": "xbzrle_cache_miss",
+             "xbzrle cache miss rate": "xbzrle_cache_miss_rate",
+             "xbzrle overflow": "xbzrle_overflow"}
+_HMP_LINE = re.compile(r"^[ \t]*([^:\n]+?)[ \t]*:[ \t]*(\S+)[ \t]*(\w*)",
+                       re.MULTILINE)
+_UNITS = {"kbytes": 1024, "mbytes": 1024 * 1024}
+
+
+def parse_migrate_info(info):
+    """
+    Flatten the output of query-migrate / "info migrate".
+
+    :param info: dict returned by a QMP monitor or str of a human monitor
+    :return: dict with the keys of FIELDS that were reported, sizes in
+             bytes, times in milliseconds
+    """
+    ret = {}
+    if isinstance(info, dict):
+        for key, name in _QMP_KEYS.items():
+            if key in info:
+                ret[name] = info[key]
+        for key, name in _QMP_RAM_KEYS.items():
+            if key in info.get("ram", {}):
+                ret[name] = info["ram"][key]
+        for key, name in _QMP_XBZRLE_KEYS.items():
+            if key in info.get("xbzrle-cache", {}):
+                ret[name] = info["xbzrle-cache"][key]
+        if "status" in info:
+            ret["status"] = info["status"]
+        return ret
+    for key, value, unit in _HMP_LINE.findall(info):
+        name = _HMP_KEYS.get(key.lower())
+        if name is None:
+            continue
+        if name == "status":
+            ret[name] = value
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        value *= _UNITS.get(unit, 1)
+        if value == int(value):
+            value = int(value)
+        ret[name] = value
+    return ret
+
+
+class MigrationTelemetry(threading.Thread):
+
+    """
+    Collect the migration progress of a VM in the background.
+    """
+
+    def __init__(self, vm, interval=0.2, events=False):
+        """
+        :param vm: source VM object
+        :param interval: query-migrate poll interval in seconds
+        :param events: also collect MIGRATION/MIGRATION_PASS QMP events
+        """
+        threading.Thread.__init__(self, name="migration_telemetry")
+        self.daemon = True
+        self.vm = vm
+        self.interval = interval
+        self.events = events and hasattr(vm.monitor, "get_events")
+        self.samples = []
+        self.event_log = []
+        self._seen_events = set()
+        self._stop_event = threading.Event()
+        self.start_time = None
+
+    def sample(self):
+        """
+        Take one sample of the migration progress.
+
+        :return: the sample dict, with the "time" offset in seconds
+        """
+        now = time.time()
+        if self.start_time is None:
+            self.start_time = now
+        sample = parse_migrate_info(self.vm.monitor.info("migrate"))
+        sample["time"] = now - self.start_time
+        self.samples.append(sample)
+        if self.events:
+            self._read_events()
+        return sample
+
+    def _read_events(self):
+        for event in self.vm.monitor.get_events():
+            if event.get("event") not in ("MIGRATION", "MIGRATION_PASS"):
+                continue
+            stamp = event.get("timestamp", {})
+            key = (event["event"], stamp.get("seconds"),
+                   stamp.get("microseconds"))
+            if key in self._seen_events:
+                continue
+            self._seen_events.add(key)
+            self.event_log.append(
+                {"time": (stamp.get("seconds", 0) +
+                          stamp.get("microseconds", 0) / 1e6 -
+                          self.start_time),
+                 "event": event["event"],
+                 "data": event.get("data", {})})
+
+    def run(self):
+        next_time = time.time()
+        while not self._stop_event.is_set():
+            try:
+                sample = self.sample()
+            except Exception, details:
+                logging.debug("Migration telemetry stopped: %s", details)
+                break
+            if sample.get("status") not in (None, "setup", "active",
+                                            "pre-switchover", "device",
+                                            "postcopy-active"):
+                break
+            next_time += self.interval
+            self._stop_event.wait(max(0, next_time - time.time()))
+
+    def stop(self, timeout=10):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def wait(self, duration):
+        """
+        Wait until the migration leaves the active state or for duration
+        seconds.
+        """
+        self.join(duration)
+
+    def finished(self):
+        """
+        Check whether the migration left the active state while sampled.
+        """
+        return bool(self.samples) and self.samples[-1].get("status") in (
+            "completed", "failed", "cancelled")
+
+    def throughput(self):
+        """
+        Get the migration throughput of every sampled interval, computed
+        from the transferred RAM.
+
+        :return: list of (time, MB/s)
+        """
+        ret = []
+        active = [_ for _ in self.samples if "transferred" in _]
+        for prev, cur in zip(active, active[1:]):
+            delta_t = cur["time"] - prev["time"]
+            if delta_t <= 0:
+                continue
+            ret.append((cur["time"], (cur["transferred"] -
+                                      prev["transferred"]) /
+                        delta_t / (1024 * 1024)))
+        return ret
+
+    def convergence(self):
+        """
+        Get the convergence curve of the migration, one point per pass
+        over the guest RAM (dirty sync count) with the RAM remaining at its
+        start.
+
+        :return: list of dicts with the pass, time, remaining and
+                 transferred bytes, dirty page rate and throttle
+        """
+        curve = []
+        last_pass = None
+        for sample in self.samples:
+            pass_no = sample.get("dirty_sync_count")
+            if pass_no is None or pass_no == last_pass:
+                continue
+            last_pass = pass_no
+            curve.append({"pass": pass_no,
+                          "time": sample["time"],
+                          "remaining": sample.get("remaining"),
+                          "transferred": sample.get("transferred"),
+                          "dirty_pages_rate": sample.get("dirty_pages_rate"),
+                          "throttle": sample.get("throttle", 0)})
+        return curve
+
+    def write_series(self, path):
+        """
+        Write the samples as a whitespace separated table, the QMP events
+        as comment lines.
+        """
+        series_file = open(path, "w")
+        series_file.write("# time %s\n" % " ".join(FIELDS))
+        for sample in self.samples:
+            series_file.write("%.3f %s\n" % (
+                sample["time"], " ".join(str(sample.get(_, "-"))
+                                         for _ in FIELDS)))
+        for event in self.event_log:
+            series_file.write("# event %.3f %s %s\n" % (
+                event["time"], event["event"], event["data"]))
+        series_file.close()
+
+    def report(self):
+        """
+        Log the convergence curve of the migration.
+        """
+        lines = ["%5s %9s %14s %14s %16s %8s" % ("pass", "time[s]",
+                                                 "remaining[MB]",
+                                                 "transferred[MB]",
+                                                 "dirty[pages/s]",
+                                                 "throttle")]
+        for point in self.convergence():
+            lines.append("%5s %9.3f %14.1f %14.1f %16s %8s" % (
+                point["pass"], point["time"],
+                (point["remaining"] or 0) / 1048576.0,
+                (point["transferred"] or 0) / 1048576.0,
+                point["dirty_pages_rate"], point["throttle"]))
+        logging.info("Migration convergence:\n%s", "\n".join(lines))
+
+
+def enable_events(vm):
+    """
+    Turn on the MIGRATION/MIGRATION_PASS events of a VM, this has to be
+    done before the migration starts.
+
+    :return: True if the events were enabled
+    """
+    try:
+        vm.monitor.set_migrate_capability(True, "events")
+    except Exception, details:
+        logging.warn("Unable to enable the migration events: %s", details)
+        return False
+    return True
+
+
+def collect(vm, duration, interval=0.2, events=False, series_file=None):
+    """
+    Collect the telemetry of a running migration for duration seconds or
+    until it leaves the active state, then log its convergence curve.
+
+    :param vm: source VM object, the migration has to be started already
+    :param events: also collect the QMP events, see enable_events()
+    :param series_file: write the time series to this file if set
+    :return: MigrationTelemetry object
+    """
+    telemetry = MigrationTelemetry(vm, interval, events)
+    telemetry.start()
+    telemetry.wait(duration)
+    telemetry.stop()
+    telemetry.report()
+    if series_file:
+        telemetry.write_series(series_file)
+        logging.debug("Migration telemetry written to %s", series_file)
+    return telemetry
@@ -0,0 +1,192 @@
+"""
+Multi-threaded streaming gzip compression.
+
+The input is cut into fixed size blocks and every block is compressed as
+an independent gzip member by a pool of threads (zlib releases the GIL
+while compressing), the members are written out in input order. A
+concatenation of gzip members is a valid gzip file, as produced by pigz
+and readable by any gzip -d.
+
+The time the reader waits for input and the time it waits for a free
+compressor slot are accounted separately, they tell whether the producer
+(e.g. qemu writing a vmcore into a pipe) or the host compression is the
+bottleneck.
+"""
+import os
+import time
+import zlib
+import Queue
+import struct
+import logging
+import threading
+
+
+# gzip member header: magic, deflate, no flags, no mtime, no xfl, unix
+_GZIP_HEADER = struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, 0, 0, 3)
+
+
+def gzip_member(data, level=1):
+    """
+    Compress data as one complete gzip member.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return "".join((_GZIP_HEADER, compressor.compress(data),
+                    compressor.flush(),
+                    struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                                len(data) & 0xffffffff)))
+
+
+def read_block(input_fd, block_size, read_size):
+    """
+    Read up to block_size bytes, less only at EOF.
+    """
+    chunks = []
+    length = 0
+    while length < block_size:
+        buf = os.read(input_fd, min(read_size, block_size - length))
+        if not buf:
+            break
+        chunks.append(buf)
+        length += len(buf)
+    return "".join(chunks)
+
+
+class _Job(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ParallelGzip(object):
+
+    """
+    Compress a file descriptor into a gzip file with a thread pool.
+    """
+
+    def __init__(self, threads=None, level=1, block_size=4 * 1024 * 1024,
+                 read_size=1024 * 1024):
+        """
+        :param threads: number of compressor threads, all host cpus if None
+        :param level: zlib compression level
+        :param block_size: uncompressed size of one gzip member
+        :param read_size: max size of one read() from the input
+        """
+        if not threads:
+            threads = os.sysconf("SC_NPROCESSORS_ONLN")
+        self.threads = threads
+        self.level = level
+        self.block_size = block_size
+        self.read_size = read_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.elapsed = 0.0
+        self.read_wait = 0.0
+        self.queue_wait = 0.0
+        self.error = None
+
+    def _compress(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            try:
+                job.result = gzip_member(job.data, self.level)
+            except Exception, details:
+                job.error = details
+            job.data = None
+            job.done.set()
+
+    def _write(self, output, pending):
+        # Keeps draining the pending jobs after an error, so the reader
+        # never blocks on a full queue.
+        while True:
+            job = pending.get()
+            if job is None:
+                break
+            job.done.wait()
+            if self.error is None:
+                self.error = job.error
+            if self.error is None:
+                try:
+                    output.write(job.result)
+                    self.bytes_out += len(job.result)
+                except Exception, details:
+                    self.error = details
+            job.result = None
+
+    def compress_fd(self, input_fd, output):
+        """
+        Compress everything read from input_fd until EOF.
+
+        :param input_fd: file descriptor to read, it is not closed
+        :param output: file object the gzip members are written to
+        :raise: the first compression or write error
+        """
+        jobs = Queue.Queue()
+        # Bounds the number of blocks in memory and keeps the output order
+        pending = Queue.Queue(2 * self.threads)
+        workers = [threading.Thread(target=self._compress, args=(jobs,),
+                                    name="gzip_%d" % i)
+                   for i in xrange(self.threads)]
+        writer = threading.Thread(target=self._write, name="gzip_writer",
+                                  args=(output, pending))
+        for thread in workers + [writer]:
+            thread.daemon = True
+            thread.start()
+        self.error = None
+        start = time.time()
+        try:
+            while self.error is None:
+                before = time.time()
+                data = read_block(input_fd, self.block_size, self.read_size)
+                self.read_wait += time.time() - before
+                if not data:
+                    break
+                self.bytes_in += len(data)
+                job = _Job(data)
+                before = time.time()
+                pending.put(job)
+                self.queue_wait += time.time() - before
+                jobs.put(job)
+        finally:
+            for _ in workers:
+                jobs.put(None)
+            for thread in workers:
+                thread.join()
+            pending.put(None)
+            writer.join()
+            self.elapsed = time.time() - start
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """
+        :return: dict with the input and output MB, the input MB/s, the
+                 compression ratio and the seconds the reader spent
+                 waiting for input and for the compressors
+        """
+        ret = {"in_mb": self.bytes_in / 1048576.0,
+               "out_mb": self.bytes_out / 1048576.0,
+               "elapsed": self.elapsed,
+               "mbps": 0.0,
+               "ratio": 0.0,
+               "read_wait": self.read_wait,
+               "compress_wait": self.queue_wait}
+        if self.elapsed:
+            ret["mbps"] = ret["in_mb"] / self.elapsed
+        if self.bytes_out:
+            ret["ratio"] = float(self.bytes_in) / self.bytes_out
+        return ret
+
+    def report(self, name="input"):
+        stats = self.stats()
+        logging.info("Compressed %.1f MB of %s to %.1f MB in %.1fs with %d "
+                     "threads: %.1f MB/s, ratio %.2f, waited %.1fs for input "
+                     "and %.1fs for the compressors", stats["in_mb"], name,
+                     stats["out_mb"], stats["elapsed"], self.threads,
+                     stats["mbps"], stats["ratio"], stats["read_wait"],
+                     stats["compress_wait"])
+        return stats
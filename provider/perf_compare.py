@@ -0,0 +1,330 @@
+"""
+Compare two sets of performance results written as *.RHS files.
+
+The netperf, fio_perf and performance tests write their results as
+"Category:" blocks of '|' separated tables. This module loads a baseline
+and a candidate result set (several files per set, e.g. repeatN runs),
+aligns the rows by category and key columns (size, sessions, bs,
+iodepth...), then computes the relative delta of every metric with a
+Welch t-test confidence interval and gives a pass/warn/fail verdict.
+"""
+import os
+import re
+import math
+import fnmatch
+
+
+PASS = "PASS"
+WARN = "WARN"
+FAIL = "FAIL"
+
+DEFAULT_KEY_COLUMNS = ("size", "sessions", "Block_size", "Iodepth",
+                       "Threads", "thread", "threads")
+# metrics where a higher value means worse performance
+DEFAULT_LOWER_BETTER = ("*lat*", "*Lat*", "*CPU*", "*cpu*", "*exits*",
+                        "*Exits*", "re_pkts", "irq_injs")
+# efficiency ratios like thr_per_CPU or BW/CPU, higher is better even when
+# they match DEFAULT_LOWER_BETTER
+DEFAULT_HIGHER_BETTER = ("*_per_*", "*/*")
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_rhs(path, key_columns=DEFAULT_KEY_COLUMNS):
+    """
+    Parse one *.RHS result file.
+
+    :param path: result file path
+    :param key_columns: column names identifying a row inside a category,
+                        columns not listed here are metrics
+    :return: tuple of (metadata dict from the "### key : value" lines,
+             dict of (category, key) -> {metric: value})
+    """
+    metadata = {}
+    rows = {}
+    category = None
+    header = None
+    row_index = 0
+    result_file = open(path)
+    for line in result_file:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("###"):
+            key, _, value = line.lstrip("#").partition(":")
+            metadata[key.strip()] = value.strip()
+        elif line.startswith("Category:"):
+            category = line[len("Category:"):].strip()
+            header = None
+            row_index = 0
+        elif "|" not in line:
+            # "name: value" lines hold results outside of the tables
+            if category is None or re.match(r"\S+:\s", line):
+                continue
+            # performance.result_sum writes one sub table per test
+            category = "%s/%s" % (category.split("/")[0], line)
+            header = None
+            row_index = 0
+        elif header is None:
+            header = [_.strip() for _ in line.split("|")]
+        else:
+            values = [_.strip() for _ in line.split("|")]
+            key = []
+            metrics = {}
+            for name, value in zip(header, values):
+                if name in key_columns:
+                    key.append("%s=%s" % (name, value))
+                    continue
+                number = _to_number(value)
+                if number is not None:
+                    metrics[name] = number
+            if not key:
+                key = ["row=%d" % row_index]
+            row_index += 1
+            rows[(category, ",".join(key))] = metrics
+    result_file.close()
+    return metadata, rows
+
+
+def find_result_files(paths, pattern="*.RHS"):
+    """
+    Find the result files of a result set.
+
+    :param paths: list of files or directories, directories are walked
+    :param pattern: file name pattern of the result files
+    """
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            for name in fnmatch.filter(names, pattern):
+                files.append(os.path.join(root, name))
+    return sorted(files)
+
+
+def load_result_set(paths, pattern="*.RHS", key_columns=DEFAULT_KEY_COLUMNS):
+    """
+    Load all the result files of a set, one sample per file.
+
+    :return: dict of (category, key) -> {metric: [values]}
+    """
+    samples = {}
+    for path in find_result_files(paths, pattern):
+        for row_key, metrics in parse_rhs(path, key_columns)[1].items():
+            row = samples.setdefault(row_key, {})
+            for metric, value in metrics.items():
+                row.setdefault(metric, []).append(value)
+    return samples
+
+
+def mean(values):
+    return float(sum(values)) / len(values)
+
+
+def variance(values):
+    avg = mean(values)
+    return sum((_ - avg) ** 2 for _ in values) / (len(values) - 1)
+
+
+def _betacf(a, b, x):
+    # continued fraction of the incomplete beta function, from
+    # Numerical Recipes
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c, d = 1.0, 1.0 - qab * x / qap
+    d = 1.0 / (d if abs(d) > 1e-30 else 1e-30)
+    h = d
+    for m in range(1, 201):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > 1e-30 else 1e-30)
+        c = 1.0 + aa / c
+        c = c if abs(c) > 1e-30 else 1e-30
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > 1e-30 else 1e-30)
+        c = 1.0 + aa / c
+        c = c if abs(c) > 1e-30 else 1e-30
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 3e-12:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    """
+    Regularized incomplete beta function I_x(a, b).
+    """
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                     a * math.log(x) + b * math.log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+def t_sf2(t, df):
+    """
+    Two sided p-value of a Student t statistic.
+    """
+    return betainc(df / 2.0, 0.5, df / (df + t * t))
+
+
+def t_ppf2(alpha, df):
+    """
+    Critical value t such that the two sided p-value is alpha.
+    """
+    low, high = 0.0, 1000.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if t_sf2(mid, df) > alpha:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def welch(base, cand, alpha=0.05):
+    """
+    Welch t-test of the difference of two sample means.
+
+    :return: tuple of (p-value, confidence interval of cand - base mean),
+             (None, None) when a sample has less than two values
+    """
+    if len(base) < 2 or len(cand) < 2:
+        return None, None
+    vb = variance(base) / len(base)
+    vc = variance(cand) / len(cand)
+    diff = mean(cand) - mean(base)
+    se = math.sqrt(vb + vc)
+    if se == 0:
+        p_value = 1.0 if diff == 0 else 0.0
+        return p_value, (diff, diff)
+    df = (vb + vc) ** 2 / (vb ** 2 / (len(base) - 1) +
+                           vc ** 2 / (len(cand) - 1))
+    p_value = t_sf2(diff / se, df)
+    margin = t_ppf2(alpha, df) * se
+    return p_value, (diff - margin, diff + margin)
+
+
+def lower_is_better(metric, patterns=DEFAULT_LOWER_BETTER,
+                    higher_patterns=DEFAULT_HIGHER_BETTER):
+    """
+    Tell if a lower value of metric is better, higher_patterns win over
+    patterns.
+    """
+    for pattern in higher_patterns:
+        if fnmatch.fnmatchcase(metric, pattern):
+            return False
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(metric, pattern):
+            return True
+    return False
+
+
+def compare_metric(base, cand, warn=0.03, fail=0.05, alpha=0.05,
+                   lower_better=False):
+    """
+    Compare the samples of one metric.
+
+    A regression larger than the fail threshold fails if it is
+    statistically significant, or if there are too few samples to tell;
+    otherwise regressions larger than the warn threshold warn.
+
+    :param base: baseline values
+    :param cand: candidate values
+    :param warn: relative regression threshold for a warning
+    :param fail: relative regression threshold for a failure
+    :param alpha: significance level of the test
+    :param lower_better: a lower value is an improvement
+    :return: dict with the means, relative delta and its confidence
+             interval, p-value and verdict
+    """
+    base_mean, cand_mean = mean(base), mean(cand)
+    ret = {"base": base_mean, "cand": cand_mean, "base_n": len(base),
+           "cand_n": len(cand), "delta": None, "ci": None,
+           "p_value": None, "verdict": PASS}
+    if base_mean == 0:
+        return ret
+    ret["delta"] = (cand_mean - base_mean) / abs(base_mean)
+    p_value, ci = welch(base, cand, alpha)
+    if ci is not None:
+        ret["p_value"] = p_value
+        ret["ci"] = (ci[0] / abs(base_mean), ci[1] / abs(base_mean))
+    regression = ret["delta"] if lower_better else -ret["delta"]
+    significant = p_value is None or p_value < alpha
+    if regression > fail and significant:
+        ret["verdict"] = FAIL
+    elif regression > warn:
+        ret["verdict"] = WARN
+    return ret
+
+
+def compare_sets(base, cand, warn=0.03, fail=0.05, alpha=0.05,
+                 lower_better_patterns=DEFAULT_LOWER_BETTER, metrics=None,
+                 higher_better_patterns=DEFAULT_HIGHER_BETTER):
+    """
+    Compare two loaded result sets.
+
+    :param base: baseline set, as returned by load_result_set()
+    :param cand: candidate set, as returned by load_result_set()
+    :param metrics: patterns of the metrics to compare, all if None
+    :param higher_better_patterns: patterns of the metrics where higher is
+                                   better, checked before
+                                   lower_better_patterns
+    :return: list of (category, key, metric, compare_metric() result),
+             for the rows and metrics present in both sets
+    """
+    results = []
+    for row_key in sorted(set(base) & set(cand)):
+        for metric in sorted(set(base[row_key]) & set(cand[row_key])):
+            if metrics and not [_ for _ in metrics
+                                if fnmatch.fnmatchcase(metric, _)]:
+                continue
+            ret = compare_metric(base[row_key][metric],
+                                 cand[row_key][metric], warn, fail, alpha,
+                                 lower_is_better(metric,
+                                                 lower_better_patterns,
+                                                 higher_better_patterns))
+            results.append((row_key[0], row_key[1], metric, ret))
+    return results
+
+
+def format_report(results):
+    """
+    Format the compare results as a text table.
+    """
+    lines = ["%-30s|%-30s|%-14s|%12s|%12s|%9s|%20s|%8s|%7s" %
+             ("category", "key", "metric", "base", "cand", "delta%",
+              "ci%", "p", "verdict")]
+    for category, key, metric, ret in results:
+        delta = ci = p_value = "-"
+        if ret["delta"] is not None:
+            delta = "%+.2f" % (ret["delta"] * 100)
+        if ret["ci"] is not None:
+            ci = "[%+.2f,%+.2f]" % (ret["ci"][0] * 100, ret["ci"][1] * 100)
+            p_value = "%.4f" % ret["p_value"]
+        lines.append("%-30s|%-30s|%-14s|%12.2f|%12.2f|%9s|%20s|%8s|%7s" %
+                     (category, key, metric, ret["base"], ret["cand"],
+                      delta, ci, p_value, ret["verdict"]))
+    return "\n".join(lines)
+
+
+def worst_verdict(results):
+    verdicts = set(_[3]["verdict"] for _ in results)
+    for verdict in (FAIL, WARN):
+        if verdict in verdicts:
+            return verdict
+    return PASS
@@ -0,0 +1,77 @@
+"""
+Machine readable result store shared by the performance tests.
+
+The *.RHS files written by the performance tests are meant for humans, this
+module keeps a JSON-lines copy of the same data: one flat JSON object per
+result row, each one carrying the run metadata (qemu, host and guest
+versions), so the file can be appended to by nightly runs and streamed
+by the dashboards without any text scraping.
+"""
+import os
+import json
+import time
+
+
+def load_records(path, category=None):
+    """
+    Read back the rows of a result store file.
+
+    :param path: path of the JSON-lines result file
+    :param category: only return the rows of this category
+    :return: list of dicts, one per row
+    """
+    records = []
+    with open(path) as result_file:
+        for line in result_file:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if category is None or record.get("category") == category:
+                records.append(record)
+    return records
+
+
+class ResultStore(object):
+
+    """
+    Append-only JSON-lines result file.
+    """
+
+    def __init__(self, path, test_name, metadata=None):
+        """
+        :param path: path of the result file, appended to if it exists
+        :param test_name: name of the test writing the rows
+        :param metadata: dict of run wide info stored with every row
+        """
+        self.path = path
+        self.metadata = {"test": test_name,
+                         "run_id": "%s-%d" % (test_name, int(time.time())),
+                         "host": os.uname()[1]}
+        if metadata:
+            self.metadata.update(metadata)
+        self._file = open(path, "a")
+
+    def update_metadata(self, **kwargs):
+        """
+        Add run wide info, used for the rows written afterwards.
+        """
+        self.metadata.update(kwargs)
+
+    def add_row(self, category, row):
+        """
+        Append one result row.
+
+        :param category: the category the row belongs to (e.g. 'randread')
+        :param row: dict with the keys and the measured values of the row
+        """
+        record = dict(self.metadata)
+        record["category"] = category
+        record["timestamp"] = time.time()
+        record.update(row)
+        self._file.write(json.dumps(record, sort_keys=True) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
@@ -0,0 +1,164 @@
+"""
+High resolution throughput sampler.
+
+Reads a byte counter (e.g. the idx of a virtio port send/recv thread) at
+a fixed rate and records (monotonic timestamp, bytes) pairs. The rate of
+every interval is computed from its measured duration, not from the
+nominal one, so late wake ups do not skew the result. Intervals moving
+(almost) no data are reported as stalls.
+"""
+import time
+import logging
+
+from virttest import utils_misc
+
+from provider import host_sampler
+
+
+class ThroughputSampler(object):
+
+    """
+    Sample a byte counter and compute per interval throughput.
+    """
+
+    def __init__(self, counter, interval=0.01, stall_ratio=0.1):
+        """
+        :param counter: function returning the number of bytes moved so far
+        :param interval: sampling interval in seconds
+        :param stall_ratio: intervals slower than this fraction of the
+                            median rate are stalls
+        """
+        self.counter = counter
+        self.interval = interval
+        self.stall_ratio = stall_ratio
+        self.timestamps = []
+        self.counts = []
+
+    def sample(self):
+        self.timestamps.append(utils_misc.monotonic_time())
+        self.counts.append(self.counter())
+
+    def run(self, duration, exit_event=None):
+        """
+        Sample for duration seconds, see run_samplers().
+        """
+        run_samplers([self], duration, exit_event)
+
+    def elapsed(self):
+        if len(self.timestamps) < 2:
+            return 0.0
+        return self.timestamps[-1] - self.timestamps[0]
+
+    def rates(self, scale=1048576.0):
+        """
+        Get the throughput of every interval.
+
+        :param scale: bytes per unit, MB/s by default
+        :return: list of (interval start offset, duration, rate)
+        """
+        ret = []
+        for i in xrange(1, len(self.timestamps)):
+            delta_t = self.timestamps[i] - self.timestamps[i - 1]
+            if delta_t <= 0:
+                continue
+            rate = (self.counts[i] - self.counts[i - 1]) / delta_t / scale
+            ret.append((self.timestamps[i - 1] - self.timestamps[0],
+                        delta_t, rate))
+        return ret
+
+    def stalls(self, rates=None):
+        """
+        Merge consecutive slow intervals into stalls.
+
+        :return: list of (start offset, duration) of the stalls
+        """
+        if rates is None:
+            rates = self.rates()
+        median = host_sampler.percentile([_[2] for _ in rates], 50)
+        if not median:
+            return []
+        limit = median * self.stall_ratio
+        stalls = []
+        current = None
+        for start, delta_t, rate in rates:
+            if rate <= limit:
+                if current is None:
+                    current = [start, 0.0]
+                current[1] += delta_t
+            elif current is not None:
+                stalls.append(tuple(current))
+                current = None
+        if current is not None:
+            stalls.append(tuple(current))
+        return stalls
+
+    def summary(self):
+        """
+        Get the throughput statistics of the sampled period.
+
+        :return: dict with the mean, min, p1, p50, p99 and max MB/s, the
+                 number of intervals, the mean interval jitter and the
+                 stall count, total and longest stall time
+        """
+        rates = self.rates()
+        if not rates:
+            return {}
+        values = [_[2] for _ in rates]
+        stalls = self.stalls(rates)
+        elapsed = self.elapsed()
+        jitter = sum(abs(_[1] - self.interval) for _ in rates) / len(rates)
+        return {"mean": ((self.counts[-1] - self.counts[0]) / elapsed /
+                         1048576.0),
+                "min": min(values),
+                "p1": host_sampler.percentile(values, 1),
+                "p50": host_sampler.percentile(values, 50),
+                "p99": host_sampler.percentile(values, 99),
+                "max": max(values),
+                "intervals": len(rates),
+                "jitter": jitter,
+                "stalls": len(stalls),
+                "stall_time": sum(_[1] for _ in stalls),
+                "max_stall": max([_[1] for _ in stalls] or [0.0])}
+
+    def write_series(self, path):
+        """
+        Write the time series as "offset bytes MB/s" lines.
+        """
+        series_file = open(path, "w")
+        series_file.write("# time[s] bytes MB/s\n")
+        for i in xrange(len(self.timestamps)):
+            rate = 0.0
+            delta_t = self.timestamps[i] - self.timestamps[i - 1]
+            if i and delta_t > 0:
+                rate = ((self.counts[i] - self.counts[i - 1]) / delta_t /
+                        1048576.0)
+            series_file.write("%.6f %d %.3f\n"
+                              % (self.timestamps[i] - self.timestamps[0],
+                                 self.counts[i], rate))
+        series_file.close()
+        logging.debug("Throughput time series written to %s", path)
+
+
+def run_samplers(samplers, duration, exit_event=None):
+    """
+    Sample several counters at the same instants for duration seconds,
+    at the interval of the first sampler. The wake ups are scheduled
+    against absolute deadlines, so the sampling does not drift.
+
+    :param samplers: list of ThroughputSampler
+    :param exit_event: stop earlier once this threading.Event is set
+    """
+    interval = samplers[0].interval
+    deadline = utils_misc.monotonic_time()
+    end = deadline + duration
+    for sampler in samplers:
+        sampler.sample()
+    while True:
+        deadline = min(deadline + interval, end)
+        delay = deadline - utils_misc.monotonic_time()
+        if delay > 0:
+            time.sleep(delay)
+        for sampler in samplers:
+            sampler.sample()
+        if deadline >= end or (exit_event and exit_event.is_set()):
+            break
@@ -0,0 +1,105 @@
+"""
+Large buffer host side data path for the virtio port performance tests.
+
+qemu_virtio_port.ThSend/ThRecv send a str and receive a new str for every
+chunk, at large buffer lengths the host harness then becomes the
+bottleneck. These threads keep the same interface (idx, ret_code,
+exitevent) but work on one preallocated buffer: the sender pushes
+memoryview slices of it (sendmsg when available) and the receiver reads
+into it with recv_into, so no data is copied or allocated per chunk.
+"""
+import os
+import socket
+import logging
+import threading
+
+
+def set_socket_buffers(sock, sndbuf=None, rcvbuf=None):
+    """
+    Set the socket send/receive buffer sizes.
+
+    :return: tuple of the (send, receive) buffer sizes set by the kernel
+    """
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, int(sndbuf))
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(rcvbuf))
+    return (sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+
+class PerfSend(threading.Thread):
+
+    """
+    Send a preallocated buffer over and over until exit_event is set.
+    """
+
+    def __init__(self, port, data, exit_event, quiet=False):
+        """
+        :param port: port socket
+        :param data: buffer to send, or its length to send random data
+        :param exit_event: threading.Event stopping the thread
+        :param quiet: don't log the sent amount at the end
+        """
+        threading.Thread.__init__(self)
+        self.port = port
+        if isinstance(data, (int, long)):
+            data = os.urandom(data)
+        self.data = bytearray(data)
+        self.exitevent = exit_event
+        self.idx = 0
+        self.quiet = quiet
+        self.ret_code = 1
+
+    def run(self):
+        logging.debug("PerfSend %s: run", self.getName())
+        view = memoryview(self.data)
+        length = len(self.data)
+        send = self.port.send
+        if hasattr(self.port, "sendmsg"):
+            def send(buf):
+                return self.port.sendmsg([buf])
+        offset = 0
+        while not self.exitevent.isSet():
+            sent = send(view[offset:])
+            self.idx += sent
+            offset = (offset + sent) % length
+        if not self.quiet:
+            logging.debug("PerfSend %s: exit(%d)", self.getName(), self.idx)
+        self.ret_code = 0
+
+
+class PerfRecv(threading.Thread):
+
+    """
+    Receive into a preallocated buffer until exit_event is set.
+    """
+
+    def __init__(self, port, exit_event, blocklen=1024, quiet=False):
+        """
+        :param port: port socket
+        :param exit_event: threading.Event stopping the thread
+        :param blocklen: size of the receive buffer
+        :param quiet: don't log the received amount at the end
+        """
+        threading.Thread.__init__(self)
+        self.port = port
+        self.port.settimeout(1)
+        self.buff = bytearray(blocklen)
+        self.exitevent = exit_event
+        self.idx = 0
+        self.quiet = quiet
+        self.ret_code = 1
+
+    def run(self):
+        logging.debug("PerfRecv %s: run", self.getName())
+        view = memoryview(self.buff)
+        recv_into = self.port.recv_into
+        while not self.exitevent.isSet():
+            try:
+                self.idx += recv_into(view)
+            except socket.timeout:
+                pass
+        if not self.quiet:
+            logging.debug("PerfRecv %s: exit(%d)", self.getName(), self.idx)
+        self.ret_code = 0
@@ -0,0 +1,191 @@
+"""
+Host side checks of an ELF vmcore written by dump-guest-memory.
+
+The vmcore is mmap()ed, its ELF header and program headers are parsed
+and sampled pages of the PT_LOAD segments are compared to the guest
+physical memory read back through the pmemsave monitor command. The
+guest must stay paused between the dump and the spot checks.
+"""
+import os
+import mmap
+import random
+import struct
+import logging
+
+
+ELFMAG = "\x7fELF"
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ET_CORE = 4
+EM_X86_64 = 62
+PT_LOAD = 1
+PT_NOTE = 4
+PN_XNUM = 0xffff
+
+_EHDR = struct.Struct("<16sHHIQQQIHHHHHH")
+_PHDR = struct.Struct("<IIQQQQQQ")
+_SHDR = struct.Struct("<IIQQQQIIQQ")
+
+
+class VmcoreError(Exception):
+    pass
+
+
+class Vmcore(object):
+
+    """
+    A mmap()ed ELF64 little endian vmcore.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size < _EHDR.size:
+            self._file.close()
+            raise VmcoreError("%s is too short for an ELF header (%d bytes)"
+                              % (path, self.size))
+        self.map = mmap.mmap(self._file.fileno(), 0, prot=mmap.PROT_READ)
+        self.machine = None
+        self.loads = []
+        self.notes = []
+        try:
+            self._parse()
+        except:
+            self.close()
+            raise
+
+    def _parse(self):
+        (ident, e_type, self.machine, _, _, phoff, shoff, _, _, phentsize,
+         phnum, shentsize, _, _) = _EHDR.unpack_from(self.map, 0)
+        if (ident[:4] != ELFMAG or ord(ident[4]) != ELFCLASS64 or
+                ord(ident[5]) != ELFDATA2LSB):
+            raise VmcoreError("%s is not an ELF64 LSB file" % self.path)
+        if e_type != ET_CORE:
+            raise VmcoreError("%s is not an ELF core file (type %d)" %
+                              (self.path, e_type))
+        if phnum == PN_XNUM:
+            # The real count is kept in sh_info of section header 0
+            if not shoff or shentsize < _SHDR.size:
+                raise VmcoreError("%s: PN_XNUM without section header" %
+                                  self.path)
+            phnum = _SHDR.unpack_from(self.map, shoff)[7]
+        if phentsize < _PHDR.size or phoff + phnum * phentsize > self.size:
+            raise VmcoreError("%s: program headers out of the file" %
+                              self.path)
+        for i in xrange(phnum):
+            (p_type, _, offset, vaddr, paddr, filesz,
+             memsz, _) = _PHDR.unpack_from(self.map, phoff + i * phentsize)
+            segment = {"offset": offset, "vaddr": vaddr, "paddr": paddr,
+                       "filesz": filesz, "memsz": memsz}
+            if p_type == PT_LOAD:
+                self.loads.append(segment)
+            elif p_type == PT_NOTE:
+                self.notes.append(segment)
+
+    def close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self._file.close()
+
+    def check_layout(self):
+        """
+        Check that the segments lie within the file and that the PT_LOAD
+        segments don't overlap, in the file nor in guest physical memory.
+
+        :return: list of problem descriptions, empty if none
+        """
+        problems = []
+        if not self.loads:
+            problems.append("no PT_LOAD segment")
+        for segment in self.loads + self.notes:
+            if segment["offset"] + segment["filesz"] > self.size:
+                problems.append("segment at offset 0x%x is truncated, the "
+                                "file has %d bytes" % (segment["offset"],
+                                                       self.size))
+        for key, size in (("offset", "filesz"), ("paddr", "memsz")):
+            ranges = sorted((_[key], _[key] + _[size]) for _ in self.loads)
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                if start < end:
+                    problems.append("PT_LOAD segments overlap at %s 0x%x" %
+                                    (key, start))
+        return problems
+
+    def ram_size(self):
+        """
+        :return: guest RAM bytes present in the vmcore
+        """
+        return sum(_["filesz"] for _ in self.loads)
+
+    def read_phys(self, paddr, length):
+        """
+        Read guest physical memory from the vmcore.
+
+        :return: str, None if the range is not (fully) in one segment
+        """
+        for segment in self.loads:
+            start = segment["paddr"]
+            if start <= paddr and paddr + length <= start + segment["filesz"]:
+                offset = segment["offset"] + paddr - start
+                return self.map[offset:offset + length]
+        return None
+
+    def sample_addresses(self, count, page_size=4096, seed=None):
+        """
+        Pick count random page aligned guest physical addresses stored in
+        the vmcore, always including the first and the last page of every
+        PT_LOAD segment.
+        """
+        rand = random.Random(seed)
+        ranges = []
+        addresses = set()
+        for segment in self.loads:
+            first = segment["paddr"] + page_size - 1
+            first -= first % page_size
+            pages = (segment["paddr"] + segment["filesz"] - first) / page_size
+            if pages > 0:
+                ranges.append((first, pages))
+                addresses.update((first, first + (pages - 1) * page_size))
+        total = sum(_[1] for _ in ranges)
+        for pick in rand.sample(xrange(total), min(count, total)):
+            for first, pages in ranges:
+                if pick < pages:
+                    addresses.add(first + pick * page_size)
+                    break
+                pick -= pages
+        return sorted(addresses)
+
+
+def pmemsave(qmp_monitor, paddr, length, path):
+    """
+    Read guest physical memory through the pmemsave monitor command.
+    """
+    qmp_monitor.cmd(cmd="pmemsave", args={"val": paddr, "size": length,
+                                          "filename": path})
+    data_file = open(path, "rb")
+    try:
+        return data_file.read()
+    finally:
+        data_file.close()
+        os.unlink(path)
+
+
+def spot_check(core, qmp_monitor, addresses, tmp_path, page_size=4096):
+    """
+    Compare sampled pages of the vmcore with the guest memory.
+
+    :param core: Vmcore object
+    :param qmp_monitor: QMP monitor of the paused guest
+    :param addresses: guest physical page addresses to compare
+    :param tmp_path: host file pmemsave writes to
+    :return: list of the mismatching addresses
+    """
+    mismatches = []
+    for paddr in addresses:
+        expected = pmemsave(qmp_monitor, paddr, page_size, tmp_path)
+        if core.read_phys(paddr, page_size) != expected:
+            logging.debug("vmcore page 0x%x differs from guest memory",
+                          paddr)
+            mismatches.append(paddr)
+    return mismatches
@@ -19,6 +19,8 @@ from virttest import data_dir
 from virttest import utils_misc
 from virttest.utils_test.qemu import migration
 
+from provider import cpuflags
+
 
 def run(test, params, env):
     """
@@ -416,6 +418,8 @@ def run(test, params, env):
         :param flags: Flags to test.
         :return: Tuple (Working, not working, not tested) flags.
         """
+        if params.get("cpuflags_bench") == "yes":
+            return bench_cpuflags(vm, path, flags)[:3]
         pass_Flags = []
         not_tested = []
         not_working = []
@@ -434,6 +438,83 @@ def run(test, params, env):
                 set(map(utils_misc.Flag, not_working)),
                 set(map(utils_misc.Flag, not_tested)))
 
+    def bench_cpuflags(vm, path, flags, duration=None):
+        """
+        Run the tests of all the flags at the same time, one per guest cpu,
+        with a single cpuflags-test --bench call and get the test runs/s
+        of each of them.
+
+        :param vm: Virtual machine.
+        :param path: Path of cpuflags_test
+        :param flags: Flags to test.
+        :param duration: Seconds every test runs, cpuflags_bench_time
+                         (10 by default) if None.
+        :return: Tuple (Working, not working, not tested) flags, dict of
+                 test name -> results, see cpuflags.parse_bench()
+        """
+        if duration is None:
+            duration = int(params.get("cpuflags_bench_time", 10))
+        tests = set()
+        not_tested = []
+        for f in flags:
+            try:
+                tests.update(utils_misc.kvm_map_flags_to_test[f])
+            except KeyError:
+                not_tested.append(f)
+        results = {}
+        if tests:
+            session = vm.wait_for_login()
+            try:
+                output = session.cmd_output(
+                    "%s/cpuflags-test --bench %d,%s" %
+                    (os.path.join(path, "cpu_flags"), duration,
+                     ",".join(sorted(tests))), timeout=duration + 60)
+            finally:
+                session.close()
+            results = cpuflags.parse_bench(output)
+        pass_Flags = []
+        not_working = []
+        for f in set(flags) - set(not_tested):
+            for tc in utils_misc.kvm_map_flags_to_test[f]:
+                result = results.get(tc)
+                if not result or result["sigill"] or result["failures"]:
+                    not_working.append(f)
+                    break
+            else:
+                pass_Flags.append(f)
+
+        lines = ["%-8s %14s %16s %10s %7s %4s" % ("test", "runs", "runs/s",
+                                                  "failures", "sigill",
+                                                  "cpu")]
+        keyval = {}
+        too_slow = []
+        for tc in sorted(tests):
+            result = results.get(tc)
+            if result is None:
+                lines.append("%-8s %14s" % (tc, "no result"))
+                continue
+            lines.append("%-8s %14d %16.1f %10d %7s %4d" % (
+                tc, result["ops"], result["rate"], result["failures"],
+                result["sigill"], result["cpu"]))
+            keyval["cpuflags_bench_%s" % tc] = "%.1f" % result["rate"]
+            min_rate = params.get("cpuflags_bench_min_rate_%s" % tc)
+            if min_rate and result["rate"] < float(min_rate):
+                logging.warning("%s runs/s %.1f below the expected %s",
+                                tc, result["rate"], min_rate)
+                too_slow.append(tc)
+        logging.info("cpuflags-test --bench results, %ds per test:\n%s",
+                     duration, "\n".join(lines))
+        if keyval:
+            test.write_test_keyval(keyval)
+        for f in pass_Flags[:]:
+            if set(utils_misc.kvm_map_flags_to_test[f]) & set(too_slow):
+                pass_Flags.remove(f)
+                not_working.append(f)
+        return (set(map(utils_misc.Flag, pass_Flags)),
+                set(map(utils_misc.Flag, not_working)),
+                set(map(utils_misc.Flag, not_tested)),
+                results)
+
     def run_stress(vm, timeout, guest_flags):
         """
         Run stress on vm for timeout time.
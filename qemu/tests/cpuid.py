@@ -1,8 +1,8 @@
 """
 Group of cpuid tests for X86 CPU
 """
-import re
 import os
+import time
 import string
 import logging
 
@@ -14,6 +14,9 @@ from virttest import env_process
 from virttest import virt_vm
 from virttest import data_dir
 
+from provider import cpuid_sweep
+from provider import cpuid_reference
+
 logger = logging.getLogger(__name__)
 dbg = logger.debug
 info = logger.info
@@ -80,63 +83,46 @@ def run(test, params, env):
         if added:
             logging.info("Extra CPU models in QEMU CPU listing: %s", added)
 
-    def compare_cpuid_output(a, b):
-        """
-        Generates a list of (bit, va, vb) tuples for
-        each bit that is different between a and b.
-        """
-        for bit in range(32):
-            ba = (a & (1 << bit)) >> bit
-            if b is not None:
-                bb = (b & (1 << bit)) >> bit
-            else:
-                bb = None
-            if ba != bb:
-                yield (bit, ba, bb)
-
     def parse_cpuid_dump(output):
         dbg("parsing cpuid dump: %r", output)
-        cpuid_re = re.compile(
-            "^ *(0x[0-9a-f]+) +0x([0-9a-f]+): +eax=0x([0-9a-f]+) ebx=0x([0-9a-f]+) ecx=0x([0-9a-f]+) edx=0x([0-9a-f]+)$")
-        output_match = re.search('(==START TEST==.*==END TEST==)', output, re.M | re.DOTALL)
-        if output_match is None:
+        result = cpuid_reference.parse_dump(output)
+        if result is None:
             dbg("cpuid dump doesn't follow expected pattern")
-            return None
-        output = output_match.group(1)
-        out_lines = output.splitlines()
-        if out_lines[0] != '==START TEST==' or out_lines[-1] != '==END TEST==':
-            dbg("cpuid dump doesn't have expected delimiters")
-            return None
-        if out_lines[1] != 'CPU:':
-            dbg("cpuid dump doesn't start with 'CPU:' line")
-            return None
-        result = {}
-        for l in out_lines[2:-1]:
-            m = cpuid_re.match(l)
-            if m is None:
-                dbg("invalid cpuid dump line: %r", l)
-                return None
-            in_eax = int(m.group(1), 16)
-            in_ecx = int(m.group(2), 16)
-            result[in_eax, in_ecx, 'eax'] = int(m.group(3), 16)
-            result[in_eax, in_ecx, 'ebx'] = int(m.group(4), 16)
-            result[in_eax, in_ecx, 'ecx'] = int(m.group(5), 16)
-            result[in_eax, in_ecx, 'edx'] = int(m.group(6), 16)
         return result
 
+    def get_reference_index():
+        """
+        Get the compiled index of the cpuid reference dumps of the current
+        (kvm or nokvm) mode, None if there are no dumps for it.
+        """
+        kvm_enabled = params.get("enable_kvm", "yes") == "yes"
+        dumps_dir = os.path.join(data_dir.get_deps_dir(), 'cpuid',
+                                 "cpuid_dumps",
+                                 kvm_enabled and "kvm" or "nokvm")
+        if not os.path.isdir(dumps_dir):
+            return None
+        return cpuid_reference.load_index(dumps_dir, data_dir.get_tmp_dir())
+
     def get_test_kernel_cpuid(self, vm):
         vm.resume()
 
         timeout = float(params.get("login_timeout", 240))
         logging.debug("Will wait for CPUID serial output at %r",
                       vm.serial_console)
-        if not utils_misc.wait_for(lambda:
-                                   re.search("==END TEST==",
-                                             vm.serial_console.get_output()),
-                                   timeout, 1):
+        # Only the output added since the last poll is parsed
+        parser = cpuid_sweep.DumpParser()
+        consumed = [0]
+
+        def dump_complete():
+            output = vm.serial_console.get_output()
+            parser.feed(output[consumed[0]:])
+            consumed[0] = len(output)
+            return parser.done
+
+        if not utils_misc.wait_for(dump_complete, timeout, 0, 0.1):
             raise error.TestFail("Could not get test complete message.")
 
-        test_output = parse_cpuid_dump(vm.serial_console.get_output())
+        test_output = parse_cpuid_dump(parser.output())
         logging.debug("Got CPUID serial output: %r", test_output)
         if test_output is None:
             raise error.TestFail("Test output signature not found in "
@@ -144,8 +130,21 @@ def run(test, params, env):
         vm.destroy(gracefully=False)
         return test_output
 
+    def get_test_kernel():
+        """
+        Get the cpuid test kernel, it is only rebuilt when its sources
+        change.
+        """
+        return cpuid_sweep.build_dump_kernel(
+            os.path.join(data_dir.get_deps_dir(), "cpuid", "src"),
+            data_dir.get_tmp_dir())
+
     def find_cpu_obj(vm):
         """Find path of a valid VCPU object"""
+        # query-cpus reports the QOM path since QEMU 2.1, no tree walk
+        for cpu in vm.monitor.cmd('query-cpus'):
+            if 'qom_path' in cpu:
+                return cpu['qom_path']
         roots = ['/machine/icc-bridge/icc', '/machine/unattached/device']
         for root in roots:
             for child in vm.monitor.cmd('qom-list', dict(path=root)):
@@ -169,16 +168,10 @@ def run(test, params, env):
         return r
 
     def get_guest_cpuid(self, cpu_model, feature=None, extra_params=None, qom_mode=False):
-        if not qom_mode:
-            test_kernel_dir = os.path.join(data_dir.get_deps_dir(), "cpuid", "src")
-            os.chdir(test_kernel_dir)
-            utils.make("cpuid_dump_kernel.bin")
-
         vm_name = params['main_vm']
         params_b = params.copy()
         if not qom_mode:
-            params_b["kernel"] = os.path.join(
-                test_kernel_dir, "cpuid_dump_kernel.bin")
+            params_b["kernel"] = get_test_kernel()
         params_b["cpu_model"] = cpu_model
         params_b["cpu_model_flags"] = feature
         del params_b["images"]
@@ -532,24 +525,66 @@ def run(test, params, env):
         if (has_error is False) and (xfail is True):
             raise error.TestFail("Test was expected to fail, but it didn't")
 
-    def check_cpuid_dump(self):
+    def get_cpuid_whitelist():
         """
-        Compare full CPUID dump data
+        Parse ignore_cpuid_leaves, syntax:
+        <in_eax>[,<in_ecx>[,<register>[ ,<bit>]]] ...
         """
-        machine_type = params.get("machine_type_to_check", "")
-        kvm_enabled = params.get("enable_kvm", "yes") == "yes"
-
-        ignore_cpuid_leaves = params.get("ignore_cpuid_leaves", "")
-        ignore_cpuid_leaves = ignore_cpuid_leaves.split()
-        whitelist = []
-        for leaf in ignore_cpuid_leaves:
+        whitelist = set()
+        for leaf in params.get("ignore_cpuid_leaves", "").split():
             leaf = leaf.split(',')
-            # syntax of ignore_cpuid_leaves:
-            # <in_eax>[,<in_ecx>[,<register>[ ,<bit>]]] ...
             for i in 0, 1, 3:  # integer fields:
                 if len(leaf) > i:
                     leaf[i] = int(leaf[i], 0)
-            whitelist.append(tuple(leaf))
+            whitelist.add(tuple(leaf))
+        return whitelist
+
+    def compare_to_reference(reference, out, whitelist, name=""):
+        """
+        Log the bits of out that differ from the reference dump.
+
+        :return: True if all the differences are whitelisted
+        """
+        ok = True
+        for d in cpuid_reference.diff(reference, out):
+            in_eax, in_ecx, reg, bit, vreference, vout = d
+            whitelisted = (in_eax,) in whitelist \
+                or (in_eax, in_ecx) in whitelist \
+                or (in_eax, in_ecx, reg) in whitelist \
+                or (in_eax, in_ecx, reg, bit) in whitelist
+            silent = False
+
+            if vout is None and params.get('ok_missing', 'no') == 'yes':
+                whitelisted = True
+                silent = True
+
+            if not silent:
+                info(
+                    "%sNon-matching bit: CPUID[0x%x,0x%x].%s[%d]: found %s instead of %s%s",
+                    name and "%s: " % name, in_eax, in_ecx, reg, bit,
+                    vout, vreference,
+                    whitelisted and " (whitelisted)" or "")
+
+            if not whitelisted:
+                ok = False
+        return ok
+
+    def cannot_run_model(output):
+        """
+        Check if the qemu output says the CPU model can't run on this host.
+        """
+        return "host doesn't support requested feature:" in output \
+            or ("host cpuid" in output and
+                ("lacks requested flag" in output or
+                 "flag restricted to guest" in output)) \
+            or ("Unable to find CPU definition:" in output)
+
+    def check_cpuid_dump(self):
+        """
+        Compare full CPUID dump data
+        """
+        machine_type = params.get("machine_type_to_check", "")
+        whitelist = get_cpuid_whitelist()
 
         if not machine_type:
             raise error.TestNAError("No machine_type_to_check defined")
@@ -558,20 +593,11 @@ def run(test, params, env):
         if cpu_model_flags:
             full_cpu_model_name += ','
             full_cpu_model_name += cpu_model_flags.lstrip(',')
-        ref_file = os.path.join(data_dir.get_deps_dir(), 'cpuid',
-                                "cpuid_dumps",
-                                kvm_enabled and "kvm" or "nokvm",
-                                machine_type, '%s-dump.txt' % (full_cpu_model_name))
-        if not os.path.exists(ref_file):
-            raise error.TestNAError("no cpuid dump file: %s" % (ref_file))
-        reference = open(ref_file, 'r').read()
-        if not reference:
-            raise error.TestNAError(
-                "no cpuid dump data on file: %s" % (ref_file))
-        reference = parse_cpuid_dump(reference)
+        index = get_reference_index()
+        reference = index and index.get(machine_type, full_cpu_model_name)
         if reference is None:
-            raise error.TestNAError(
-                "couldn't parse reference cpuid dump from file; %s" % (ref_file))
+            raise error.TestNAError("no valid cpuid dump for %s on %s" %
+                                    (full_cpu_model_name, machine_type))
         qom_mode = params.get('qom_mode', "no").lower() == 'yes'
         if not qom_mode:
             cpu_model_flags += ',enforce'
@@ -583,45 +609,87 @@ def run(test, params, env):
                 qom_mode=qom_mode)
         except (virt_vm.VMStartError, virt_vm.VMCreateError) as e:
             output = getattr(e, 'reason', getattr(e, 'output', ''))
-            if "host doesn't support requested feature:" in output \
-                or ("host cpuid" in output and
-                    ("lacks requested flag" in output or
-                     "flag restricted to guest" in output)) \
-                    or ("Unable to find CPU definition:" in output):
+            if cannot_run_model(output):
                 raise error.TestNAError(
                     "Can't run CPU model %s on this host" % (full_cpu_model_name))
             else:
                 raise
-        dbg('ref_file: %r', ref_file)
         dbg('ref: %r', reference)
         dbg('out: %r', out)
-        ok = True
-        for k in reference.keys():
-            in_eax, in_ecx, reg = k
-            diffs = compare_cpuid_output(reference[k], out.get(k))
-            for d in diffs:
-                bit, vreference, vout = d
-                whitelisted = (in_eax,) in whitelist \
-                    or (in_eax, in_ecx) in whitelist \
-                    or (in_eax, in_ecx, reg) in whitelist \
-                    or (in_eax, in_ecx, reg, bit) in whitelist
-                silent = False
-
-                if vout is None and params.get('ok_missing', 'no') == 'yes':
-                    whitelisted = True
-                    silent = True
-
-                if not silent:
-                    info(
-                        "Non-matching bit: CPUID[0x%x,0x%x].%s[%d]: found %s instead of %s%s",
-                        in_eax, in_ecx, reg, bit, vout, vreference,
-                        whitelisted and " (whitelisted)" or "")
-
-                if not whitelisted:
-                    ok = False
+        ok = compare_to_reference(reference, out, whitelist)
         if not ok:
             raise error.TestFail("Unexpected CPUID data")
 
+    def cpuid_dump_sweep(self):
+        """
+        Compare the CPUID dumps of many machine types and CPU models, one
+        short-lived qemu per reference dump, several running in parallel.
+
+        sweep_machine_types and cpu_models select the reference dumps,
+        all of them by default. The CPU flags are taken from the
+        reference dump file names.
+        """
+        kvm_enabled = params.get("enable_kvm", "yes") == "yes"
+        index = get_reference_index()
+        if index is None:
+            raise error.TestNAError("no cpuid dumps for this mode")
+        machine_types = params.get("sweep_machine_types", "*")
+        machine_types = machine_types != "*" and machine_types.split() or None
+        models = params.get("cpu_models", "*")
+        models = models != "*" and models.split() or None
+        whitelist = get_cpuid_whitelist()
+        timeout = float(params.get("sweep_dump_timeout", 60))
+        kernel = get_test_kernel()
+
+        references = {}
+        jobs = {}
+        for machine_type, full_cpu_model_name in index.select(machine_types,
+                                                              models):
+            name = "%s/%s" % (machine_type, full_cpu_model_name)
+            references[name] = index.get(machine_type, full_cpu_model_name)
+            jobs[name] = dict(qemu_binary=qemu_binary, kernel=kernel,
+                              machine_type=machine_type,
+                              cpu_model="%s,enforce" % full_cpu_model_name,
+                              kvm=kvm_enabled, timeout=timeout)
+        for machine_type, full_cpu_model_name in index.invalid:
+            logging.warn("Couldn't parse reference dump %s/%s",
+                         machine_type, full_cpu_model_name)
+        if not jobs:
+            raise error.TestNAError("No cpuid reference dump selected")
+
+        parallel = int(params.get("sweep_parallel", 0))
+        logging.info("Dumping CPUID of %d machine type/CPU model "
+                     "combinations", len(jobs))
+        start = time.time()
+        results = cpuid_sweep.run_sweep(jobs, parallel)
+        logging.info("Got %d CPUID dumps in %.1fs", len(results),
+                     time.time() - start)
+
+        failed = []
+        skipped = []
+        for name in sorted(results):
+            output, qemu_output, _ = results[name]
+            out = output and parse_cpuid_dump(output)
+            if not out:
+                if cannot_run_model(qemu_output) or \
+                        "unsupported machine type" in qemu_output:
+                    dbg("%s can't run on this host: %s", name, qemu_output)
+                    skipped.append(name)
+                else:
+                    info("%s: no CPUID dump, qemu output: %s", name,
+                         qemu_output)
+                    failed.append(name)
+                continue
+            if not compare_to_reference(references[name], out, whitelist,
+                                        name):
+                failed.append(name)
+        info("CPUID sweep: %d passed, %d failed, %d can't run on this "
+             "host", len(results) - len(failed) - len(skipped),
+             len(failed), len(skipped))
+        if failed:
+            raise error.TestFail("Unexpected CPUID data for: %s" %
+                                 " ".join(failed))
+
     # subtests runner
     test_type = params["test_type"]
     if test_type not in locals():
@@ -1,5 +1,6 @@
 import os
 import re
+import json
 import time
 import threading
 import logging
@@ -12,6 +13,10 @@ from avocado.core import exceptions
 from virttest import utils_misc, utils_test
 from virttest import data_dir
 
+from provider import convergence
+from provider import host_sampler
+from provider import perf_results
+
 
 def format_result(result, base="12", fbase="2"):
     """
@@ -62,6 +67,7 @@ def get_version(session, result_file, kvm_ver_chk_cmd, guest_ver_cmd, type, driv
     :param type: guest type
     :param driver_format: driver format
     :param timeout: Timeout in seconds
+    :return: dict of the collected versions
     """
 
     kvm_ver = utils.system_output(kvm_ver_chk_cmd)
@@ -74,11 +80,174 @@ def get_version(session, result_file, kvm_ver_chk_cmd, guest_ver_cmd, type, driv
         result = session.cmd_output(guest_ver_cmd, timeout)
         if type == "windows":
             guest_ver = re.findall(".*?(\d{2}\.\d{2}\.\d{3}\.\d{4}).*?", result)
-            result_file.write("### guest-kernel-ver :Microsoft Windows [Version %s]\n" % guest_ver[0])
+            guest_ver = "Microsoft Windows [Version %s]" % guest_ver[0]
+            result_file.write("### guest-kernel-ver :%s\n" % guest_ver)
         else:
+            guest_ver = result.strip()
             result_file.write("### guest-kernel-ver :%s" % result)
     else:
-        result_file.write("### guest-kernel-ver : Microsoft Windows [Version ide driver format]\n")
+        guest_ver = "Microsoft Windows [Version ide driver format]"
+        result_file.write("### guest-kernel-ver : %s\n" % guest_ver)
+
+    return {"kvm-userspace-ver": kvm_ver.strip(),
+            "kvm_version": host_ver,
+            "guest-kernel-ver": guest_ver}
+
+
+def _fio_lat_stats(job_dir, lat_key):
+    """
+    Get the latency stats of one direction of a fio json job in msec.
+
+    fio >= 2.99 reports latencies in nsec under "<key>_ns", older versions
+    in usec under "<key>".
+
+    :param job_dir: the "read" or "write" dict of a fio json job
+    :param lat_key: "lat" or "clat"
+    :return: tuple of the stats dict and its divisor to get msec
+    """
+    if "%s_ns" % lat_key in job_dir:
+        return job_dir["%s_ns" % lat_key], 1000000.0
+    return job_dir.get(lat_key, {}), 1000.0
+
+
+def _fio_percentiles(clat, divisor, percentiles):
+    """
+    Get completion latency percentiles in msec.
+
+    The "percentile" dict written by fio is used when present, the json+
+    "bins" histogram (latency -> io count) otherwise.
+
+    :param clat: the clat stats dict of one direction of a fio json job
+    :param divisor: divisor to convert the fio latency unit to msec
+    :param percentiles: list of the wanted percentiles as floats
+    :return: dict of percentile -> latency
+    """
+    result = {}
+    fio_pct = clat.get("percentile", {})
+    for pct in percentiles:
+        key = "%f" % pct
+        if key in fio_pct:
+            result[pct] = float(fio_pct[key]) / divisor
+    bins = clat.get("bins")
+    if len(result) == len(percentiles) or not isinstance(bins, dict):
+        return result
+    hist = sorted((float(lat), count) for lat, count in bins.items())
+    total = sum(count for _, count in hist)
+    for pct in percentiles:
+        if pct in result or not total:
+            continue
+        target = total * pct / 100.0
+        seen = 0
+        for lat, count in hist:
+            seen += count
+            if seen >= target:
+                result[pct] = lat / divisor
+                break
+    return result
+
+
+def load_fio_json(result_path):
+    """
+    Load a fio result file written with --output-format=json or json+.
+
+    :param result_path: fio result file on host
+    """
+    with open(result_path) as result_file:
+        content = result_file.read()
+    # fio may print warnings before the json document
+    return json.loads(content[content.index("{"):])
+
+
+def summary_fio_jobs(jobs, disk_util=None, percentiles=(50.0, 99.0, 99.9)):
+    """
+    Sum up the results of fio json jobs.
+
+    Read and write sides are summed up the same way as for the normal
+    output, so the numbers stay comparable with the regex based parsing.
+
+    :param jobs: list of the job dicts of a fio json report
+    :param disk_util: the disk_util list of a fio json report
+    :param percentiles: completion latency percentiles to report
+    :return: dict with bw (MB/s), iops, lat (ms), clat_p<N> (ms), the
+             util of the first disk (%, None if not reported) and a
+             per job list of bw/iops
+    """
+    ret = {"bw": 0.0, "iops": 0.0, "lat": 0.0, "util": None, "jobs": []}
+    clat_pct = {}
+    for job in jobs:
+        job_ret = {"jobname": job.get("jobname"), "bw": 0.0, "iops": 0.0}
+        for direction in ("read", "write"):
+            job_dir = job.get(direction)
+            if not job_dir or not job_dir.get("io_bytes", job_dir.get("bw")):
+                continue
+            # fio reports bw in KiB/s
+            job_ret["bw"] += float(job_dir["bw"]) / 1024
+            job_ret["iops"] += float(job_dir["iops"])
+            lat, divisor = _fio_lat_stats(job_dir, "lat")
+            ret["lat"] += float(lat.get("mean", 0)) / divisor
+            clat, divisor = _fio_lat_stats(job_dir, "clat")
+            for pct, value in _fio_percentiles(clat, divisor,
+                                               percentiles).items():
+                clat_pct[pct] = max(clat_pct.get(pct, 0.0), value)
+        ret["bw"] += job_ret["bw"]
+        ret["iops"] += job_ret["iops"]
+        ret["jobs"].append(job_ret)
+
+    for pct, value in clat_pct.items():
+        ret["clat_p%s" % ("%g" % pct)] = value
+    if disk_util:
+        ret["util"] = float(disk_util[0]["util"])
+    return ret
+
+
+def parse_fio_json(result_path, percentiles=(50.0, 99.0, 99.9)):
+    """
+    Parse a fio result file written with --output-format=json or json+.
+
+    :param result_path: fio result file on host
+    :param percentiles: completion latency percentiles to report
+    :return: dict as returned by summary_fio_jobs()
+    """
+    data = load_fio_json(result_path)
+    return summary_fio_jobs(data["jobs"], data.get("disk_util"), percentiles)
+
+
+def fio_batch_job_name(io_pattern, bs, io_depth, numjobs):
+    """
+    Name of the job file section of one matrix cell.
+    """
+    return "%s_%s_%s_%s" % (io_pattern, bs, io_depth, numjobs)
+
+
+def write_fio_batch_job_file(path, cells, global_opts, filename):
+    """
+    Write one fio job file covering the whole test matrix.
+
+    Every cell is a stonewall section, so the cells run one after another
+    and each one is its own reporting group in the fio report.
+
+    :param path: job file path on host
+    :param cells: list of (io_pattern, bs, io_depth, numjobs) tuples
+    :param global_opts: fio options shared by all cells, like
+                        "direct=1 ioengine=libaio runtime=60 time_based"
+    :param filename: value of the fio filename option, "%s" in it is
+                     replaced by the name of the cell
+    """
+    job_file = open(path, "w")
+    job_file.write("[global]\n")
+    for opt in global_opts.split():
+        job_file.write("%s\n" % opt)
+    for io_pattern, bs, io_depth, numjobs in cells:
+        name = fio_batch_job_name(io_pattern, bs, io_depth, numjobs)
+        job_file.write("\n[%s]\n" % name)
+        job_file.write("stonewall\n")
+        if "%s" in filename:
+            job_file.write("filename=%s\n" % (filename % name))
+        else:
+            job_file.write("filename=%s\n" % filename)
+        job_file.write("rw=%s\nbs=%s\niodepth=%s\nnumjobs=%s\n" %
+                       (io_pattern, bs, io_depth, numjobs))
+    job_file.close()
 
 
 def clean_tmp_files(session, check_install_fio, tarball, os_type, guest_result_file, fio_path, timeout):
@@ -120,12 +289,38 @@ def run(test, params, env):
     :param env: Dictionary with test environment
     """
 
-    def fio_thread():
+    def fio_thread(run_cmd):
         """
         run fio command in guest
         """
         session.cmd_status(run_cmd, cmd_timeout)
 
+    def parse_fio_text(fio_result_file, io_pattern):
+        """
+        parse the normal fio output with the configured regex
+
+        :param fio_result_file: fio result file on host
+        :param io_pattern: the rw type of the fio job
+        """
+        util = None
+        o = process.system_output("egrep '(read|write)' %s" % fio_result_file)
+        results = re.findall(pattern, o)
+        o = process.system_output("egrep 'lat' %s" % fio_result_file)
+        laten = re.findall("\s{5}lat\s\((\wsec)\).*?avg=[\s]?(\d+(?:[\.][\d]+)?).*?", o)
+        bw = float(utils_misc.normalize_data_size(results[0][0]))
+        iops = int(results[0][1])
+        if os_type == "linux":
+            o = process.system_output("egrep 'util' %s" % fio_result_file)
+            util = float(re.findall(".*?util=(\d+(?:[\.][\d]+))%", o)[0])
+
+        lat = float(laten[0][1]) / 1000 if laten[0][0] == "usec" else float(laten[0][1])
+        if re.findall("rw", io_pattern):
+            bw = bw + float(utils_misc.normalize_data_size(results[1][0]))
+            iops = iops + int(results[1][1])
+            lat1 = float(laten[1][1]) / 1000 if laten[1][0] == "usec" else float(laten[1][1])
+            lat = lat + lat1
+        return bw, iops, lat, util
+
     def _pin_vm_threads(node):
         """
         pin guest vcpu and vhost threads to cpus of a numa node repectively
@@ -184,14 +379,38 @@ def run(test, params, env):
     os_type = params.get("os_type", "linux")
     drop_cache = params.get("drop_cache")
     num_disk = params.get("num_disk")
+    fio_json = params.get("fio_output_format") in ("json", "json+")
+    if fio_json:
+        # parse fio's own json report in python instead of grepping the
+        # normal output, it also carries the completion latency percentiles
+        fio_cmd = fio_cmd.replace(
+            "--output=", "--output-format=%s --output=" %
+            params["fio_output_format"], 1)
+
+    if params.get("fio_batch") == "yes" and not params.get("fio_batch_cmd"):
+        raise exceptions.TestSkipError("fio_batch needs fio_batch_cmd, it "
+                                       "is only set for linux guests")
 
     result_path = utils_misc.get_path(test.resultsdir,
                                       "fio_result.RHS")
     result_file = open(result_path, "w")
 
     # scratch host and windows guest version info
-    get_version(session, result_file, kvm_ver_chk_cmd, guest_ver_cmd, os_type,
-                driver_format, cmd_timeout)
+    versions = get_version(session, result_file, kvm_ver_chk_cmd,
+                           guest_ver_cmd, os_type, driver_format, cmd_timeout)
+
+    # machine readable copy of the results, appended across runs
+    result_store = None
+    if params.get("result_store", "yes") == "yes":
+        store_path = params.get("result_store_path")
+        if not store_path:
+            store_path = utils_misc.get_path(test.resultsdir,
+                                             "fio_result.jsonl")
+        result_store = perf_results.ResultStore(store_path, "fio_perf",
+                                                versions)
+        result_store.update_metadata(
+            os_type=os_type, drive_format=driver_format,
+            image_name_disk1=params.get("image_name_disk1"))
 
     # install fio tool in guest
     fio_install(tarball)
@@ -212,22 +431,219 @@ def run(test, params, env):
     if format == "True":
         session.cmd(pre_cmd, cmd_timeout)
 
+    # repeat every cell until its bandwidth is stable
+    stable_mode = params.get("stable_mode") == "yes"
+    cv_target = float(params.get("stable_cv_target", 0.05))
+    min_runs = int(params.get("stable_min_runs", 3))
+    max_runs = int(params.get("stable_max_runs", 10))
+
     # get order_list
     order_line = ""
     for order in order_list.split():
         order_line += "%s|" % format_result(order)
+    if stable_mode and params.get("fio_batch") != "yes":
+        for order in "Samples", "BW_CV%":
+            order_line += "%s|" % format_result(order)
+
+    def host_stats(start, end):
+        """
+        get the host cpu usage, kvm exits and qemu cpu usage of a window
+
+        :param start: start timestamp of the host sampling window
+        :param end: end timestamp of the host sampling window
+        """
+        cpu_summary = host_sampler.summary(
+            [_[1] for _ in sampler.cpu_series(start, end)])
+        qemu_cpu = host_sampler.summary(
+            [_[1] for _ in sampler.counter_series("pid:%s" % vm.get_pid(),
+                                                  start, end)])
+        return {"cpu": sampler.cpu_usage(start, end),
+                "io_exits": sampler.counter_delta("kvm:exits", start, end),
+                "host_cpu_median": cpu_summary["median"],
+                "host_cpu_p95": cpu_summary["p95"],
+                "qemu_cpu": qemu_cpu["mean"]}
+
+    def record_result(io_pattern, bs, io_depth, numjobs, ret):
+        """
+        write the result of one matrix cell to the result files
+
+        :param ret: dict with bw, iops, lat, util, the host_stats() of the
+                    cell and the extra values kept in the result store
+        """
+        cpu = ret["cpu"]
+        line = ""
+        line += "%s|" % format_result(bs[:-1])
+        line += "%s|" % format_result(io_depth)
+        line += "%s|" % format_result(numjobs)
+        normal = ret["bw"] / cpu
+        for result in ret["bw"], ret["iops"], ret["lat"], cpu, normal:
+            line += "%s|" % format_result(result)
+        if os_type == "windows":
+            line += "%s" % format_result(ret["io_exits"])
+        if os_type == "linux":
+            line += "%s" % format_result(ret["io_exits"])
+            # no per cell disk util in batch mode
+            if ret["util"] is not None:
+                line += "|%s" % format_result(ret["util"])
+        if "samples" in ret:
+            line += "|%s" % format_result(ret["samples"])
+            line += "|%s" % format_result((ret["bw_cv"] or 0.0) * 100)
+        result_file.write("%s\n" % line)
+
+        if result_store:
+            row = {"rw": io_pattern, "bs": bs,
+                   "iodepth": int(io_depth),
+                   "numjobs": int(numjobs), "bw": ret["bw"],
+                   "iops": ret["iops"], "lat": ret["lat"], "host_cpu": cpu,
+                   "bw_per_cpu": normal, "kvm_exits": ret["io_exits"]}
+            if os_type == "linux" and ret["util"] is not None:
+                row["util"] = ret["util"]
+            for key in ret:
+                if key.startswith("clat_p") or key in (
+                        "host_cpu_median", "host_cpu_p95", "qemu_cpu",
+                        "jobs", "samples", "bw_cv", "bw_min", "bw_max",
+                        "stable"):
+                    row[key] = ret[key]
+            result_store.add_row(io_pattern, row)
+
+    def run_cell(run_cmd, io_pattern):
+        """
+        run fio once for a matrix cell and collect its results
+
+        :param run_cmd: fio command of the cell
+        :param io_pattern: the rw type of the cell
+        """
+        if os_type == "linux":
+            (s, o) = session.cmd_status_output(drop_cache,
+                                               timeout=cmd_timeout)
+            if s:
+                raise exceptions.TestFail("Failed to free memory: %s" % o)
+        fio_t = threading.Thread(target=fio_thread, args=(run_cmd,))
+        start = time.time()
+        fio_t.start()
+        fio_t.join()
+        end = min(time.time(), start + sample_time)
+
+        vm.copy_files_from(guest_result_file, data_dir.get_tmp_dir())
+        fio_result_file = os.path.join(data_dir.get_tmp_dir(), "fio_result")
+        if fio_json:
+            ret = parse_fio_json(fio_result_file)
+            ret["iops"] = int(ret["iops"])
+            if ret["util"] is None:
+                ret["util"] = 0.0
+        else:
+            ret = {}
+            (ret["bw"], ret["iops"], ret["lat"],
+             ret["util"]) = parse_fio_text(fio_result_file, io_pattern)
+        ret.update(host_stats(start, end))
+        return ret
+
+    def fio_batch_run():
+        """
+        run the whole matrix with one fio job file and one fio invocation,
+        the host cpu and kvm exits are sampled during the whole run and
+        split up by the start time and the runtime fio reports for every
+        job
+        """
+        cells = []
+        for io_pattern in rw.split():
+            for bs in block_size.split():
+                for io_depth in iodepth.split():
+                    for numjobs in threads.split():
+                        cells.append((io_pattern, bs, io_depth, numjobs))
+
+        job_file = os.path.join(data_dir.get_tmp_dir(), "fio_batch.fio")
+        write_fio_batch_job_file(job_file, cells,
+                                 params["fio_batch_options"],
+                                 params["fio_batch_filename"])
+        guest_job_file = params.get("fio_batch_job_file", "/tmp/fio_batch.fio")
+        vm.copy_files_to(job_file, guest_job_file)
+        batch_cmd = params["fio_batch_cmd"] % guest_job_file
+        logging.info("run_cmd is: %s" % batch_cmd)
+        if os_type == "linux":
+            (s, o) = session.cmd_status_output(drop_cache,
+                                               timeout=cmd_timeout)
+            if s:
+                raise exceptions.TestFail("Failed to free memory: %s" % o)
+
+        # guest clock offset, to place the fio job start times on the host
+        # sample timeline
+        before = time.time()
+        guest_time = float(session.cmd_output("date +%s.%N").strip())
+        clock_offset = (before + time.time()) / 2 - guest_time
+        start_time = time.time()
+        cell_timeout = int(params.get("fio_batch_cell_timeout", 120))
+        batch_timeout = max(cmd_timeout, len(cells) * cell_timeout)
+        s, o = session.cmd_status_output(batch_cmd, batch_timeout)
+        if s:
+            raise exceptions.TestFail("fio batch run failed: %s" % o)
+
+        vm.copy_files_from(guest_result_file, data_dir.get_tmp_dir())
+        fio_result_file = os.path.join(data_dir.get_tmp_dir(),
+                                       os.path.basename(guest_result_file))
+        data = load_fio_json(fio_result_file)
+        jobs = {}
+        for job in data["jobs"]:
+            jobs[job["jobname"]] = job
+
+        # every cell is placed by the start time fio reports for its job
+        # (job_start, fio >= 3.28) plus its io runtime, older fio only
+        # gives the runtimes, the cells are then laid back to back from
+        # the start of the run. The host samples close to the edges of
+        # every cell are dropped.
+        trim = float(params.get("fio_batch_trim", 2))
+        if [_ for _ in jobs.values() if not _.get("job_start")]:
+            logging.warn("fio reports no job_start, the host samples of "
+                         "the cells are placed by the sum of the runtimes")
+        cell_start = start_time
+        category = None
+        header = order_line.rstrip("|")
+        if header.endswith("Util%"):
+            header = header.rsplit("|", 1)[0]
+        for io_pattern, bs, io_depth, numjobs in cells:
+            if io_pattern != category:
+                category = io_pattern
+                result_file.write("Category:%s\n" % io_pattern)
+                result_file.write("%s\n" % header)
+            name = fio_batch_job_name(io_pattern, bs, io_depth, numjobs)
+            job = jobs[name]
+            runtime = max(job["read"].get("runtime", 0),
+                          job["write"].get("runtime", 0)) / 1000.0
+            if job.get("job_start"):
+                cell_start = job["job_start"] / 1000.0 + clock_offset
+            cell_end = cell_start + runtime
+            # disk_util covers the whole run, it is not reported per cell
+            ret = summary_fio_jobs([job])
+            ret["iops"] = int(ret["iops"])
+            ret.update(host_stats(cell_start + trim, cell_end - trim))
+            record_result(io_pattern, bs, io_depth, numjobs, ret)
+            cell_start = cell_end
+
+    # sample host cpu, kvm exits and qemu cpu time in process for the whole
+    # test instead of forking mpstat and cat for every cell
+    sampler = host_sampler.HostSampler(
+        interval=float(params.get("host_sample_interval", 1)),
+        size=int(params.get("host_sample_size", 36000)),
+        pids=[vm.get_pid()])
+    sampler.start()
+    sample_time = float(params.get("host_sample_time", 60))
+
+    if params.get("fio_batch") == "yes":
+        if stable_mode:
+            logging.warn("stable_mode is not supported with fio_batch, "
+                         "every cell runs once")
+        fio_batch_run()
+        io_patterns = []
+    else:
+        io_patterns = rw.split()
 
     # get result tested by each scenario
-    for io_pattern in rw.split():
+    for io_pattern in io_patterns:
         result_file.write("Category:%s\n" % io_pattern)
         result_file.write("%s\n" % order_line.rstrip("|"))
         for bs in block_size.split():
             for io_depth in iodepth.split():
                 for numjobs in threads.split():
-                    line = ""
-                    line += "%s|" % format_result(bs[:-1])
-                    line += "%s|" % format_result(io_depth)
-                    line += "%s|" % format_result(numjobs)
                     if format == "True":
                         file_name = io_pattern + "_" + bs + "_" + io_depth
                         run_cmd = fio_cmd % (io_pattern, bs, io_depth, file_name, numjobs)
@@ -235,52 +651,23 @@ def run(test, params, env):
                         run_cmd = fio_cmd % (io_pattern, bs, io_depth, numjobs)
 
                     logging.info("run_cmd is: %s" % run_cmd)
-                    if os_type == "linux":
-                        (s, o) = session.cmd_status_output(drop_cache,
-                                                           timeout=cmd_timeout)
-                        if s:
-                            raise exceptions.TestFail("Failed to free memory: %s" % o)
-                    cpu_file = os.path.join(data_dir.get_tmp_dir(), "cpus")
-                    io_exits_b = int(process.system_output("cat /sys/kernel/debug/kvm/exits"))
-                    fio_t = threading.Thread(target=fio_thread)
-                    fio_t.start()
-                    process.system_output("mpstat 1 60 > %s" % cpu_file, shell=True)
-                    fio_t.join()
-
-                    io_exits_a = int(process.system_output("cat /sys/kernel/debug/kvm/exits"))
-                    vm.copy_files_from(guest_result_file, data_dir.get_tmp_dir())
-                    fio_result_file = os.path.join(data_dir.get_tmp_dir(), "fio_result")
-                    o = process.system_output("egrep '(read|write)' %s" % fio_result_file)
-                    results = re.findall(pattern, o)
-                    o = process.system_output("egrep 'lat' %s" % fio_result_file)
-                    laten = re.findall("\s{5}lat\s\((\wsec)\).*?avg=[\s]?(\d+(?:[\.][\d]+)?).*?", o)
-                    bw = float(utils_misc.normalize_data_size(results[0][0]))
-                    iops = int(results[0][1])
-                    if os_type == "linux":
-                        o = process.system_output("egrep 'util' %s" % fio_result_file)
-                        util = float(re.findall(".*?util=(\d+(?:[\.][\d]+))%", o)[0])
-
-                    lat = float(laten[0][1]) / 1000 if laten[0][0] == "usec" else float(laten[0][1])
-                    if re.findall("rw", io_pattern):
-                        bw = bw + float(utils_misc.normalize_data_size(results[1][0]))
-                        iops = iops + int(results[1][1])
-                        lat1 = float(laten[1][1]) / 1000 if laten[1][0] == "usec" else float(laten[1][1])
-                        lat = lat + lat1
-
-                    ret = process.system_output("tail -n 1 %s" % cpu_file)
-                    idle = float(ret.split()[-1])
-                    iowait = float(ret.split()[5])
-                    cpu = 100 - idle - iowait
-                    normal = bw / cpu
-                    io_exits = io_exits_a - io_exits_b
-                    for result in bw, iops, lat, cpu, normal:
-                        line += "%s|" % format_result(result)
-                    if os_type == "windows":
-                        line += "%s" % format_result(io_exits)
-                    if os_type == "linux":
-                        line += "%s|" % format_result(io_exits)
-                        line += "%s" % format_result(util)
-                    result_file.write("%s\n" % line)
+                    if stable_mode:
+                        ret, spread = convergence.run_until_stable(
+                            lambda: run_cell(run_cmd, io_pattern), "bw",
+                            cv_target, min_runs, max_runs)
+                        ret["samples"] = spread["samples"]
+                        ret["bw_cv"] = spread["cv"]
+                        ret["bw_min"] = spread["min"]
+                        ret["bw_max"] = spread["max"]
+                        ret["stable"] = spread["stable"]
+                    else:
+                        ret = run_cell(run_cmd, io_pattern)
+                    record_result(io_pattern, bs, io_depth, numjobs, ret)
+
+    sampler.stop()
+    result_file.close()
+    if result_store:
+        result_store.close()
 
     # del temporary files in guest
     clean_tmp_files(session, check_install_fio, tarball, os_type, guest_result_file, fio_path, cmd_timeout)
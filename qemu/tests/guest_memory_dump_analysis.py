@@ -1,6 +1,7 @@
 """
 Integrity test of a big guest vmcore, using the dump-guest-memory QMP
-command and the "crash" utility.
+command and the "crash" utility, or host side checks of the vmcore ELF
+headers and sampled pages (vmcore_verify = host).
 
 :copyright: 2013 Red Hat, Inc.
 :author: Laszlo Ersek <lersek@redhat.com>
@@ -11,13 +12,16 @@ Related RHBZ: https://bugzilla.redhat.com/show_bug.cgi?id=990118
 import logging
 import string
 import os
-import gzip
+import time
 import threading
 
 from aexpect import ShellCmdError
 
 from autotest.client.shared import error
 
+from provider import parallel_gzip
+from provider import vmcore
+
 REQ_GUEST_MEM = 4096        # exact size of guest RAM required
 REQ_GUEST_ARCH = "x86_64"    # the only supported guest arch
 REQ_GUEST_DF = 6144        # minimum guest disk space required
@@ -41,16 +45,17 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
-    def check_requirements(vm, session):
+    def check_requirements(vm, session, check_mem=True):
         """
         Check guest RAM size and guest architecture.
 
         :param vm: virtual machine.
         :param session: login shell session.
+        :param check_mem: check the guest RAM size too.
         :raise: error.TestError if the test is misconfigured.
         """
         mem_size = vm.get_memory_size()
-        if (mem_size != REQ_GUEST_MEM):
+        if (check_mem and mem_size != REQ_GUEST_MEM):
             raise error.TestError("the guest must have %d MB RAM exactly "
                                   "(current: %d MB)" % (REQ_GUEST_MEM,
                                                         mem_size))
@@ -151,7 +156,8 @@ def run(test, params, env):
 
         Use the "dump-guest-memory" QMP command with paging=false. Start
         a new Python thread that compresses data from a file descriptor
-        to a host file. Create a pipe and pass its writeable end to qemu
+        to a host file, as independent gzip members compressed by a pool
+        of threads. Create a pipe and pass its writeable end to qemu
         for vmcore dumping. Pass the pipe's readable end (with full
         ownership) to the compressor thread. Track references to the
         file descriptions underlying the pipe end fds carefully.
@@ -164,15 +170,24 @@ def run(test, params, env):
         :param qmp_monitor: QMP monitor for the guest.
         :param vmcore_host: absolute pathname of gzipped destination
                 file.
+        :return: dict with the dump time and the compression statistics,
+                see ParallelGzip.stats().
         :raise: all sorts of exceptions. No resources should be leaked.
         """
+        compressor_pool = parallel_gzip.ParallelGzip(
+            int(params.get("dump_compress_threads", 0)),
+            int(params.get("dump_compress_level", 1)),
+            int(params.get("dump_block_size", 4 * 1024 * 1024)),
+            int(params.get("dump_read_size", 1024 * 1024)))
+
+        compress_errors = []
+
         def compress_from_fd(input_fd, gzfile):
             # Run in a separate thread, take ownership of input_fd.
             try:
-                buf = os.read(input_fd, 4096)
-                while (buf):
-                    gzfile.write(buf)
-                    buf = os.read(input_fd, 4096)
+                compressor_pool.compress_fd(input_fd, gzfile)
+            except Exception, details:
+                compress_errors.append(details)
             finally:
                 # If we've run into a problem, this causes an EPIPE in
                 # the qemu process, preventing it from blocking in
@@ -197,7 +212,7 @@ def run(test, params, env):
                                 args={"fdname": "%s" % VMCORE_FD_NAME})
                 raise
 
-        gzfile = gzip.open(vmcore_host, "wb", 1)
+        gzfile = open(vmcore_host, "wb")
         try:
             try:
                 (read_by_gzip, written_by_qemu) = os.pipe()
@@ -210,7 +225,9 @@ def run(test, params, env):
                     # been transferred.
                     read_by_gzip = -1
                     try:
+                        dump_start = time.time()
                         dump_vmcore(qmp_monitor, written_by_qemu)
+                        dump_time = time.time() - dump_start
                     finally:
                         # Close Python's own reference to the writeable
                         # end as well, so that the compressor can
@@ -218,6 +235,9 @@ def run(test, params, env):
                         os.close(written_by_qemu)
                         written_by_qemu = -1
                         compressor.join()
+                    if compress_errors:
+                        raise error.TestError("vmcore compression failed: "
+                                              "%s" % compress_errors[0])
                 finally:
                     if (read_by_gzip != -1):
                         os.close(read_by_gzip)
@@ -230,6 +250,11 @@ def run(test, params, env):
         except:
             os.unlink(vmcore_host)
             raise
+        stats = compressor_pool.report("vmcore")
+        stats["dump_time"] = dump_time
+        logging.info("dump-guest-memory took %.1fs, %.1f MB/s", dump_time,
+                     stats["in_mb"] / dump_time if dump_time else 0.0)
+        return stats
 
     def verify_vmcore(vm, session, host_compr, guest_compr, guest_plain):
         """
@@ -265,6 +290,65 @@ def run(test, params, env):
                 string.find(output, "WARNING:") >= 0):
             raise error.TestFail("vmcore corrupt")
 
+    def verify_vmcore_host(vm, qmp_monitor, vmcore_plain):
+        """
+        Verify the vmcore on the host, without the guest side "crash".
+
+        Pause the guest, dump an uncompressed vmcore to a host file and
+        compare sampled pages of its PT_LOAD segments to the guest
+        physical memory read with pmemsave, then resume the guest. The
+        ELF headers are checked to describe an x86_64 core holding all of
+        the guest RAM, with segments that fit in the file.
+
+        :param vm: virtual machine.
+        :param qmp_monitor: QMP monitor for the guest.
+        :param vmcore_plain: absolute pathname of the host vmcore file.
+        :raise: error.TestFail if the vmcore is corrupt.
+        """
+        spot_checks = int(params.get("vmcore_spot_checks", 256))
+        vm.pause()
+        try:
+            dump_start = time.time()
+            qmp_monitor.cmd(cmd="dump-guest-memory",
+                            args={"paging": False,
+                                  "protocol": "file:%s" % vmcore_plain},
+                            timeout=LONG_TIMEOUT)
+            dump_time = time.time() - dump_start
+            try:
+                core = vmcore.Vmcore(vmcore_plain)
+            except vmcore.VmcoreError, details:
+                raise error.TestFail("vmcore corrupt: %s" % details)
+            try:
+                logging.info("vmcore of %d MB dumped in %.1fs, %d PT_LOAD "
+                             "segments", core.size / 1048576, dump_time,
+                             len(core.loads))
+                problems = core.check_layout()
+                if core.machine != vmcore.EM_X86_64:
+                    problems.append("ELF machine %s is not x86_64" %
+                                    core.machine)
+                ram_mb = core.ram_size() / 1048576
+                if ram_mb < vm.get_memory_size():
+                    problems.append("vmcore holds %d MB of the %d MB of "
+                                    "guest RAM" % (ram_mb,
+                                                   vm.get_memory_size()))
+                if problems:
+                    raise error.TestFail("vmcore corrupt: %s" %
+                                         "; ".join(problems))
+                addresses = core.sample_addresses(spot_checks)
+                mismatches = vmcore.spot_check(
+                    core, qmp_monitor, addresses,
+                    os.path.join(test.tmpdir, "pmemsave"))
+            finally:
+                core.close()
+        finally:
+            vm.resume()
+        logging.info("%d of %d sampled pages match the guest memory",
+                     len(addresses) - len(mismatches), len(addresses))
+        if mismatches:
+            raise error.TestFail("vmcore corrupt: %d pages differ from the "
+                                 "guest memory, first at 0x%x" %
+                                 (len(mismatches), mismatches[0]))
+
     vm = env.get_vm(params["main_vm"])
     vm.verify_alive()
 
@@ -277,6 +361,16 @@ def run(test, params, env):
     login_timeout = int(params.get("login_timeout", 240))
     session = vm.wait_for_login(timeout=login_timeout)
     try:
+        if params.get("vmcore_verify", "guest") == "host":
+            check_requirements(vm, session, check_mem=False)
+            vmcore_plain = os.path.join(test.tmpdir, VMCORE_BASE)
+            try:
+                verify_vmcore_host(vm, qmp_monitor, vmcore_plain)
+            finally:
+                if os.path.exists(vmcore_plain):
+                    os.unlink(vmcore_plain)
+            return
+
         check_requirements(vm, session)
 
         new_sess = install_kernel_debuginfo(vm, session, login_timeout)
@@ -289,7 +383,9 @@ def run(test, params, env):
 
         vmcore_compr = "%s.gz" % VMCORE_BASE
         vmcore_host = os.path.join(test.tmpdir, vmcore_compr)
-        dump_and_compress(qmp_monitor, vmcore_host)
+        stats = dump_and_compress(qmp_monitor, vmcore_host)
+        test.write_test_keyval(dict(("dump_%s" % key, "%.3f" % value)
+                                    for key, value in stats.items()))
         try:
             verify_vmcore(vm, session, vmcore_host, vmcore_compr, VMCORE_BASE)
         finally:
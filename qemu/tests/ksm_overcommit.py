@@ -12,6 +12,13 @@ from autotest.client.shared import utils
 from virttest import utils_misc, utils_test, env_process, data_dir
 from virttest.staging import utils_memory
 
+from provider import host_sampler
+
+
+KSM_DIR = "/sys/kernel/mm/ksm"
+KSM_COUNTERS = ("pages_shared", "pages_sharing", "pages_unshared",
+                "full_scans")
+
 
 def run(test, params, env):
     """
@@ -41,6 +48,13 @@ def run(test, params, env):
                    3) Verifies all pages
                    4) Fills memory with the same number (S2)
                    5) Changes the last 96B (S3)
+    Bench mode - parallel mode setup, measures ksmd for every
+                 pages_to_scan/sleep_millisecs pair of the sweep while the
+                 KSM counters and the ksmd cpu time are sampled:
+                 1) Fills memory with the same number (S1), until merged
+                 2) Fills memory with random numbers (S2)
+                 Reports the merge and split rates and the ksmd cpu
+                 seconds per merged GB.
 
     Scenarios:
     S1) Fill all vms with the same value (all pages should be merged into 1)
@@ -59,9 +73,16 @@ def run(test, params, env):
     :param cfg: ksm_parallel_ratio - number of workers (parallel mode only)
     :param cfg: ksm_host_reserve - override memory reserve on host in MB
     :param cfg: ksm_guest_reserve - override memory reserve on guests in MB
-    :param cfg: ksm_mode - test mode {serial, parallel}
+    :param cfg: ksm_mode - test mode {serial, parallel, bench}
+    :param cfg: ksm_pages_to_scan - ksmd pages_to_scan
+    :param cfg: ksm_sleep_millisecs - ksmd sleep_millisecs
+    :param cfg: ksm_bench_pages_to_scan - pages_to_scan values (bench mode)
+    :param cfg: ksm_bench_sleep_millisecs - sleep_millisecs values (bench
+                                            mode)
     :param cfg: ksm_perf_ratio - performance ratio, increase it when your
                                  machine is too slow
+    :param cfg: ksm_allocator - guest allocator {python, native}, native
+                                is the multi-threaded deps/ksm_fill
     """
     def _start_allocator(vm, session, timeout):
         """
@@ -72,8 +93,8 @@ def run(test, params, env):
         :param timeout: Timeout that will be used to verify if
                 ksm_overcommit_guest.py started properly.
         """
-        logging.debug("Starting ksm_overcommit_guest.py on guest %s", vm.name)
-        session.sendline("python /tmp/ksm_overcommit_guest.py")
+        logging.debug("Starting %s on guest %s", allocator_cmd, vm.name)
+        session.sendline(allocator_cmd)
         try:
             session.read_until_last_line_matches(["PASS:", "FAIL:"], timeout)
         except aexpect.ExpectProcessTerminatedError, details:
@@ -118,6 +139,18 @@ def run(test, params, env):
         fpages.close()
         return ((ksm_pages * 4096) / 1e6)
 
+    def set_ksm(pages_to_scan, sleep_millisecs):
+        """
+        Set the ksmd scan rate.
+        """
+        for name, value in (("pages_to_scan", pages_to_scan),
+                            ("sleep_millisecs", sleep_millisecs)):
+            ksm_file = open(os.path.join(KSM_DIR, name), "w")
+            try:
+                ksm_file.write(str(value))
+            finally:
+                ksm_file.close()
+
     def initialize_guests():
         """
         Initialize guests (fill their memories with specified patterns).
@@ -403,6 +436,223 @@ def run(test, params, env):
         session.close()
         vm.destroy(gracefully=False)
 
+    def _fill_parallel(cmd, vm, timeout):
+        """
+        Send cmd to all the allocators of vm at once and wait for them.
+        """
+        for i in range(0, max_alloc):
+            lsessions[i].sendline(cmd)
+        for i in range(0, max_alloc):
+            try:
+                match, data = lsessions[i].read_until_last_line_matches(
+                    ["PASS:", "FAIL:"], timeout)
+            except aexpect.ExpectProcessTerminatedError, details:
+                raise error.TestFail("Failed to execute command '%s' on "
+                                     "ksm_overcommit_guest.py, vm '%s': %s" %
+                                     (cmd, vm.name, details))
+            if match != 0:
+                raise error.TestFail("Command '%s' failed on allocator %d: "
+                                     "%s" % (cmd, i, data))
+
+    def ksm_bench():
+        """
+        Merge and split the allocator memory for every pages_to_scan and
+        sleep_millisecs of the sweep, sampling the KSM counters and the
+        ksmd cpu time.
+        """
+        session = lsessions[0]
+        vm = lvms[0]
+        for i in range(1, max_alloc):
+            lsessions.append(vm.wait_for_login(timeout=360))
+        session.cmd("swapoff -a", timeout=300)
+        for i in range(0, max_alloc):
+            _start_allocator(vm, lsessions[i], 60 * perf_ratio)
+            cmd = "mem = MemFill(%d, %s, %s)" % ((ksm_size / max_alloc),
+                                                 skeys[i], dkeys[i])
+            _execute_allocator(cmd, vm, lsessions[i], 60 * perf_ratio)
+
+        ksmd = host_sampler.find_pids("ksmd")
+        if not ksmd:
+            raise error.TestError("ksmd kernel thread not found")
+        ksmd_cpu = "pid:%s" % ksmd[0]
+        interval = float(params.get("ksm_bench_interval", 0.5))
+        sampler = host_sampler.HostSampler(
+            interval=interval,
+            size=int(params.get("ksm_bench_sample_size", 36000)),
+            kvm_stats=(), pids=ksmd,
+            files=dict((_, os.path.join(KSM_DIR, _)) for _ in KSM_COUNTERS))
+        # Allocator memory in 4k pages
+        ksm_pages = ksm_size * 256
+        merge_target = float(params.get("ksm_bench_merge_target", 0.95))
+        merge_timeout = float(params.get("ksm_bench_merge_timeout",
+                                         600)) * perf_ratio
+
+        def window_stats(start, end):
+            # The rates use the time between the first and the last sample
+            # of the window, like the counter deltas
+            window = sampler.samples(start, end)
+            if len(window) < 2:
+                raise error.TestError("Less than 2 KSM samples in %.1fs, "
+                                      "lower ksm_bench_interval" %
+                                      (end - start))
+            stats = {"elapsed": window[-1][0] - window[0][0]}
+            for name in KSM_COUNTERS:
+                stats[name] = sampler.counter_delta("file:%s" % name,
+                                                    start, end)
+            stats["ksmd_cpu"] = (float(sampler.counter_delta(ksmd_cpu, start,
+                                                             end)) /
+                                 sampler.clk_tck)
+            return stats
+
+        results = []
+        sampler.start()
+        try:
+            for pages_to_scan in params.get("ksm_bench_pages_to_scan",
+                                            "100 1000 5000").split():
+                for sleep_ms in params.get("ksm_bench_sleep_millisecs",
+                                           "20 50 200").split():
+                    set_ksm(pages_to_scan, sleep_ms)
+                    logging.info("KSM bench: pages_to_scan %s, "
+                                 "sleep_millisecs %s", pages_to_scan,
+                                 sleep_ms)
+                    # Merge, from the start of the guest fill (ksmd merges
+                    # the pages as soon as they are written) to the first
+                    # time pages_sharing is at the target. A fast scan
+                    # rate merging it all during the fill and a slow one
+                    # not reaching it in time are results too.
+                    fill_start = time.time()
+                    _fill_parallel("mem.value_fill(%d)" % skeys[0], vm,
+                                   fill_base_timeout * 2 * perf_ratio)
+                    fill_end = time.time()
+                    merged = True
+                    merged_in_fill = True
+                    while (host_sampler.read_int_file(
+                            os.path.join(KSM_DIR, "pages_sharing")) <
+                           merge_target * ksm_pages):
+                        merged_in_fill = False
+                        if time.time() - fill_end > merge_timeout:
+                            logging.warn("Only %s of %s pages merged after "
+                                         "%ds", host_sampler.read_int_file(
+                                             os.path.join(KSM_DIR,
+                                                          "pages_sharing")),
+                                         ksm_pages, merge_timeout)
+                            merged = False
+                            break
+                        time.sleep(interval)
+                    # Keep at least a few samples in the window
+                    time.sleep(max(0, fill_start + 3 * interval -
+                                   time.time()))
+                    merge_end = time.time()
+                    merged_pct = (100.0 * host_sampler.read_int_file(
+                        os.path.join(KSM_DIR, "pages_sharing")) / ksm_pages)
+                    # Let the sampler see the end of the window
+                    time.sleep(interval * 2)
+
+                    split_start = time.time()
+                    _fill_parallel("mem.static_random_fill()", vm,
+                                   fill_base_timeout * perf_ratio)
+                    time.sleep(max(0, split_start + 3 * interval -
+                                   time.time()))
+                    split_end = time.time()
+                    time.sleep(interval * 2)
+
+                    merge = window_stats(fill_start, merge_end)
+                    split = window_stats(split_start, split_end)
+                    merged_gb = merge["pages_sharing"] * 4096 / 1073741824.0
+                    result = {
+                        "pages_to_scan": int(pages_to_scan),
+                        "sleep_millisecs": int(sleep_ms),
+                        "merged": merged,
+                        "merged_pct": merged_pct,
+                        "merged_in_fill": merged_in_fill,
+                        "fill_time": fill_end - fill_start,
+                        "merge_time": merge_end - fill_start,
+                        "merge_mbps": (merge["pages_sharing"] / 256.0 /
+                                       max(merge["elapsed"], 1e-6)),
+                        "split_time": split_end - split_start,
+                        "split_mbps": (-split["pages_sharing"] / 256.0 /
+                                       max(split["elapsed"], 1e-6)),
+                        "full_scans": merge["full_scans"],
+                        "ksmd_cpu": merge["ksmd_cpu"],
+                        "ksmd_cpu_per_gb": (merged_gb and
+                                            merge["ksmd_cpu"] / merged_gb or
+                                            0.0),
+                        "start": fill_start,
+                        "end": split_end}
+                    logging.info("Merged %.1f%% at %.1f MB/s in %.1fs%s (%d "
+                                 "full scans, ksmd %.1f cpu s/GB), split "
+                                 "%.1f MB/s", merged_pct,
+                                 result["merge_mbps"], result["merge_time"],
+                                 merged_in_fill and ", during the fill" or "",
+                                 result["full_scans"],
+                                 result["ksmd_cpu_per_gb"],
+                                 result["split_mbps"])
+                    results.append(result)
+        finally:
+            sampler.stop()
+            set_ksm(params.get("ksm_pages_to_scan", 5000),
+                    params.get("ksm_sleep_millisecs", 50))
+
+        result_file = open(os.path.join(test.resultsdir, "ksm_bench.RHS"),
+                           "w")
+        try:
+            result_file.write("pages_to_scan|sleep_millisecs|merged%|"
+                              "in_fill|fill_s|merge_s|merge_MB/s|full_scans|"
+                              "ksmd_cpu_s|ksmd_cpu_s/GB|split_s|"
+                              "split_MB/s\n")
+            for result in results:
+                result_file.write(
+                    "%(pages_to_scan)d|%(sleep_millisecs)d|%(merged_pct).1f|"
+                    "%(merged_in_fill)d|%(fill_time).1f|"
+                    "%(merge_time).1f|%(merge_mbps).1f|%(full_scans)d|"
+                    "%(ksmd_cpu).2f|%(ksmd_cpu_per_gb).2f|"
+                    "%(split_time).1f|%(split_mbps).1f\n" % result)
+        finally:
+            result_file.close()
+
+        # Timeline of the counters, one row per sample
+        timeline = open(os.path.join(test.resultsdir, "ksm_timeline.csv"),
+                        "w")
+        try:
+            timeline.write("time,pages_to_scan,sleep_millisecs,%s,"
+                           "ksmd_cpu_ticks\n" % ",".join(KSM_COUNTERS))
+            for sample in sampler.samples():
+                current = [_ for _ in results
+                           if _["start"] <= sample[0] <= _["end"]]
+                if not current:
+                    continue
+                timeline.write("%.3f,%d,%d,%s,%s\n" % (
+                    sample[0] - results[0]["start"],
+                    current[0]["pages_to_scan"],
+                    current[0]["sleep_millisecs"],
+                    ",".join(str(sample[4].get("file:%s" % _, ""))
+                             for _ in KSM_COUNTERS),
+                    sample[4].get(ksmd_cpu, "")))
+        finally:
+            timeline.close()
+
+        keyval = {}
+        for result in results:
+            prefix = "ksm_%(pages_to_scan)d_%(sleep_millisecs)d" % result
+            for key in ("merged_pct", "merge_mbps", "split_mbps",
+                        "ksmd_cpu_per_gb"):
+                keyval["%s_%s" % (prefix, key)] = "%.2f" % result[key]
+        test.write_test_keyval(keyval)
+
+        logging.debug("Cleaning up...")
+        for i in range(0, max_alloc):
+            lsessions[i].cmd_output("die()", 20)
+        session.close()
+        vm.destroy(gracefully=False)
+
+        not_merged = ["%(pages_to_scan)d/%(sleep_millisecs)d" % _
+                      for _ in results if not _["merged"]]
+        if not_merged:
+            logging.info("KSM didn't merge %d%% of the memory in %ds with "
+                         "pages_to_scan/sleep_millisecs %s",
+                         merge_target * 100, merge_timeout,
+                         ", ".join(not_merged))
+
     # Main test code
     logging.info("Starting phase 0: Initialization")
     if utils.run("ps -C ksmtuned", ignore_status=True).exit_status == 0:
@@ -410,8 +660,8 @@ def run(test, params, env):
         utils.run("killall ksmtuned")
     new_ksm = False
     if (os.path.exists("/sys/kernel/mm/ksm/run")):
-        utils.run("echo 50 > /sys/kernel/mm/ksm/sleep_millisecs")
-        utils.run("echo 5000 > /sys/kernel/mm/ksm/pages_to_scan")
+        set_ksm(params.get("ksm_pages_to_scan", 5000),
+                params.get("ksm_sleep_millisecs", 50))
         utils.run("echo 1 > /sys/kernel/mm/ksm/run")
 
         e_up = "/sys/kernel/mm/transparent_hugepage/enabled"
@@ -480,7 +730,7 @@ def run(test, params, env):
     else:
         perf_ratio = 1
 
-    if (params['ksm_mode'] == "parallel"):
+    if params['ksm_mode'] in ("parallel", "bench"):
         vmsc = 1
         overcommit = 1
         mem = host_mem
@@ -641,18 +891,37 @@ def run(test, params, env):
     time.sleep(vmsc * 2 * perf_ratio)
     logging.debug(utils_test.get_memory_info(lvms))
 
-    # Copy ksm_overcommit_guest.py into guests
-    vksmd_src = os.path.join(data_dir.get_shared_dir(),
-                             "scripts", "ksm_overcommit_guest.py")
-    dst_dir = "/tmp"
-    for vm in lvms:
-        vm.copy_files_to(vksmd_src, dst_dir)
+    if params.get("ksm_allocator", "python") == "native":
+        # Build the native allocator in the guests, it speaks the
+        # ksm_overcommit_guest.py protocol
+        ksm_fill_src = os.path.join(data_dir.get_deps_dir("ksm_fill"), "src")
+        dst_dir = "/tmp/ksm_fill"
+        for vm, session in zip(lvms, lsessions):
+            session.cmd("rm -rf %s" % dst_dir)
+            vm.copy_files_to(ksm_fill_src, dst_dir)
+            session.cmd("make -C %s clean ksm_fill" % dst_dir,
+                        timeout=120 * perf_ratio)
+        allocator_cmd = os.path.join(dst_dir, "ksm_fill")
+    else:
+        # Copy ksm_overcommit_guest.py into guests
+        vksmd_src = os.path.join(data_dir.get_shared_dir(),
+                                 "scripts", "ksm_overcommit_guest.py")
+        dst_dir = "/tmp"
+        for vm in lvms:
+            vm.copy_files_to(vksmd_src, dst_dir)
+        allocator_cmd = "python /tmp/ksm_overcommit_guest.py"
     logging.info("Phase 0: PASS")
 
     if params['ksm_mode'] == "parallel":
         logging.info("Starting KSM test parallel mode")
         split_parallel()
         logging.info("KSM test parallel mode: PASS")
+    elif params['ksm_mode'] == "bench":
+        if not new_ksm:
+            raise error.TestNAError("KSM bench mode needs %s" % KSM_DIR)
+        logging.info("Starting KSM test bench mode")
+        ksm_bench()
+        logging.info("KSM test bench mode: PASS")
     elif params['ksm_mode'] == "serial":
         logging.info("Starting KSM test serial mode")
         initialize_guests()
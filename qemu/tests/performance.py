@@ -1,10 +1,10 @@
 import os
 import re
-import commands
+import json
+import time
+import logging
 import shutil
-import shelve
-import threading
-from Queue import Queue
+import signal
 
 from autotest.client.shared import error
 from autotest.client import utils
@@ -13,8 +13,12 @@ from virttest import utils_test
 from virttest import utils_misc
 from virttest import data_dir
 
+from provider import host_monitor
+from provider import host_sampler
 
-def cmd_runner_monitor(vm, monitor_cmd, test_cmd, guest_path, timeout=300):
+
+def cmd_runner_monitor(vm, monitor_cmd, test_cmd, guest_path, timeout=300,
+                       extra_monitors=None):
     """
     For record the env information such as cpu utilization, meminfo while
     run guest test in guest.
@@ -23,50 +27,28 @@ def cmd_runner_monitor(vm, monitor_cmd, test_cmd, guest_path, timeout=300):
     @test_cmd: test suit run command
     @guest_path: path in guest to store the test result and monitor data
     @timeout: longest time for monitor running
+    @extra_monitors: dict of name -> (command, stop signal) of more host
+                     monitors running along with monitor_cmd, e.g. vmstat or
+                     perf stat, their output goes to
+                     /tmp/host_<name>_result_<tag>
     Return: tag the suffix of the results
     """
-    def thread_kill(cmd, p_file):
-        fd = shelve.open(p_file)
-        o = commands.getoutput("pstree -p %s" % fd["pid"])
-        tmp = re.split("\s+", cmd)[0]
-        pid = re.findall("%s.(\d+)" % tmp, o)[0]
-        s, o = commands.getstatusoutput("kill -9 %s" % pid)
-        fd.close()
-        return (s, o)
-
-    def monitor_thread(m_cmd, p_file, r_file):
-        fd = shelve.open(p_file)
-        fd["pid"] = os.getpid()
-        fd.close()
-        os.system("%s &> %s" % (m_cmd, r_file))
-
-    def test_thread(session, m_cmd, t_cmd, p_file, flag, timeout):
-        flag.put(True)
-        s, o = session.cmd_status_output(t_cmd, timeout)
-        if s != 0:
-            raise error.TestFail("Test failed or timeout: %s" % o)
-        if not flag.empty():
-            flag.get()
-            thread_kill(m_cmd, p_file)
-
-    kill_thread_flag = Queue(1)
     session = vm.wait_for_login(timeout=300)
     tag = vm.instance
-    pid_file = "/tmp/monitor_pid_%s" % tag
     result_file = "/tmp/host_monitor_result_%s" % tag
 
-    monitor = threading.Thread(target=monitor_thread, args=(monitor_cmd,
-                                                            pid_file, result_file))
-    test_runner = threading.Thread(target=test_thread, args=(session,
-                                                             monitor_cmd, test_cmd, pid_file,
-                                                             kill_thread_flag, timeout))
-    monitor.start()
-    test_runner.start()
-    monitor.join(int(timeout))
-    if not kill_thread_flag.empty():
-        kill_thread_flag.get()
-        thread_kill(monitor_cmd, pid_file)
-        thread_kill("sh", pid_file)
+    monitors = host_monitor.MonitorManager()
+    monitors.start("monitor", monitor_cmd, result_file)
+    for name, (cmd, stop_signal) in (extra_monitors or {}).items():
+        monitors.start(name, cmd, "/tmp/host_%s_result_%s" % (name, tag),
+                       stop_signal)
+    try:
+        s, o = session.cmd_status_output(test_cmd, int(timeout))
+    finally:
+        monitors.stop_all()
+        session.close()
+    if s != 0:
+        raise error.TestFail("Test failed or timeout: %s" % o)
 
     guest_result_file = "/tmp/guest_result_%s" % tag
     guest_monitor_result_file = "/tmp/guest_monitor_result_%s" % tag
@@ -154,14 +136,42 @@ def run(test, params, env):
     cmd += " %s" % int(test_timeout)
 
     test_cmd = cmd
+    # Sample host cpu, kvm exits and qemu cpu time in process along with
+    # the monitor command
+    sampler = None
+    if params.get("host_sampler") == "yes":
+        sampler = host_sampler.HostSampler(
+            interval=float(params.get("host_sample_interval", 1)),
+            pids=[vm.get_pid()])
+        sampler.start()
+    start_time = time.time()
+    # More host monitors running along with monitor_cmd
+    extra_monitors = {}
+    for name in params.get("host_monitors", "").split():
+        stop_signal = params.get("host_monitor_signal_%s" % name, "TERM")
+        extra_monitors[name] = (params["host_monitor_cmd_%s" % name],
+                                getattr(signal, "SIG%s" % stop_signal))
     # Run guest test with monitor
     tag = cmd_runner_monitor(vm, monitor_cmd, test_cmd,
-                             guest_path, timeout=test_timeout)
+                             guest_path, timeout=test_timeout,
+                             extra_monitors=extra_monitors)
 
     # Result collecting
     result_list = ["/tmp/guest_result_%s" % tag,
                    "/tmp/host_monitor_result_%s" % tag,
                    "/tmp/guest_monitor_result_%s" % tag]
+    for name in extra_monitors:
+        result_list.append("/tmp/host_%s_result_%s" % (name, tag))
+    if sampler:
+        sampler.stop()
+        report = sampler.report(start_time, time.time())
+        sampler_result = "/tmp/host_sampler_result_%s" % tag
+        sampler_file = open(sampler_result, "w")
+        json.dump(report, sampler_file)
+        sampler_file.close()
+        result_list.append(sampler_result)
+        for key, value in report["cpu"]["summary"].items():
+            test.write_perf_keyval({"host_cpu_%s" % key: value})
     guest_results_dir = os.path.join(test.outputdir, "guest_results")
     if not os.path.exists(guest_results_dir):
         os.mkdir(guest_results_dir)
@@ -269,6 +279,74 @@ def get_sum_result(sum_matrix, value, tag):
     return sum_matrix
 
 
+def index_result_files(topdir, index_file=None):
+    """
+    List the files under topdir, reusing the listing of the job dirs that
+    did not change since the last call.
+
+    The listing is saved per top level job dir in index_file with the
+    mtime of every dir below it. A job dir is only reused if none of these
+    mtimes changed (a new file or sub dir changes the mtime of its parent
+    dir) and they were all older than the index when the index was
+    written, so dirs still being written at that time are listed again.
+
+    :param topdir: results directory holding the job dirs
+    :param index_file: file to save the listing to, None to not save it
+    :return: list of (dirpath, filenames) for all the dirs with files
+    """
+    index = {}
+    index_time = 0
+    if index_file and os.path.isfile(index_file):
+        try:
+            index_fd = open(index_file)
+            saved = json.load(index_fd)
+            index_fd.close()
+            index = saved["dirs"]
+            index_time = saved["time"]
+        except (ValueError, KeyError, IOError):
+            index = {}
+
+    now = time.time()
+    new_index = {}
+    listing = []
+    top_files = []
+    for entry in sorted(os.listdir(topdir)):
+        path = os.path.join(topdir, entry)
+        if not os.path.isdir(path):
+            top_files.append(entry)
+            continue
+        dirs = index.get(entry)
+        if dirs:
+            for dirpath, _, mtime in dirs:
+                try:
+                    if (os.path.getmtime(os.path.join(topdir, dirpath)) !=
+                            mtime or mtime >= index_time):
+                        dirs = None
+                        break
+                except OSError:
+                    dirs = None
+                    break
+        if not dirs:
+            dirs = [[dirpath[len(topdir):].lstrip("/"), filenames,
+                     os.path.getmtime(dirpath)]
+                    for dirpath, _, filenames in os.walk(path)]
+        new_index[entry] = dirs
+        for dirpath, filenames, _ in dirs:
+            if filenames:
+                listing.append((os.path.join(topdir, dirpath), filenames))
+    if top_files:
+        listing.append((topdir, top_files))
+
+    if index_file:
+        try:
+            index_fd = open(index_file, "w")
+            json.dump({"time": now, "dirs": new_index}, index_fd)
+            index_fd.close()
+        except IOError, details:
+            logging.warn("Can not save the result index: %s", details)
+    return listing
+
+
 def result_sum(topdir, params, guest_ver, resultsdir, test):
     case_type = params.get("test")
     unit_std = params.get("unit_std", "M")
@@ -294,38 +372,46 @@ def result_sum(topdir, params, guest_ver, resultsdir, test):
     if params.get("file_list"):
         file_list = params.get("file_list").split()
 
-    for files in os.walk(topdir):
-        if files[2]:
-            for file in files[2]:
-                jump_flag = False
-                for ignore_case in ignore_cases:
-                    if ignore_case in files[0]:
-                        jump_flag = True
-                if jump_flag:
-                    continue
-                file_dir_norpt = re.sub("\.repeat\d+", "", files[0])
-                if (repeatn in files[0] and
-                        category_key in file_dir_norpt and
-                        case_type in files[0]):
-                    for i, pattern in enumerate(file_list):
-                        if re.findall(pattern, file):
-                            prefix = re.findall("%s\.[\d\w_\.]+" % case_type,
-                                                file_dir_norpt)[0]
-                            prefix = re.sub("\.|_", "--", prefix)
-                            if prefix not in results_files.keys():
-                                results_files[prefix] = []
-                                tmp = []
-                                for j in range(len(file_list)):
-                                    tmp.append(None)
-                                results_files[prefix] = tmp
-                            tmp_file = utils_misc.get_path(files[0], file)
-                            results_files[prefix][i] = tmp_file
+    # Compile the patterns once and only list the job dirs which are new
+    # since the last summary
+    index_file = params.get("result_index_file")
+    if not index_file:
+        # keep the index out of the shared results tree
+        index_file = os.path.join(data_dir.get_tmp_dir(),
+                                  "result_sum_index_%s" %
+                                  re.sub(r"\W", "_", os.path.abspath(topdir)))
+    file_res = [re.compile(_) for _ in file_list]
+    ignore_re = None
+    if ignore_cases:
+        ignore_re = re.compile("|".join(re.escape(_) for _ in ignore_cases))
+    prefix_re = re.compile("%s\.[\d\w_\.]+" % case_type)
+    repeat_re = re.compile("\.repeat\d+")
+    for dirpath, filenames in index_result_files(topdir, index_file):
+        if ignore_re and ignore_re.search(dirpath):
+            continue
+        file_dir_norpt = repeat_re.sub("", dirpath)
+        if not (repeatn in dirpath and
+                category_key in file_dir_norpt and
+                case_type in dirpath):
+            continue
+        prefix = None
+        for file in filenames:
+            for i, pattern in enumerate(file_res):
+                if pattern.search(file):
+                    if prefix is None:
+                        prefix = prefix_re.findall(file_dir_norpt)[0]
+                        prefix = re.sub("\.|_", "--", prefix)
+                    if prefix not in results_files:
+                        results_files[prefix] = [None] * len(file_list)
+                    tmp_file = utils_misc.get_path(dirpath, file)
+                    results_files[prefix][i] = tmp_file
 
     # Start to read results from results file and monitor file
     results_matrix = {}
     no_table_results = {}
     thread_tag = params.get("thread_tag", "thread")
     order_list = []
+    mark_res = {}
     for prefix in results_files:
         marks = params.get("marks", "").split()
         case_infos = prefix.split("--")
@@ -367,7 +453,9 @@ def result_sum(topdir, params, guest_ver, resultsdir, test):
         result_context_file.close()
         for mark in marks:
             mark_tag, mark_key = mark.split(":")
-            datas = re.findall(mark_key, result_context)
+            if mark_key not in mark_res:
+                mark_res[mark_key] = re.compile(mark_key)
+            datas = mark_res[mark_key].findall(result_context)
             if isinstance(datas[0], tuple):
                 data = time_ana(datas[0])
             else:
@@ -416,17 +504,16 @@ def result_sum(topdir, params, guest_ver, resultsdir, test):
 
     sum_marks = params.get("sum_marks", "").split()
     sum_matrix = {}
-    order_line = ""
     if results_matrix.get("thread_tag"):
         headline = "%20s|" % results_matrix["thread_tag"]
         results_matrix.pop("thread_tag")
     else:
         headline = ""
+    order_index = {}
     for index, tag in enumerate(order_list):
         headline += "%s|" % format_result(tag)
-        order_line += "DATA%d|" % index
+        order_index.setdefault(tag, index)
     headline = headline.rstrip("|")
-    order_line = order_line.rstrip("|")
 
     result_path = utils_misc.get_path(resultsdir,
                                       "%s-result.RHS" % case_type)
@@ -445,7 +532,7 @@ def result_sum(topdir, params, guest_ver, resultsdir, test):
         matrix_order = results_matrix.keys()
         matrix_order.sort()
     for category in matrix_order:
-        out_loop_line = order_line
+        out_loop_values = ["DATA%d" % num for num in range(len(order_list))]
         result_file.write("%s\n" % category)
         line = ""
         write_out_loop = True
@@ -462,17 +549,13 @@ def result_sum(topdir, params, guest_ver, resultsdir, test):
                 result_file.write("%s\n" % line.rstrip("|"))
                 write_out_loop = False
             else:
-                #line += "%s|" % format_result(results_matrix[category][item])
-                re_data = "DATA%s" % order_list.index(item)
-                out_loop_line = re.sub(re_data,
-                                       format_result(
-                                           results_matrix[category][item]),
-                                       out_loop_line)
-                if tag in sum_marks:
-                    sum_matrix = get_sum_result(sum_matrix, tmp_dic[tag],
-                                                tag)
+                out_loop_values[order_index[item]] = format_result(
+                    results_matrix[category][item])
+                if item in sum_marks:
+                    sum_matrix = get_sum_result(
+                        sum_matrix, results_matrix[category][item], item)
         if write_out_loop:
-            result_file.write("%s\n" % out_loop_line)
+            result_file.write("%s\n" % "|".join(out_loop_values))
 
     if sum_matrix:
         if case_type == "ffsb":
@@ -4,7 +4,7 @@ Collection of virtio_console and virtio_serialport tests.
 :copyright: 2010-2012 Red Hat Inc.
 """
 from collections import deque
-import array
+import functools
 import logging
 import os
 import random
@@ -27,6 +27,9 @@ from virttest import funcatexit
 from virttest.qemu_devices import qdevices
 from virttest.utils_virtio_port import VirtioPortTest
 
+from provider import throughput_sampler
+from provider import virtio_port_perf
+
 EXIT_EVENT = threading.Event()
 
 
@@ -948,21 +951,58 @@ def run(test, params, env):
         if err:
             raise error.TestFail("%s failed" % err[:-2])
 
-    @error.context_aware
-    def _process_stats(stats, scale=1.0):
+    def _report_perf(sampler, direction, name):
         """
-        Process the stats to human readable form.
-        :param stats: List of measured data.
+        Log the throughput statistics of a perf run and write its time series
+        to the debug dir.
+
+        :param sampler: ThroughputSampler of the run
+        :param direction: "Host -> Guest" or "Guest -> Host"
+        :param name: name of the time series file
         """
+        stats = sampler.summary()
+        logging.debug("Stats = %s", stats)
         if not stats:
-            return None
-        for i in xrange((len(stats) - 1), 0, -1):
-            stats[i] = stats[i] - stats[i - 1]
-            stats[i] /= scale
-        stats[0] /= scale
-        stats = sorted(stats)
+            return
+        logging.info("%s [MB/s] (mean/min/p1/p50/p99/max) = %.3f/%.3f/%.3f/"
+                     "%.3f/%.3f/%.3f", direction, stats['mean'], stats['min'],
+                     stats['p1'], stats['p50'], stats['p99'], stats['max'])
+        logging.info("%s: %d intervals, jitter %.6fs, %d stalls (total "
+                     "%.3fs, longest %.3fs)", direction, stats['intervals'],
+                     stats['jitter'], stats['stalls'], stats['stall_time'],
+                     stats['max_stall'])
+        sampler.write_series(os.path.join(test.debugdir, name))
         return stats
 
+    def _perf_threads():
+        """
+        Get the host send and receive thread classes of the perf tests.
+
+        :param cfg: virtio_console_perf_zerocopy - send/receive through one
+                    preallocated buffer (sendmsg/recv_into) instead of
+                    ThSend/ThRecv (no)
+        """
+        if params.get('virtio_console_perf_zerocopy') == 'yes':
+            return virtio_port_perf.PerfSend, virtio_port_perf.PerfRecv
+        return qemu_virtio_port.ThSend, qemu_virtio_port.ThRecv
+
+    def _perf_open(port):
+        """
+        Open the port and set the host socket buffer sizes.
+
+        :param cfg: virtio_console_perf_sndbuf - host socket send buffer size
+        :param cfg: virtio_console_perf_rcvbuf - host socket receive buffer
+                    size
+        """
+        port.open()
+        if (params.get('virtio_console_perf_sndbuf') or
+                params.get('virtio_console_perf_rcvbuf')):
+            sock_bufs = virtio_port_perf.set_socket_buffers(
+                port.sock, params.get('virtio_console_perf_sndbuf'),
+                params.get('virtio_console_perf_rcvbuf'))
+            logging.debug("%s socket buffers (send/recv) = %s/%s", port.name,
+                          *sock_bufs)
+
     @error.context_aware
     def test_perf():
         """
@@ -974,9 +1014,22 @@ def run(test, params, env):
                         '$console_type@$buffer_length:$test_duration;...'
         :param cfg: virtio_console_test_time - default test_duration time
         :param cfg: virtio_port_spread - how many devices per virt pci (0=all)
+        :param cfg: virtio_console_perf_interval - throughput sampling
+                    interval [s] (default: test_duration / 100)
+        :param cfg: virtio_console_perf_stall - intervals slower than this
+                    fraction of the median throughput are stalls (0.1)
+        :param cfg: virtio_console_perf_zerocopy - send/receive through one
+                    preallocated buffer (sendmsg/recv_into) instead of
+                    ThSend/ThRecv (no)
+        :param cfg: virtio_console_perf_sndbuf - host socket send buffer size
+        :param cfg: virtio_console_perf_rcvbuf - host socket receive buffer
+                    size
         """
         test_params = params['virtio_console_params']
         test_time = int(params.get('virtio_console_test_time', 60))
+        sample_interval = params.get('virtio_console_perf_interval')
+        stall_ratio = float(params.get('virtio_console_perf_stall', 0.1))
+        send_thread, recv_thread = _perf_threads()
         no_serialports = 0
         no_consoles = 0
         if test_params.count('serialport'):
@@ -1009,31 +1062,31 @@ def run(test, params, env):
             param = (param[0] == 'serialport')
             port = consoles[param][0]
 
-            port.open()
+            _perf_open(port)
 
-            data = ""
-            for _ in xrange(buf_len):
-                data += "%c" % random.randrange(255)
+            data = os.urandom(buf_len)
 
             funcatexit.register(env, params.get('type'), __set_exit_event)
 
             time_slice = float(duration) / 100
+            if sample_interval:
+                time_slice = float(sample_interval)
+            series_name = "virtio_perf_%s_%d" % (port.name, buf_len)
 
             # HOST -> GUEST
             guest_worker.cmd('virt.loopback(["%s"], [], %d, virt.LOOP_NONE)'
                              % (port.name, buf_len), 10)
-            thread = qemu_virtio_port.ThSend(port.sock, data, EXIT_EVENT)
-            stats = array.array('f', [])
+            thread = send_thread(port.sock, data, EXIT_EVENT)
+            sampler = throughput_sampler.ThroughputSampler(
+                functools.partial(getattr, thread, "idx"), time_slice,
+                stall_ratio)
             loads = utils.SystemLoad([(os.getpid(), 'autotest'),
                                       (vm.get_pid(), 'VM'), 0])
             try:
                 loads.start()
-                _time = time.time()
                 thread.start()
-                for _ in xrange(100):
-                    stats.append(thread.idx)
-                    time.sleep(time_slice)
-                _time = time.time() - _time - duration
+                sampler.run(duration)
+                _time = sampler.elapsed() - duration
                 logging.info("\n" + loads.get_cpu_status_string()[:-1])
                 logging.info("\n" + loads.get_mem_status_string()[:-1])
                 EXIT_EVENT.set()
@@ -1063,29 +1116,24 @@ def run(test, params, env):
                                   "time slice", _time)
                 else:
                     logging.debug("Test ran %fs longer", _time)
-                stats = _process_stats(stats[1:], time_slice * 1048576)
-                logging.debug("Stats = %s", stats)
-                logging.info("Host -> Guest [MB/s] (min/med/max) = %.3f/%.3f/"
-                             "%.3f", stats[0], stats[len(stats) / 2],
-                             stats[-1])
+                _report_perf(sampler, "Host -> Guest",
+                             series_name + "_h2g")
 
                 del thread
 
                 # GUEST -> HOST
                 EXIT_EVENT.clear()
-                stats = array.array('f', [])
                 guest_worker.cmd("virt.send_loop_init('%s', %d)"
                                  % (port.name, buf_len), 30)
-                thread = qemu_virtio_port.ThRecv(port.sock, EXIT_EVENT,
-                                                 buf_len)
+                thread = recv_thread(port.sock, EXIT_EVENT, buf_len)
                 thread.start()
                 loads.start()
                 guest_worker.cmd("virt.send_loop()", 10)
-                _time = time.time()
-                for _ in xrange(100):
-                    stats.append(thread.idx)
-                    time.sleep(time_slice)
-                _time = time.time() - _time - duration
+                sampler = throughput_sampler.ThroughputSampler(
+                    functools.partial(getattr, thread, "idx"), time_slice,
+                    stall_ratio)
+                sampler.run(duration)
+                _time = sampler.elapsed() - duration
                 logging.info("\n" + loads.get_cpu_status_string()[:-1])
                 logging.info("\n" + loads.get_mem_status_string()[:-1])
                 guest_worker.cmd("virt.exit_threads()", 10)
@@ -1104,11 +1152,8 @@ def run(test, params, env):
                                   "time slice", _time)
                 else:
                     logging.debug("Test ran %fs longer", _time)
-                stats = _process_stats(stats[1:], time_slice * 1048576)
-                logging.debug("Stats = %s", stats)
-                logging.info("Guest -> Host [MB/s] (min/med/max) = %.3f/%.3f/"
-                             "%.3f", stats[0], stats[len(stats) / 2],
-                             stats[-1])
+                _report_perf(sampler, "Guest -> Host",
+                             series_name + "_g2h")
             except Exception, inst:
                 logging.error("test_perf: Failed with %s, starting virtio_test.cleanup",
                               inst)
@@ -1134,6 +1179,127 @@ def run(test, params, env):
             logging.error(msg)
             raise error.TestFail(msg)
 
+    @error.context_aware
+    def test_perf_multiport():
+        """
+        Tests the throughput of many virtio ports driven at the same time.
+        Every port gets its own host sender, in 'both' mode the guest echoes
+        the data back and every port also gets its own host receiver. It
+        reports the aggregate and per port throughput and the host CPU
+        utilization of the autotest and qemu processes.
+
+        :param cfg: virtio_console_perf_serialports - number of serialports
+        :param cfg: virtio_console_perf_consoles - number of consoles
+        :param cfg: virtio_console_perf_buflen - buffer length (65536)
+        :param cfg: virtio_console_perf_direction - 'h2g' sends data to the
+                    guest only, 'both' makes the guest echo it back (both)
+        :param cfg: virtio_console_test_time - test duration
+        :param cfg: virtio_port_spread - how many devices per virt pci (0=all)
+        :param cfg: virtio_console_perf_interval - throughput sampling
+                    interval [s] (default: test duration / 100)
+        :param cfg: virtio_console_perf_stall - intervals slower than this
+                    fraction of the median throughput are stalls (0.1)
+        """
+        no_serialports = int(params.get('virtio_console_perf_serialports', 2))
+        no_consoles = int(params.get('virtio_console_perf_consoles', 0))
+        buf_len = int(params.get('virtio_console_perf_buflen', 65536))
+        echo = params.get('virtio_console_perf_direction', 'both') == 'both'
+        duration = float(params.get('virtio_console_test_time', 60))
+        time_slice = float(params.get('virtio_console_perf_interval',
+                                      duration / 100))
+        stall_ratio = float(params.get('virtio_console_perf_stall', 0.1))
+        send_thread, recv_thread = _perf_threads()
+
+        vm, guest_worker = virtio_test.get_vm_with_worker(no_consoles,
+                                                          no_serialports)
+        (consoles, serialports) = virtio_test.get_virtio_ports(vm)
+        ports = consoles[:no_consoles] + serialports[:no_serialports]
+        if not ports:
+            raise error.TestError("test_perf_multiport: no ports to test")
+        data = os.urandom(buf_len)
+
+        error.context("test_perf_multiport: %d ports, buf_len %d, %s"
+                      % (len(ports), buf_len, echo and "both directions" or
+                         "host -> guest"), logging.info)
+        for port in ports:
+            _perf_open(port)
+            if echo:
+                loop_out = "'%s'" % port.name
+            else:
+                loop_out = ""
+            guest_worker.cmd("virt.loopback(['%s'], [%s], %d, virt.LOOP_NONE)"
+                             % (port.name, loop_out, buf_len), 10)
+
+        EXIT_EVENT.clear()
+        funcatexit.register(env, params.get('type'), __set_exit_event)
+        threads = []
+        for port in ports:
+            threads.append(("%s H2G" % port.name,
+                            send_thread(port.sock, data, EXIT_EVENT)))
+            if echo:
+                threads.append(("%s G2H" % port.name,
+                                recv_thread(port.sock, EXIT_EVENT, buf_len)))
+        samplers = [throughput_sampler.ThroughputSampler(
+            functools.partial(getattr, thread, "idx"), time_slice,
+            stall_ratio) for _, thread in threads]
+        total = throughput_sampler.ThroughputSampler(
+            lambda: sum(_[1].idx for _ in threads), time_slice, stall_ratio)
+        loads = utils.SystemLoad([(os.getpid(), 'autotest'),
+                                  (vm.get_pid(), 'VM'), 0])
+        no_errors = 0
+        try:
+            loads.start()
+            for _, thread in threads:
+                thread.start()
+            throughput_sampler.run_samplers([total] + samplers, duration)
+            logging.info("\n" + loads.get_cpu_status_string()[:-1])
+            logging.info("\n" + loads.get_mem_status_string()[:-1])
+        finally:
+            loads.stop()
+            EXIT_EVENT.set()
+            for _, thread in threads:
+                thread.join(5)
+            funcatexit.unregister(env, params.get('type'), __set_exit_event)
+
+        results = []
+        for (name, thread), sampler in zip(threads, samplers):
+            if thread.isAlive():
+                vm.destroy()
+                raise error.TestError("test_perf_multiport: thread %s did "
+                                      "not finish" % name)
+            if thread.ret_code or thread.idx == 0:
+                no_errors += 1
+                logging.error("test_perf_multiport: no data or error in "
+                              "thread %s", name)
+            stats = _report_perf(sampler, name,
+                                 "virtio_perf_multiport_%s"
+                                 % name.replace(" ", "_").lower())
+            if stats:
+                results.append((name, stats))
+        _report_perf(total, "Aggregate", "virtio_perf_multiport_total")
+        if results:
+            logging.info("test_perf_multiport: per port MB/s\n%s",
+                         "\n".join("%-16s mean %10.3f  p1 %10.3f  p50 %10.3f "
+                                   " p99 %10.3f  stalls %d"
+                                   % (name, stats['mean'], stats['p1'],
+                                      stats['p50'], stats['p99'],
+                                      stats['stalls'])
+                                   for name, stats in results))
+            means = [_[1]['mean'] for _ in results]
+            logging.info("test_perf_multiport: per port mean MB/s "
+                         "(min/max) = %.3f/%.3f", min(means), max(means))
+
+        if echo:
+            guest_worker.safe_exit_loopback_threads(ports, ports)
+        else:
+            guest_worker.safe_exit_loopback_threads(ports, [])
+        virtio_test.cleanup(vm, guest_worker)
+        if no_errors:
+            msg = ("test_perf_multiport: %d errors occurred while executing "
+                   "test, check log for details." % no_errors)
+            logging.error(msg)
+            raise error.TestFail(msg)
+
     #
     # Migration tests
     #